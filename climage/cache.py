@@ -0,0 +1,326 @@
+# Copyright 2013 craigslist
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''craigslist image cache module.
+
+This provides caches the server uses to avoid processing the same image
+more than once.'''
+
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+
+# Indexes into the linked list entries used by the LRU cache.
+PREV, NEXT, KEY, VALUE, SIZE, EXPIRES = range(6)
+
+# Each disk cache entry is a header followed by the key and value.
+SEGMENT_HEADER = struct.Struct('!4sIId')
+SEGMENT_MAGIC = 'CLIC'
+SEGMENT_REGEX = re.compile('^([0-9]+)\\.segment$')
+
+
+class Cache(object):
+    '''Thread safe in-memory LRU cache with a byte budget. Entries are
+    evicted least recently used first once the total size of all values
+    is over max_size bytes, and are ignored after ttl seconds if a ttl is
+    given. Counters for hits, misses, and evictions are kept in the stats
+    attribute.'''
+
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.size = 0
+        self.stats = dict(hits=0, misses=0, evictions=0, expired=0)
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None, 0, None]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        '''Get the value for a key, or None if it is not cached.'''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            if entry[EXPIRES] is not None and entry[EXPIRES] < time.time():
+                self._remove(entry)
+                self.stats['expired'] += 1
+                self.stats['misses'] += 1
+                return None
+            self._unlink(entry)
+            self._link(entry)
+            self.stats['hits'] += 1
+            return entry[VALUE]
+
+    def put(self, key, value, size, ttl=None):
+        '''Add a value that takes size bytes, evicting the least recently
+        used entries if needed. Values larger than max_size are not
+        cached. If a ttl is given, the value is ignored after the lower of
+        it and the cache ttl.'''
+        if ttl is None or (self.ttl is not None and self.ttl < ttl):
+            ttl = self.ttl
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._remove(entry)
+            if size > self.max_size:
+                return
+            expires = None
+            if ttl is not None:
+                expires = time.time() + ttl
+            entry = [None, None, key, value, size, expires]
+            self._entries[key] = entry
+            self._link(entry)
+            self.size += size
+            while self.size > self.max_size:
+                self._remove(self._root[NEXT])
+                self.stats['evictions'] += 1
+
+    def _link(self, entry):
+        '''Link an entry as the most recently used, lock must be held.'''
+        last = self._root[PREV]
+        entry[PREV] = last
+        entry[NEXT] = self._root
+        last[NEXT] = entry
+        self._root[PREV] = entry
+
+    def _unlink(self, entry):
+        '''Unlink an entry from the list, lock must be held.'''
+        entry[PREV][NEXT] = entry[NEXT]
+        entry[NEXT][PREV] = entry[PREV]
+
+    def _remove(self, entry):
+        '''Remove an entry from the cache, lock must be held.'''
+        self._unlink(entry)
+        del self._entries[entry[KEY]]
+        self.size -= entry[SIZE]
+
+
+class DiskCache(object):
+    '''Thread safe on-disk cache stored in append-only segment files that
+    are memory mapped for reads. Values are returned as read-only buffers
+    into the mapped segment so they can be written out without copying.
+    A new segment is started once the current one reaches segment_size
+    bytes. The size attribute only counts entries that are still in the
+    index, and the oldest segments are removed once that is over max_size
+    bytes, or once all segments (including entries that were replaced or
+    expired) take more than twice that. Older segments with no entries
+    left in the index are removed right away. The index is rebuilt by
+    scanning the segments on startup, so cached entries survive restarts.
+    Keys must be strings.'''
+
+    def __init__(self, path, max_size, segment_size, ttl=None):
+        self.path = path
+        self.max_size = max_size
+        self.segment_size = segment_size
+        self.ttl = ttl
+        self.size = 0
+        self.stats = dict(hits=0, misses=0, evictions=0, expired=0)
+        self._lock = threading.Lock()
+        self._index = {}
+        self._segments = {}
+        self._live = {}
+        self._segment_keys = {}
+        self._maps = {}
+        self._current = None
+        self._file = None
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for filename in sorted(os.listdir(path)):
+            match = SEGMENT_REGEX.match(filename)
+            if match is not None:
+                self._load_segment(int(match.group(1)))
+        with self._lock:
+            self._rotate()
+            self._evict()
+
+    def __len__(self):
+        return len(self._index)
+
+    def get(self, key):
+        '''Get a buffer with the value for a key, or None if it is not
+        cached.'''
+        with self._lock:
+            entry = self._index.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            segment, offset, length, expires, _record_length = entry
+            if expires and expires < time.time():
+                self._remove(key)
+                self._remove_dead()
+                self.stats['expired'] += 1
+                self.stats['misses'] += 1
+                return None
+            data = self._maps.get(segment)
+            if data is None or offset + length > len(data):
+                data = self._map(segment)
+            self.stats['hits'] += 1
+            return buffer(data, offset, length)
+
+    def put(self, key, value, ttl=None):
+        '''Append a value to the current segment, starting a new one and
+        removing old ones as needed. Values that would take more than
+        max_size bytes are not cached. If a ttl is given, the value is
+        ignored after the lower of it and the cache ttl, including after a
+        restart.'''
+        if ttl is None or (self.ttl is not None and self.ttl < ttl):
+            ttl = self.ttl
+        expires = 0
+        if ttl is not None:
+            expires = time.time() + ttl
+        record = SEGMENT_HEADER.pack(SEGMENT_MAGIC, len(key), len(value),
+            expires)
+        with self._lock:
+            if len(record) + len(key) + len(value) > self.max_size:
+                self._remove(key)
+                self._remove_dead()
+                return
+            if self._segments[self._current] > 0 and \
+                    self._segments[self._current] + len(record) + len(key) + \
+                    len(value) > self.segment_size:
+                self._rotate()
+            offset = self._segments[self._current]
+            self._file.write(record)
+            self._file.write(key)
+            self._file.write(value)
+            self._file.flush()
+            length = len(record) + len(key) + len(value)
+            self._segments[self._current] += length
+            self._add(key, (self._current, offset + len(record) + len(key),
+                len(value), expires, length))
+            self._evict()
+
+    def _add(self, key, entry):
+        '''Add an entry to the index, replacing any old entry for the key,
+        lock must be held.'''
+        self._remove(key)
+        self._index[key] = entry
+        self._live[entry[0]] += entry[4]
+        self.size += entry[4]
+        self._segment_keys[entry[0]].append(key)
+
+    def _remove(self, key):
+        '''Remove the entry for a key from the index if there is one, lock
+        must be held. The data stays in its segment until it is removed.'''
+        entry = self._index.pop(key, None)
+        if entry is not None:
+            self._live[entry[0]] -= entry[4]
+            self.size -= entry[4]
+
+    def _load_segment(self, segment):
+        '''Add all entries in an existing segment to the index, scanning it
+        through a read-only mapping. Anything after the last complete entry
+        is truncated.'''
+        filename = self._filename(segment)
+        self._segments[segment] = 0
+        self._live[segment] = 0
+        self._segment_keys[segment] = []
+        segment_file = open(filename, 'rb')
+        try:
+            length = os.fstat(segment_file.fileno()).st_size
+            if length == 0:
+                return
+            data = mmap.mmap(segment_file.fileno(), 0,
+                access=mmap.ACCESS_READ)
+        finally:
+            segment_file.close()
+        offset = 0
+        try:
+            while offset + SEGMENT_HEADER.size <= length:
+                magic, key_length, value_length, expires = \
+                    SEGMENT_HEADER.unpack_from(data, offset)
+                end = offset + SEGMENT_HEADER.size + key_length + \
+                    value_length
+                if magic != SEGMENT_MAGIC or end > length:
+                    break
+                key = data[offset + SEGMENT_HEADER.size:
+                    offset + SEGMENT_HEADER.size + key_length]
+                self._add(key, (segment,
+                    offset + SEGMENT_HEADER.size + key_length, value_length,
+                    expires, end - offset))
+                offset = end
+        finally:
+            data.close()
+        if offset < length:
+            segment_file = open(filename, 'r+b')
+            segment_file.truncate(offset)
+            segment_file.close()
+        self._segments[segment] = offset
+
+    def _rotate(self):
+        '''Start a new segment, lock must be held.'''
+        if self._file is not None:
+            self._file.close()
+        if len(self._segments) == 0:
+            self._current = 0
+        else:
+            self._current = max(self._segments) + 1
+        self._file = open(self._filename(self._current), 'ab')
+        self._segments[self._current] = 0
+        self._live[self._current] = 0
+        self._segment_keys[self._current] = []
+
+    def _evict(self):
+        '''Remove the oldest segments while over the size limits, along
+        with any older segments that have nothing left in the index, lock
+        must be held.'''
+        while len(self._segments) > 1 and (self.size > self.max_size or
+                sum(self._segments.itervalues()) > self.max_size * 2):
+            segment = min(self._segments)
+            for key in self._segment_keys[segment]:
+                if self._index.get(key, (None,))[0] == segment:
+                    self._remove(key)
+            self._remove_segment(segment)
+            self.stats['evictions'] += 1
+        self._remove_dead()
+
+    def _remove_dead(self):
+        '''Remove segments other than the current one that have no entries
+        left in the index, lock must be held.'''
+        for segment in self._segments.keys():
+            if segment != self._current and self._live[segment] == 0:
+                self._remove_segment(segment)
+
+    def _remove_segment(self, segment):
+        '''Remove a segment file, lock must be held. Buffers already
+        returned for it stay valid since the mapping is only dropped, not
+        closed.'''
+        del self._segments[segment]
+        del self._live[segment]
+        del self._segment_keys[segment]
+        self._maps.pop(segment, None)
+        os.unlink(self._filename(segment))
+
+    def _map(self, segment):
+        '''Map a segment for reading, lock must be held.'''
+        segment_file = open(self._filename(segment), 'rb')
+        try:
+            data = mmap.mmap(segment_file.fileno(), 0,
+                access=mmap.ACCESS_READ)
+        finally:
+            segment_file.close()
+        self._maps[segment] = data
+        return data
+
+    def _filename(self, segment):
+        '''Get the filename for a segment.'''
+        return os.path.join(self.path, '%010d.segment' % segment)
@@ -14,7 +14,12 @@
 
 '''craigslist image exif module.
 
-Dictionaries for EXIF tag code to name translation.'''
+Dictionaries for EXIF tag code to name translation, and a parser that
+reads only allowed tags straight from the EXIF segment. Tags that are not
+allowed or too large are skipped by offset without reading their values,
+so the cost stays the same no matter how large the EXIF block is.'''
+
+import struct
 
 TAGS = {
     0x000b: "ProcessingSoftware",
@@ -311,3 +316,110 @@ GPSINFO_TAGS = {
     0x001c: "GPSAreaInformation",
     0x001d: "GPSDateStamp",
     0x001e: "GPSDifferential"}
+
+EXIF_IFD_TAG = 0x8769
+GPS_IFD_TAG = 0x8825
+
+# Tags that hold large binary blobs or offsets into the file, which are
+# never useful as image info.
+SKIP_TAGS = set(['ExifTag', 'GPSTag', 'ImageResources', 'InterColorProfile',
+    'InteroperabilityTag', 'IPTCNAA', 'JPEGInterchangeFormat',
+    'JPEGInterchangeFormatLength', 'MakerNote', 'MakerNoteSafety',
+    'PrintImageMatching', 'StripByteCounts', 'StripOffsets', 'XMLPacket'])
+
+DEFAULT_TAGS = (set(TAGS.values()) | set(GPSINFO_TAGS.values())) - SKIP_TAGS
+
+# Struct format and size in bytes of each TIFF field type.
+TYPES = {
+    1: ('B', 1),
+    2: ('s', 1),
+    3: ('H', 2),
+    4: ('L', 4),
+    5: ('L', 8),
+    6: ('b', 1),
+    7: ('s', 1),
+    8: ('h', 2),
+    9: ('l', 4),
+    10: ('l', 8),
+    11: ('f', 4),
+    12: ('d', 8)}
+
+
+def parse(data, tags=None, max_size=1024):
+    '''Parse EXIF data from an APP1 segment (starting with Exif\\0\\0) or
+    raw TIFF data. This returns a dictionary of tag names to values for
+    the main, EXIF, and GPS IFDs, using the same value types as PIL.
+    Only tags in the tags allowlist (DEFAULT_TAGS if not given) with
+    values no larger than max_size bytes are read.'''
+    if data.startswith('Exif\x00\x00'):
+        data = data[6:]
+    if data[:2] == 'II':
+        order = '<'
+    elif data[:2] == 'MM':
+        order = '>'
+    else:
+        return {}
+    if tags is None:
+        tags = DEFAULT_TAGS
+    elif not isinstance(tags, (set, frozenset)):
+        tags = set(tags)
+    exif = {}
+    try:
+        offset = struct.unpack(order + 'L', data[4:8])[0]
+        pointers = _parse_ifd(data, order, offset, TAGS, tags, max_size,
+            exif)
+        if EXIF_IFD_TAG in pointers:
+            _parse_ifd(data, order, pointers[EXIF_IFD_TAG], TAGS, tags,
+                max_size, exif)
+        if GPS_IFD_TAG in pointers:
+            _parse_ifd(data, order, pointers[GPS_IFD_TAG], GPSINFO_TAGS,
+                tags, max_size, exif)
+    except (struct.error, IndexError):
+        pass
+    return exif
+
+
+def _parse_ifd(data, order, offset, names, tags, max_size, exif):
+    '''Parse allowed tags from a single IFD into exif. This returns the
+    offsets of any EXIF or GPS IFDs found.'''
+    pointers = {}
+    count = struct.unpack(order + 'H', data[offset:offset + 2])[0]
+    for index in xrange(count):
+        entry = data[offset + 2 + index * 12:offset + 14 + index * 12]
+        tag, tag_type, value_count = struct.unpack(order + 'HHL', entry[:8])
+        if tag in [EXIF_IFD_TAG, GPS_IFD_TAG] and names is TAGS:
+            pointers[tag] = struct.unpack(order + 'L', entry[8:12])[0]
+            continue
+        name = names.get(tag, tag)
+        if name not in tags or tag_type not in TYPES:
+            continue
+        value_format, value_size = TYPES[tag_type]
+        size = value_size * value_count
+        if size > max_size:
+            continue
+        if size <= 4:
+            value = entry[8:8 + size]
+        else:
+            value_offset = struct.unpack(order + 'L', entry[8:12])[0]
+            value = data[value_offset:value_offset + size]
+        if len(value) < size:
+            continue
+        exif[name] = _decode(order, tag_type, value_format, value_count,
+            value)
+    return pointers
+
+
+def _decode(order, tag_type, value_format, value_count, value):
+    '''Decode a tag value the same way PIL does.'''
+    if tag_type == 2:
+        return value.rstrip('\x00')
+    if tag_type == 7:
+        return value
+    if tag_type in [5, 10]:
+        values = struct.unpack(order + value_format * value_count * 2, value)
+        values = tuple(zip(values[::2], values[1::2]))
+    else:
+        values = struct.unpack(order + value_format * value_count, value)
+    if len(values) == 1:
+        return values[0]
+    return values
@@ -0,0 +1,181 @@
+# Copyright 2013 craigslist
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''craigslist image probe module.
+
+This reads the format, dimensions, mode, and orientation of an image from
+the magic bytes and headers alone, without decoding any pixel data. It
+works on partial data so it can be used while an image is still being
+received. Format and mode names match the ones used by PIL.'''
+
+import struct
+
+JPEG_SOF_MARKERS = [0xc0, 0xc1, 0xc2, 0xc3, 0xc5, 0xc6, 0xc7, 0xc9, 0xca,
+    0xcb, 0xcd, 0xce, 0xcf]
+
+JPEG_MODES = {1: 'L', 3: 'RGB', 4: 'CMYK'}
+
+PNG_MODES = {0: 'L', 2: 'RGB', 3: 'P', 4: 'LA', 6: 'RGBA'}
+
+BMP_MODES = {1: '1', 4: 'P', 8: 'P', 16: 'RGB', 24: 'RGB', 32: 'RGB'}
+
+TIFF_WIDTH = 0x0100
+TIFF_HEIGHT = 0x0101
+TIFF_ORIENTATION = 0x0112
+
+
+def probe(data):
+    '''Probe the given image data. This returns None if the data does not
+    start with any known magic bytes, otherwise a dictionary with format,
+    width, height, mode, and orientation keys. Any values that could not
+    be found (such as when the data is truncated) are None.'''
+    for magic, parser in MAGIC:
+        if data.startswith(magic):
+            info = dict(format=None, width=None, height=None, mode=None,
+                orientation=None)
+            try:
+                parser(data, info)
+            except (struct.error, IndexError):
+                pass
+            return info
+    return None
+
+
+def is_complete(info):
+    '''Check if probed info has the format and dimensions.'''
+    return info is not None and info['format'] is not None and \
+        info['width'] is not None and info['height'] is not None
+
+
+def _jpeg(data, info):
+    '''Parse JPEG markers up to the start of scan.'''
+    info['format'] = 'JPEG'
+    offset = 2
+    while offset + 4 <= len(data):
+        if data[offset] != '\xff':
+            return
+        marker = ord(data[offset + 1])
+        if marker == 0xff:
+            offset += 1
+            continue
+        if marker == 0xd8 or 0xd0 <= marker <= 0xd7:
+            offset += 2
+            continue
+        if marker == 0xda or marker == 0xd9:
+            return
+        length = struct.unpack('>H', data[offset + 2:offset + 4])[0]
+        segment = data[offset + 4:offset + 2 + length]
+        if marker == 0xe1 and segment.startswith('Exif\x00\x00'):
+            info['orientation'] = _tiff_orientation(segment[6:])
+        elif marker in JPEG_SOF_MARKERS:
+            height, width, components = struct.unpack('>HHB', segment[1:6])
+            info['width'] = width
+            info['height'] = height
+            info['mode'] = JPEG_MODES.get(components)
+            if info['orientation'] is None:
+                info['orientation'] = 1
+            return
+        offset += 2 + length
+
+
+def _png(data, info):
+    '''Parse the PNG IHDR chunk.'''
+    info['format'] = 'PNG'
+    if data[12:16] != 'IHDR':
+        return
+    width, height, _depth, color = struct.unpack('>IIBB', data[16:26])
+    info['width'] = width
+    info['height'] = height
+    info['mode'] = PNG_MODES.get(color)
+    info['orientation'] = 1
+
+
+def _gif(data, info):
+    '''Parse the GIF logical screen descriptor.'''
+    info['format'] = 'GIF'
+    width, height = struct.unpack('<HH', data[6:10])
+    info['width'] = width
+    info['height'] = height
+    info['mode'] = 'P'
+    info['orientation'] = 1
+
+
+def _bmp(data, info):
+    '''Parse the BMP DIB header.'''
+    info['format'] = 'BMP'
+    header_size = struct.unpack('<I', data[14:18])[0]
+    if header_size == 12:
+        width, height, _planes, bits = struct.unpack('<HHHH', data[18:26])
+    else:
+        width, height, _planes, bits = struct.unpack('<iiHH', data[18:30])
+    info['width'] = abs(width)
+    info['height'] = abs(height)
+    info['mode'] = BMP_MODES.get(bits)
+    info['orientation'] = 1
+
+
+def _tiff(data, info):
+    '''Parse the first TIFF IFD.'''
+    info['format'] = 'TIFF'
+    tags = _tiff_tags(data, [TIFF_WIDTH, TIFF_HEIGHT, TIFF_ORIENTATION])
+    info['width'] = tags.get(TIFF_WIDTH)
+    info['height'] = tags.get(TIFF_HEIGHT)
+    info['orientation'] = tags.get(TIFF_ORIENTATION, 1)
+
+
+def _ppm(data, info):
+    '''Only the format is needed for PPM since it is never allowed.'''
+    info['format'] = 'PPM'
+
+
+def _tiff_orientation(data):
+    '''Get the orientation tag from TIFF data in an EXIF segment.'''
+    try:
+        return _tiff_tags(data, [TIFF_ORIENTATION]).get(TIFF_ORIENTATION, 1)
+    except (struct.error, IndexError):
+        return None
+
+
+def _tiff_tags(data, wanted):
+    '''Read the given integer tags from the first IFD of TIFF data.'''
+    order = '<' if data[:2] == 'II' else '>'
+    offset = struct.unpack(order + 'I', data[4:8])[0]
+    count = struct.unpack(order + 'H', data[offset:offset + 2])[0]
+    tags = {}
+    for index in xrange(count):
+        entry = data[offset + 2 + index * 12:offset + 14 + index * 12]
+        tag, tag_type = struct.unpack(order + 'HH', entry[:4])
+        if tag not in wanted:
+            continue
+        if tag_type == 3:
+            tags[tag] = struct.unpack(order + 'H', entry[8:10])[0]
+        elif tag_type == 4:
+            tags[tag] = struct.unpack(order + 'I', entry[8:12])[0]
+    return tags
+
+
+MAGIC = [
+    ('\xff\xd8', _jpeg),
+    ('\x89PNG\r\n\x1a\n', _png),
+    ('GIF87a', _gif),
+    ('GIF89a', _gif),
+    ('BM', _bmp),
+    ('II*\x00', _tiff),
+    ('MM\x00*', _tiff),
+    ('P1', _ppm),
+    ('P2', _ppm),
+    ('P3', _ppm),
+    ('P4', _ppm),
+    ('P5', _ppm),
+    ('P6', _ppm)]
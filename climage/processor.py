@@ -19,12 +19,17 @@ called through the server module.'''
 
 import hashlib
 import json
+import mmap
+import multiprocessing
+import os
 import pgmagick
 import PIL.Image
 import PIL.ImageFile
 import re
 import StringIO
 import sys
+import tempfile
+import threading
 import time
 
 import clblob.client
@@ -33,6 +38,8 @@ import clcommon.log
 import clcommon.profile
 import clcommon.worker
 import climage.exif
+import climage.probe
+import climage.upload
 
 # Increase max blocks in ImageFile lib to allow for saving larger images.
 PIL.ImageFile.MAXBLOCK = 1048576
@@ -40,14 +47,48 @@ PIL.ImageFile.MAXBLOCK = 1048576
 DEFAULT_CONFIG = clcommon.config.update(clblob.client.DEFAULT_CONFIG, {
     'climage': {
         'processor': {
+            'batch': False,
+            'batch_size': 4,
+            'budget_attempts': 5,
+            'budget_min_quality': 30,
+            'cascade': True,
+            'cascade_scale': 2.0,
+            'dedup': False,
+            'dedup_check_blob': True,
+            'dedup_index': None,
+            'dedup_refresh': 0.9,
+            'engine': 'thread',
+            'exif_tags': None,
             'formats': ['TIFF', 'BMP', 'JPEG', 'GIF', 'PNG'],
+            'header_size': 65536,
             'log_level': 'NOTSET',
+            'manifest': None,
             'max_height': 7000,
+            'max_size': 0,
             'max_width': 7000,
+            'memory_budget': 0,
+            'output_formats': [],
             'pool_size': 8,
+            'probe': True,
+            'process_pool_size': 0,
             'quality': 70,
+            'read_size': 65536,
+            'reduce': True,
+            'reduce_scale': 2.0,
+            'resize_filter': 'antialias',
             'save': True,
             'save_blob': True,
+            'save_info': True,
+            'save_original': False,
+            'save_pipeline': False,
+            'scheduler': False,
+            'scheduler_fast_weight': 4,
+            'scheduler_large_cost': 24000000,
+            'scheduler_large_slots': 2,
+            'scheduler_large_weight': 1,
+            'scheduler_slots': 0,
+            'scheduler_timeout': 30.0,
+            'shm_path': '/dev/shm',
             'sizes': ['50x50c', '300x300', '600x450'],
             'ttl': 7776000}}})  # 90 days
 
@@ -60,6 +101,34 @@ DEFAULT_CONFIG_DIRS = clblob.client.DEFAULT_CONFIG_DIRS + [
 
 SIZE_REGEX = re.compile('^([0-9]+)x([0-9]+)(.*)')
 
+# Size flags: c to crop, b<bytes>[k] for a byte budget, and f<filter> for
+# the resize filter, one of the letters in FILTER_FLAGS.
+FLAG_REGEX = re.compile('(c)|b([0-9]+)(k?)|f([nlba])')
+
+FILTERS = {
+    'nearest': PIL.Image.NEAREST,
+    'bilinear': PIL.Image.BILINEAR,
+    'bicubic': PIL.Image.BICUBIC,
+    'antialias': PIL.Image.ANTIALIAS}
+
+FILTER_FLAGS = {
+    'n': 'nearest',
+    'l': 'bilinear',
+    'b': 'bicubic',
+    'a': 'antialias'}
+
+# Blob name extensions and content types for each output format. JPEG is
+# always written, the others are extra formats set in output_formats.
+EXTENSIONS = {'JPEG': 'jpg', 'PNG': 'png', 'WEBP': 'webp'}
+CONTENT_TYPES = {'jpg': 'image/jpeg', 'png': 'image/png',
+    'webp': 'image/webp'}
+
+# Modes PIL can write as PNG, anything else is converted to RGB first.
+PNG_MODES = ['1', 'L', 'LA', 'I', 'I;16', 'P', 'RGB', 'RGBA']
+
+# Number of bytes needed to identify any supported format by magic bytes.
+PROBE_MAGIC_SIZE = 16
+
 ORIENTATION_OPERATIONS = {
     1: [],
     2: [PIL.Image.FLIP_LEFT_RIGHT],
@@ -71,30 +140,365 @@ ORIENTATION_OPERATIONS = {
     8: [PIL.Image.ROTATE_90]}
 
 
+# Bytes per pixel PIL uses to store each mode, anything else uses 4.
+MODE_BYTES = {'1': 1, 'L': 1, 'P': 1}
+
+_CHECKSUM_INDEXES = {}
+_CHECKSUM_INDEXES_LOCK = threading.Lock()
+
+_MEMORY_BUDGETS = {}
+_MEMORY_BUDGETS_LOCK = threading.Lock()
+
+
+class ChecksumIndex(object):
+    '''Persistent index of image checksums that have already been processed
+    and saved to the blob service. Checksums are kept in memory and appended
+    to a file, one per line, so the index survives restarts.'''
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._checksums = set()
+        if os.path.exists(path):
+            for line in open(path):
+                line = line.strip()
+                if line != '':
+                    self._checksums.add(line)
+        self._file = open(path, 'a')
+
+    def __contains__(self, checksum):
+        return checksum[:16] in self._checksums
+
+    def __len__(self):
+        return len(self._checksums)
+
+    def add(self, checksum):
+        '''Add a checksum to the index if it is not already there.'''
+        checksum = checksum[:16]
+        with self._lock:
+            if checksum in self._checksums:
+                return
+            self._checksums.add(checksum)
+            self._file.write('%s\n' % checksum)
+            self._file.flush()
+
+    def close(self):
+        '''Close the index file.'''
+        with self._lock:
+            self._file.close()
+
+
+def get_checksum_index(path):
+    '''Get the shared checksum index for the given path, creating it if
+    needed. Returns None if no path is given.'''
+    if path is None:
+        return None
+    with _CHECKSUM_INDEXES_LOCK:
+        if path not in _CHECKSUM_INDEXES:
+            _CHECKSUM_INDEXES[path] = ChecksumIndex(path)
+        return _CHECKSUM_INDEXES[path]
+
+
+def close_checksum_indexes():
+    '''Close all shared checksum indexes. Later calls to get_checksum_index
+    open them again.'''
+    with _CHECKSUM_INDEXES_LOCK:
+        for index in _CHECKSUM_INDEXES.itervalues():
+            index.close()
+        _CHECKSUM_INDEXES.clear()
+
+
+class MemoryBudget(object):
+    '''Process-wide budget for decoded pixel buffers, in bytes. A waiting
+    reservation blocks until it fits under the limit, unless nothing else
+    is reserved so images larger than the limit can still be processed.
+    Reservations that don't wait are always granted but still count
+    toward the current and peak totals.'''
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.current = 0
+        self.peak = 0
+        self.waits = 0
+        self._condition = threading.Condition()
+
+    def reserve(self, size, wait=True):
+        '''Reserve size bytes, waiting for them to fit if requested.'''
+        with self._condition:
+            if wait and self.current > 0 and \
+                    self.current + size > self.limit:
+                self.waits += 1
+                while self.current > 0 and self.current + size > self.limit:
+                    self._condition.wait()
+            self.current += size
+            self.peak = max(self.peak, self.current)
+
+    def release(self, size):
+        '''Release size bytes and wake waiting reservations.'''
+        with self._condition:
+            self.current -= size
+            self._condition.notify_all()
+
+
+def get_memory_budget(limit):
+    '''Get the shared memory budget for the given limit, creating it if
+    needed. Returns None if the limit is 0.'''
+    if limit == 0:
+        return None
+    with _MEMORY_BUDGETS_LOCK:
+        if limit not in _MEMORY_BUDGETS:
+            _MEMORY_BUDGETS[limit] = MemoryBudget(limit)
+        return _MEMORY_BUDGETS[limit]
+
+
+class ProcessEngine(object):
+    '''Execution engine that runs the CPU bound load and process stages in
+    a pool of worker processes so they are not limited by the GIL. The raw
+    image and the processed images are passed through files in shm_path
+    so only small descriptors need to be pickled between processes. This
+    should be created before any threads are started, since the worker
+    processes are forked and would inherit any locks those threads hold.'''
+
+    def __init__(self, config):
+        self.config = config['climage']['processor']
+        size = self.config['process_pool_size'] or multiprocessing.cpu_count()
+        self._pool = multiprocessing.Pool(size)
+
+    def run(self, config, raw, checksum=None):
+        '''Load and process the raw image in a worker process using the
+        given processor config. The checksum is passed along so the worker
+        doesn't compute it again. This returns the info, processed images,
+        variants, and profile marks from the worker. The memory budget is
+        turned off in the worker, since the calling processor has already
+        reserved memory for the image in this process.'''
+        start = time.time()
+        config = clcommon.config.update(config, {
+            'engine': 'thread',
+            'dedup': False,
+            'memory_budget': 0,
+            'pool_size': 0,
+            'save': False,
+            'save_blob': False})
+        input_name = _shm_write(self.config['shm_path'], [raw])
+        try:
+            result = self._pool.apply_async(_run_process_engine,
+                ({'climage': {'processor': config}}, input_name,
+                checksum)).get()
+        finally:
+            os.unlink(input_name)
+        info, output_name, offsets, marks = result
+        try:
+            output = _shm_read(output_name, [(offset, length)
+                for _name, _extension, offset, length in offsets])
+        finally:
+            os.unlink(output_name)
+        processed = {}
+        variants = {}
+        for (name, extension, _offset, _length), data in zip(offsets, output):
+            if extension is None:
+                processed[name] = data
+            else:
+                variants.setdefault(name, {})[extension] = data
+        marks['engine'] = time.time() - start
+        return info, processed, variants, marks
+
+    def stop(self):
+        '''Stop all worker processes.'''
+        self._pool.close()
+        self._pool.join()
+
+
+def _run_process_engine(config, input_name, checksum):
+    '''Run a processor in a worker process for the process engine. This
+    returns the info, name of the shared memory file holding the processed
+    images, offsets of each image in that file, and the profile marks.'''
+    processor = Processor(config, _shm_read(input_name), checksum=checksum)
+    processed = processor.process()
+    images = [(name, None, processed[name]) for name in processed]
+    for name in processor.variants:
+        for extension in processor.variants[name]:
+            images.append((name, extension,
+                processor.variants[name][extension]))
+    offsets = []
+    offset = 0
+    chunks = []
+    for name, extension, data in images:
+        offsets.append((name, extension, offset, len(data)))
+        offset += len(data)
+        chunks.append(data)
+    output_name = _shm_write(config['climage']['processor']['shm_path'],
+        chunks)
+    return processor.info, output_name, offsets, dict(processor.profile.marks)
+
+
+class Scheduler(object):
+    '''Scheduler for processing jobs shared across processor objects. Jobs
+    are classified by estimated cost into a fast lane and a large lane so
+    a few large images can't take every slot in the worker pool while
+    small ones wait behind them. At most scheduler_slots jobs run at once
+    (pool_size if 0), and at most scheduler_large_slots of those can be
+    large. When a slot frees up and both lanes have jobs waiting, the next
+    lane is picked by smooth weighted round robin using the lane weights
+    so neither lane starves. Only whole jobs are scheduled, the sizes of a
+    job that is running still share the worker pool with other jobs.'''
+
+    LANES = ['fast', 'large']
+
+    def __init__(self, config):
+        self.config = config['climage']['processor']
+        self.slots = self.config['scheduler_slots'] or \
+            self.config['pool_size']
+        self.caps = dict(fast=self.slots,
+            large=self.config['scheduler_large_slots'])
+        self.weights = dict(fast=self.config['scheduler_fast_weight'],
+            large=self.config['scheduler_large_weight'])
+        self.running = dict(fast=0, large=0)
+        self.timeouts = 0
+        self._credits = dict(fast=0, large=0)
+        self._waiting = dict(fast=[], large=[])
+        self._lock = threading.Lock()
+
+    def waiting(self, lane):
+        '''Get the number of jobs waiting in a lane.'''
+        return len(self._waiting[lane])
+
+    def enter(self, cost):
+        '''Wait for a slot for a job with the given cost, returning the
+        name of the lane it ran in. The slot must be given back with
+        leave. Raises Busy if no slot is free within scheduler_timeout
+        seconds.'''
+        lane = 'fast'
+        if cost >= self.config['scheduler_large_cost']:
+            lane = 'large'
+        event = threading.Event()
+        with self._lock:
+            self._waiting[lane].append(event)
+            self._dispatch()
+        if not event.wait(self.config['scheduler_timeout']):
+            with self._lock:
+                if not event.is_set():
+                    self._waiting[lane].remove(event)
+                    self.timeouts += 1
+                    raise Busy(_('Timed out waiting for a %s slot') % lane)
+        return lane
+
+    def leave(self, lane):
+        '''Give back a slot in a lane and start waiting jobs.'''
+        with self._lock:
+            self.running[lane] -= 1
+            self._dispatch()
+
+    def _dispatch(self):
+        '''Start waiting jobs while there are free slots, lock must be
+        held.'''
+        while sum(self.running.values()) < self.slots:
+            lanes = [lane for lane in self.LANES
+                if len(self._waiting[lane]) > 0 and
+                self.running[lane] < self.caps[lane]]
+            if len(lanes) == 0:
+                return
+            for lane in lanes:
+                self._credits[lane] += self.weights[lane]
+            lane = max(lanes, key=lambda lane: self._credits[lane])
+            self._credits[lane] -= sum(self.weights[other]
+                for other in lanes)
+            self.running[lane] += 1
+            self._waiting[lane].pop(0).set()
+
+
+def blob_name(blob_client, checksum):
+    '''Get the base blob name for an image from its checksum.'''
+    checksum = int(checksum[:16], 16)
+    checksum = clcommon.anybase.encode(checksum, 62)
+    return blob_client.name(checksum)
+
+
+def _shm_write(path, chunks):
+    '''Write data chunks to a new file in the shared memory path, returning
+    the file name.'''
+    if not os.path.isdir(path):
+        path = None
+    descriptor, name = tempfile.mkstemp(prefix='climage', dir=path)
+    output = os.fdopen(descriptor, 'wb')
+    for chunk in chunks:
+        output.write(chunk)
+    output.close()
+    return name
+
+
+def _shm_read(name, ranges=None):
+    '''Read all data from a file in the shared memory path. If a list of
+    (offset, length) ranges is given, this instead returns a list with the
+    data for each range, copied straight out of the mapping.'''
+    descriptor = os.open(name, os.O_RDONLY)
+    try:
+        if os.fstat(descriptor).st_size == 0:
+            if ranges is None:
+                return ''
+            return ['' for _range in ranges]
+        data = mmap.mmap(descriptor, 0, access=mmap.ACCESS_READ)
+        try:
+            if ranges is None:
+                return data[:]
+            return [data[offset:offset + length]
+                for offset, length in ranges]
+        finally:
+            data.close()
+    finally:
+        os.close(descriptor)
+
+
 class Processor(object):
     '''Image processing class. This handles a processing job for a single
-    image. An optional worker pool and blob client can be passed in for
-    use between different processor objects.'''
+    image. An optional worker pool, blob client, process engine, scheduler,
+    and uploader can be passed in for use between different processor
+    objects. The checksum of the image can also be given if it is already
+    known.'''
 
-    def __init__(self, config, image, pool=None, blob_client=None):
+    def __init__(self, config, image, pool=None, blob_client=None,
+            engine=None, scheduler=None, uploader=None, checksum=None):
         self.config = config['climage']['processor']
+        self._engine = engine
+        self._stop_engine = False
+        if self.config['engine'] == 'process' and engine is None:
+            self._engine = ProcessEngine(config)
+            self._stop_engine = True
+        elif self.config['engine'] not in ['thread', 'process']:
+            raise ProcessingError(_('Invalid engine: %s') %
+                self.config['engine'])
         self._pool = pool or clcommon.worker.Pool(self.config['pool_size'])
         self._stop_pool = pool is None
         if self.config['save_blob'] and blob_client is None:
             blob_client = clblob.client.Client(config)
         self._blob_client = blob_client
+        self._scheduler = scheduler
+        self._uploader = uploader
+        self._stop_uploader = False
+        self._pipeline = None
+        self._pipeline_lock = threading.Lock()
+        self._pipeline_start = None
+        self._memory_budget = get_memory_budget(self.config['memory_budget'])
+        self._reserved = 0
+        self._reserved_lock = threading.Lock()
         self.log = clcommon.log.get_log('climage_processor',
             self.config['log_level'])
         self.profile = clcommon.profile.Profile()
+        self._pgmagick_ran = False
+        self._decoded = None
+        self._callback = None
+        self._checksum = checksum
+        self._probed = None
         if not isinstance(image, str):
-            image = image.read()
+            image = self._read(image)
             self.profile.mark_time('read')
         self.raw = image
         self.profile.mark('original_size', len(self.raw))
-        self._pgmagick_ran = False
         self._processed = {}
+        self.variants = {}
         self.info = {}
         self._orientation = 1
+        self._plan = []
+        self._intermediates = {}
         self._sizes = []
         for size in self.config['sizes']:
             match = SIZE_REGEX.match(size)
@@ -104,51 +508,273 @@ class Processor(object):
             parsed_size['width'] = int(match.group(1))
             parsed_size['height'] = int(match.group(2))
             parsed_size['flags'] = match.group(3)
+            self._parse_flags(parsed_size)
             self._sizes.append(parsed_size)
+        for output_format in self.config['output_formats']:
+            if output_format not in EXTENSIONS or output_format == 'JPEG':
+                raise ProcessingError(_('Invalid output format: %s') %
+                    output_format)
+
+    def _parse_flags(self, size):
+        '''Parse the flags for a size into the size dictionary.'''
+        size['crop'] = False
+        size['budget'] = None
+        size['filter'] = self.config['resize_filter']
+        offset = 0
+        while offset < len(size['flags']):
+            match = FLAG_REGEX.match(size['flags'], offset)
+            if match is None:
+                raise ProcessingError(_('Invalid size parameter: %s') %
+                    size['name'])
+            if match.group(1) is not None:
+                size['crop'] = True
+            elif match.group(2) is not None:
+                size['budget'] = int(match.group(2))
+                if match.group(3) == 'k':
+                    size['budget'] *= 1024
+            elif match.group(4) is not None:
+                size['filter'] = FILTER_FLAGS[match.group(4)]
+            offset = match.end()
+        if size['filter'] not in FILTERS:
+            raise ProcessingError(_('Invalid resize filter: %s') %
+                size['filter'])
+
+    def estimate_cost(self):
+        '''Estimate the cost of processing this image as the number of
+        pixels times the number of sizes, using the probed header. If the
+        dimensions can't be probed, the largest allowed are assumed.'''
+        width, height = self._probed_size()
+        return width * height * len(self._sizes)
+
+    def _probed_size(self):
+        '''Get the image dimensions from the probed header, or the largest
+        allowed if they can't be probed.'''
+        probed = self._probed
+        if probed is None:
+            probed = climage.probe.probe(self.raw[:self.config['header_size']])
+        if climage.probe.is_complete(probed):
+            return probed['width'], probed['height']
+        return self.config['max_width'], self.config['max_height']
+
+    @property
+    def checksum(self):
+        '''SHA-256 checksum of the original image data.'''
+        return self._get_checksum()
 
     def __del__(self):
         if hasattr(self, '_pool') and self._stop_pool:
             self._pool.stop()
+        if hasattr(self, '_uploader') and self._stop_uploader:
+            self._uploader.stop()
+        if hasattr(self, '_engine') and self._stop_engine:
+            self._engine.stop()
         if hasattr(self, 'profile') and len(self.profile.marks) > 0:
             self.log.info('profile %s', self.profile)
 
-    def process(self):
+    def _read(self, stream):
+        '''Read the image from a file-like object in chunks. The checksum
+        is updated as data arrives, and the header is parsed as soon as
+        enough data is available so images that are too large or in the
+        wrong format are rejected before reading the rest.'''
+        checksum = hashlib.sha256()  # pylint: disable=E1101
+        chunks = []
+        length = 0
+        header = ''
+        while True:
+            chunk = stream.read(self.config['read_size'])
+            if not chunk:
+                break
+            length += len(chunk)
+            if 0 < self.config['max_size'] < length:
+                raise InvalidImage(
+                    _('Image too large: more than %d bytes') %
+                    self.config['max_size'])
+            checksum.update(chunk)
+            chunks.append(chunk)
+            if header is not None and self.config['probe']:
+                header += chunk
+                if self._check_probe(header, False):
+                    header = None
+                elif len(header) >= self.config['header_size']:
+                    header = None
+        self._checksum = checksum.hexdigest()
+        return ''.join(chunks)
+
+    def _check_probe(self, data, final=True):
+        '''Probe the image header and check the info found so bad images
+        are rejected before any decoding. Returns True if the format and
+        dimensions were found. If final is not set, more data may still
+        be coming, so only data that can't be an image is rejected.'''
+        probed = climage.probe.probe(data)
+        if probed is None:
+            if final or len(data) >= PROBE_MAGIC_SIZE:
+                raise InvalidImage(_('Unknown image format'))
+            return False
+        if probed['format'] not in self.config['formats']:
+            raise InvalidImage(
+                _('Invalid image format: %s') % probed['format'])
+        if not climage.probe.is_complete(probed):
+            return False
+        self._check_info(probed)
+        self._probed = probed
+        self.profile.mark_time('probe')
+        return True
+
+    def process(self, callback=None):
         '''Process the image as specified in the config. Image info
         (such as the blob names after being saved) can be found in the
         info attribute when this returns. This returns a dictionary of
-        resized images, indexed by the size name from the config.'''
+        resized JPEG images, indexed by the size name from the config.
+        Images in any extra output formats are in the variants attribute,
+        indexed by size name and then extension. If a callback is given,
+        it is called with the size name, JPEG image, and variants for each
+        size as soon as it is ready, possibly from a worker thread. If
+        there is a scheduler, this first waits for a slot in the lane for
+        the estimated cost, and the time spent waiting is marked in the
+        profile for that lane.'''
+        self._callback = callback
         self.profile.reset_time()
-        start = time.time()
-        image = self._pool.start(self._load).wait()
-        batch = self._pool.batch()
-        for size in self._sizes:
-            batch.start(self._process, size, image)
-            image = None
-        batch.wait_all()
+        lane = None
+        if self._scheduler is not None:
+            lane = self._scheduler.enter(self.estimate_cost())
+            self.profile.mark_time('wait_%s' % lane)
+        try:
+            return self._process_all()
+        finally:
+            self._release_memory()
+            if lane is not None:
+                self._scheduler.leave(lane)
+
+    def _process_all(self):
+        '''Process the image and save it if needed. With save_pipeline,
+        each size is uploaded as soon as it is encoded instead of after
+        all sizes are done.'''
         self.profile.reset_time()
-        if self.config['save']:
-            if self.config['save_blob']:
+        start = time.time()
+        if self._dedup():
+            self._sizes_done()
+            self.profile.mark('real_time', time.time() - start)
+            return self._processed
+        self._wait_memory()
+        save = self.config['save'] and self.config['save_blob']
+        try:
+            if self._engine is not None:
+                info, self._processed, self.variants, marks = \
+                    self._engine.run(self.config, self.raw,
+                        self._get_checksum())
+                self.info.update(info)
+                for name, value in marks.iteritems():
+                    self.profile.mark(name, value)
+                self.profile.reset_time()
+                self._sizes_done()
+            else:
+                image = self._pool.start(self._load).wait()
+                # Only start uploading once the image has been validated.
+                if save and self.config['save_pipeline']:
+                    self._start_pipeline()
+                if self.config['cascade']:
+                    self._process_plan(image)
+                else:
+                    batch = self._pool.batch()
+                    for size in self._sizes:
+                        batch.start(self._process, size, image)
+                        image = None
+                    batch.wait_all()
+            self.profile.reset_time()
+            if self._pipeline is not None:
+                self._finish_pipeline()
+            elif save:
                 self._save_blob()
+        except Exception:
+            if self._pipeline is not None:
+                self._pipeline.abort()
+            raise
         self.profile.mark('real_time', time.time() - start)
         return self._processed
 
+    def _dedup(self):
+        '''If dedup is enabled and this image has already been processed
+        and saved, load the saved info and images from the blob service
+        instead of processing it again. The local checksum index is checked
+        first, and the blob service is only asked on an index miss if
+        dedup_check_blob is set. The saved copy is only used if it was
+        encoded with the same quality. If less than dedup_refresh of the
+        ttl for this request is left before its blobs expire, they are
+        saved again with the new ttl.
+        Returns True if the saved copy was used.'''
+        if not self.config['dedup'] or not self.config['save'] or \
+                not self.config['save_blob']:
+            return False
+        checksum = self._get_checksum()
+        index = get_checksum_index(self.config['dedup_index'])
+        if index is not None and checksum not in index and \
+                not self.config['dedup_check_blob']:
+            self.profile.mark('dedup_miss', 1)
+            return False
+        name = self._blob_name()
+        try:
+            info = json.loads(self._blob_client.get('%s.json' % name).read())
+            if info.get('quality') != self.config['quality']:
+                self.profile.mark_time('dedup')
+                self.profile.mark('dedup_miss', 1)
+                return False
+            processed = {}
+            variants = {}
+            for size in self._sizes:
+                processed[size['name']] = self._blob_client.get(
+                    '%s_%s.jpg' % (name, size['name'])).read()
+                for extension in info.get('variants', {}).get(size['name'],
+                        []):
+                    variants.setdefault(size['name'], {})[extension] = \
+                        self._blob_client.get('%s_%s.%s' % (name,
+                        size['name'], extension)).read()
+        except Exception, exception:
+            self.log.debug(_('Dedup lookup failed for %s: %s'), name,
+                exception)
+            self.profile.mark_time('dedup')
+            self.profile.mark('dedup_miss', 1)
+            return False
+        if 'filename' in self.config:
+            info['filename'] = self.config['filename']
+        self.info = info
+        self._processed = processed
+        self.variants = variants
+        self._set_blob_names(name)
+        if index is not None:
+            index.add(checksum)
+        self.profile.mark_time('dedup')
+        self.profile.mark('dedup_hit', 1)
+        ttl = self.config['ttl']
+        if ttl is not None and info.get('blob_expires', 0) < \
+                time.time() + ttl * self.config['dedup_refresh']:
+            self._save_blob()
+            self.profile.mark('dedup_refresh', 1)
+        return True
+
     def _load(self):
         '''Load image and parse info.'''
+        self._get_checksum()
+        if self.config['probe'] and self._probed is None:
+            self._check_probe(self.raw)
         try:
             image = PIL.Image.open(StringIO.StringIO(self.raw))
         except Exception:
             self.profile.mark_time('open')
+            if len(self._sizes) == 0 and self._probed is not None:
+                # Nothing to decode, so answer with the probed info. This
+                # means an info-only request for an image with a valid
+                # header succeeds even if the pixel data can't be decoded.
+                self._get_probe_info()
+                return None
             try:
-                self._pgmagick()
-                image = PIL.Image.open(StringIO.StringIO(self.raw))
+                image = self._pgmagick()
             except Exception, exception:
-                raise BadImage(_('Cannot open image: %s') % exception)
+                raise _decode_error(_('Cannot open image: %s'), exception)
         self.profile.mark_time('open')
 
         self._get_info(image)
         self._check_info(self.info)
 
-        self._orientation = int(self.info.get('exif_orientation', 1))
         if self._orientation not in ORIENTATION_OPERATIONS:
             self._orientation = 1
 
@@ -157,7 +783,7 @@ class Processor(object):
 
         # Fix width and height to keep aspect ration for non-cropped images.
         for size in self._sizes:
-            if 'c' in size['flags']:
+            if size['crop']:
                 continue
             width, height = image.size
             if self._orientation > 4:
@@ -171,35 +797,115 @@ class Processor(object):
                 height = size['height']
             size['width'], size['height'] = width, height
 
+        draft_size = self._sizes[0]
+        if self.config['cascade']:
+            self._make_plan(image.size)
+            draft_size = dict(
+                width=max(size['width'] for size in self._sizes),
+                height=max(size['height'] for size in self._sizes))
         try:
-            self._load_image(image, self._sizes[0])
+            self._load_image(image, draft_size, False)
         except Exception:
             self.profile.mark_time('load')
             try:
-                self._pgmagick()
-                image = PIL.Image.open(StringIO.StringIO(self.raw))
-                self.profile.mark_time('open')
-                self._load_image(image, self._sizes[0])
+                image = self._pgmagick()
+                self._load_image(image, draft_size, False)
             except Exception, exception:
-                raise BadImage(_('Cannot load image: %s') % exception)
+                raise _decode_error(_('Cannot load image: %s'), exception)
         self.profile.mark_time('load')
 
         return image
 
-    def _load_image(self, image, size):
-        '''Load the image using the smallest sample we can.'''
+    def _make_plan(self, image_size):
+        '''Plan the order sizes are rendered in. Sizes are sorted largest
+        first, and each is built from the smallest larger uncropped size
+        that is still at least cascade_scale times bigger in both
+        dimensions, or from the decoded image if there is none. The plan
+        is a list of levels, where each level only depends on sizes from
+        previous levels.'''
+        scale = self.config['cascade_scale']
+        sizes = sorted(self._sizes,
+            key=lambda size: size['width'] * size['height'], reverse=True)
+        depths = {}
+        self._plan = []
+        for size in sizes:
+            size['source'] = None
+            size['intermediate'] = False
+            source_width, source_height = image_size
+            depth = 0
+            for source in sizes:
+                if source is size:
+                    break
+                if source['crop']:
+                    continue
+                ratio = min(float(source['width']) / size['width'],
+                    float(source['height']) / size['height'])
+                if ratio >= scale and (source_width * source_height >
+                        source['width'] * source['height']):
+                    size['source'] = source['name']
+                    source_width = source['width']
+                    source_height = source['height']
+                    depth = depths[source['name']] + 1
+            if size['source'] is not None:
+                for source in sizes:
+                    if source['name'] == size['source']:
+                        source['intermediate'] = True
+            depths[size['name']] = depth
+            while len(self._plan) <= depth:
+                self._plan.append([])
+            self._plan[depth].append(size)
+        self.profile.mark_time('plan')
+
+    def _load_image(self, image, size, reserve=True):
+        '''Load the image using the smallest sample we can. Memory for the
+        decoded pixels is reserved after the draft is set, so the estimate
+        is for the downscaled decode. The first decode of the source image
+        was already reserved by _wait_memory, so it isn't counted again.'''
         width, height = size['width'], size['height']
         if self._orientation > 4:
             # Width and height will be reversed for these orientations.
             width, height = height, width
         image.draft(None, (width, height))
+        if reserve:
+            self._reserve_memory(image.size, image.mode)
         image.load()
 
+    def _wait_memory(self):
+        '''Wait for room in the memory budget to decode the source image,
+        estimated at full size from the probed header. This is the only
+        reservation that waits, and it runs on the thread calling process
+        before any pool work starts. Pool threads never wait on the budget,
+        since they may be needed to finish the work of processors already
+        holding memory.'''
+        if self._memory_budget is None or len(self._sizes) == 0:
+            return
+        start = time.time()
+        self._reserve_memory(self._probed_size(), None, True)
+        self.profile.mark('memory_wait', time.time() - start)
+
+    def _reserve_memory(self, size, mode, wait=False):
+        '''Reserve memory for a pixel buffer of the given size and mode in
+        the memory budget.'''
+        if self._memory_budget is None:
+            return
+        reserved = size[0] * size[1] * MODE_BYTES.get(mode, 4)
+        self._memory_budget.reserve(reserved, wait)
+        with self._reserved_lock:
+            self._reserved += reserved
+
+    def _release_memory(self):
+        '''Release all memory reserved by this processor.'''
+        with self._reserved_lock:
+            reserved = self._reserved
+            self._reserved = 0
+        if reserved > 0:
+            self._memory_budget.release(reserved)
+
     def _get_info(self, image):
         '''Parse out all info and exif data embedded in image.'''
         for key, value in image.info.iteritems():
-            if key == 'exif' and hasattr(image, '_getexif'):
-                self._get_exif(image)
+            if key == 'exif':
+                self._get_exif(value)
             else:
                 self._set_info(key, value)
         if 'filename' in self.config:
@@ -209,24 +915,47 @@ class Processor(object):
         self.info['format'] = image.format
         self.info['mode'] = image.mode
         self.profile.mark_time('info')
-        value = hashlib.sha256(self.raw).hexdigest()  # pylint: disable=E1101
-        self.info['checksum'] = value
-        self.profile.mark_time('checksum')
+        self.info['checksum'] = self._get_checksum()
 
-    def _get_exif(self, image):
-        '''Add exif data to the info dictionary.'''
-        try:
-            exif = image._getexif()  # pylint: disable=W0212
-        except Exception:
-            return
-        for key, value in exif.items():
-            key = climage.exif.TAGS.get(key, key)
-            if key == 'GPSTag':
-                for gps_key, gps_value in value.items():
-                    gps_key = climage.exif.GPSINFO_TAGS.get(gps_key, gps_key)
-                    self._set_info('exif_%s' % gps_key, gps_value)
-            else:
+    def _get_checksum(self):
+        '''Get the checksum of the original image data, computing it the
+        first time this is called.'''
+        if self._checksum is None:
+            # pylint: disable=E1101
+            self._checksum = hashlib.sha256(self.raw).hexdigest()
+            self.profile.mark_time('checksum')
+        return self._checksum
+
+    def _blob_name(self):
+        '''Get the base blob name for this image from the checksum.'''
+        return blob_name(self._blob_client, self._get_checksum())
+
+    def _get_probe_info(self):
+        '''Set info from the probed header when PIL can't open it. This is
+        only used when no sizes are requested, so the image is never
+        decoded and exif data is left out of the info.'''
+        if 'filename' in self.config:
+            self.info['filename'] = self.config['filename']
+        for key in ['width', 'height', 'format', 'mode']:
+            self.info[key] = self._probed[key]
+        self.info['checksum'] = self._get_checksum()
+
+    def _get_exif(self, data):
+        '''Add exif data for the allowed tags to the info dictionary. The
+        orientation is always parsed so the image is still rotated when
+        it is not an allowed tag, it is just left out of the info.'''
+        tags = self.config['exif_tags']
+        if tags is not None:
+            tags = set(tags) | set(['Orientation'])
+        exif = climage.exif.parse(data, tags)
+        orientation = exif.get('Orientation')
+        if isinstance(orientation, (int, long)):
+            self._orientation = orientation
+        for key, value in exif.iteritems():
+            if self.config['exif_tags'] is None or \
+                    key in self.config['exif_tags']:
                 self._set_info('exif_%s' % key, value)
+        self.profile.mark_time('exif')
 
     def _set_info(self, key, value):
         '''Set an info key value pair if it is UTF-8 safe.'''
@@ -245,59 +974,194 @@ class Processor(object):
     def _check_info(self, info):
         '''Make sure image is allowed with given info.'''
         if info['format'] == '':
-            raise BadImage(_('Unknown image format'))
+            raise InvalidImage(_('Unknown image format'))
         if info['format'] not in self.config['formats']:
-            raise BadImage(_('Invalid image format: %s') % info['format'])
+            raise InvalidImage(_('Invalid image format: %s') % info['format'])
         if info['width'] > self.config['max_width'] or \
                 info['height'] > self.config['max_height']:
-            raise BadImage(_('Image too large: %dx%d') %
+            raise InvalidImage(_('Image too large: %dx%d') %
                 (info['width'], info['height']))
 
+    def _process_plan(self, image):
+        '''Process all sizes level by level according to the plan. Sizes
+        within a level run in parallel since their sources have all been
+        rendered by previous levels.'''
+        for level, sizes in enumerate(self._plan):
+            batch = self._pool.batch()
+            for size in sizes:
+                source = image
+                if size['source'] is not None:
+                    source = self._intermediates[size['source']]
+                batch.start(self._process, size, source)
+            batch.wait_all()
+            self.profile.mark_time('level%d' % level)
+        self._intermediates = {}
+
     def _process(self, size, image=None):
         '''Process a given image size.'''
         profile = clcommon.profile.Profile()
 
         # Used image.copy originally, but that was actually much slower than
         # reopening unless the image has already been modified in some way.
-        if image is None:
+        # Images decoded by pgmagick can't be reopened, so they are shared.
+        if image is None and self._decoded is not None:
+            image = self._decoded
+        elif image is None:
             image = PIL.Image.open(StringIO.StringIO(self.raw))
             profile.mark_time('open')
             try:
                 self._load_image(image, size)
             except Exception, exception:
                 profile.mark_time('load')
-                raise BadImage(_('Cannot load image (proc): %s') % exception)
+                raise _decode_error(_('Cannot load image (proc): %s'),
+                    exception)
             profile.mark_time('load')
 
         width, height = size['width'], size['height']
-        if 'c' in size['flags']:
+        if size['crop']:
             image = self._crop(image, width, height)
             profile.mark_time('%s:crop' % size['name'])
 
         if self._orientation > 4:
             # Width and height will be reversed for these orientations.
             width, height = height, width
-        image = image.resize((width, height), PIL.Image.ANTIALIAS)
+        image = self._reduce(image, width, height)
+        profile.mark_time('%s:reduce' % size['name'])
+        self._reserve_memory((width, height), image.mode)
+        image = image.resize((width, height), FILTERS[size['filter']])
         profile.mark_time('%s:resize' % size['name'])
+        if size.get('source') is not None:
+            profile.mark('%s:cascade' % size['name'], 1)
+        if size.get('intermediate'):
+            self._intermediates[size['name']] = image
 
         if self._orientation > 1:
             for operation in ORIENTATION_OPERATIONS[self._orientation]:
+                self._reserve_memory(image.size, image.mode)
                 image = image.transpose(operation)
             profile.mark_time('%s:transpose' % size['name'])
 
+        original = image
         if image.mode in ['P', 'LA']:
+            self._reserve_memory(image.size, 'RGB')
             image = image.convert(mode='RGB')
             profile.mark_time('%s:convert' % size['name'])
 
-        output = StringIO.StringIO()
-        image.save(output, 'JPEG', quality=self.config['quality'],
-            optimize=True)
-        raw = output.getvalue()
+        if size['budget'] is None:
+            raw = self._encode(image, self.config['quality'])
+        else:
+            raw = self._encode_budget(image, size, profile)
         self._processed[size['name']] = raw
         profile.mark_time('%s:save' % size['name'])
         profile.mark('%s:size' % size['name'], len(raw))
+        if len(self.config['output_formats']) > 0:
+            self._encode_variants(original, size, len(raw), profile)
+        if self._pipeline is not None:
+            self._save_size(size['name'])
+        if self._callback is not None:
+            self._callback(size['name'], raw,
+                self.variants.get(size['name'], {}))
         self.profile.update(profile)
 
+    def _sizes_done(self):
+        '''Call the callback for all sizes that were not processed here.'''
+        if self._callback is None:
+            return
+        for size in self._processed:
+            self._callback(size, self._processed[size],
+                self.variants.get(size, {}))
+
+    def _reduce(self, image, width, height):
+        '''Shrink the image by the largest integer factor that still leaves
+        it at least reduce_scale times the target size, averaging each
+        block of pixels. This is much cheaper than running the resize
+        filter over the full image, and the filter still does the final
+        step. Box reduction needs a newer PIL, so this is skipped without
+        it, and for modes where PIL only resizes with nearest anyway.'''
+        if not self.config['reduce'] or image.mode in ['1', 'P']:
+            return image
+        factor = int(min(float(image.size[0]) / width,
+            float(image.size[1]) / height) / self.config['reduce_scale'])
+        if factor < 2:
+            return image
+        reduced = (image.size[0] / factor, image.size[1] / factor)
+        if hasattr(image, 'reduce'):
+            self._reserve_memory(reduced, image.mode)
+            return image.reduce(factor)
+        if hasattr(PIL.Image, 'BOX'):
+            self._reserve_memory(reduced, image.mode)
+            return image.resize(reduced, PIL.Image.BOX)
+        return image
+
+    def _encode(self, image, quality):
+        '''Encode the image as a JPEG with the given quality.'''
+        output = StringIO.StringIO()
+        image.save(output, 'JPEG', quality=quality, optimize=True)
+        return output.getvalue()
+
+    def _encode_variants(self, image, size, jpeg_size, profile):
+        '''Encode the image in all extra output formats. Palette and LA
+        images that were converted to RGB for the JPEG are encoded as
+        lossless WebP, keeping any transparency. Modes PNG can't store, such
+        as CMYK, are converted to RGB. PNG is only kept if it is smaller
+        than the JPEG.'''
+        variants = {}
+        for output_format in self.config['output_formats']:
+            extension = EXTENSIONS[output_format]
+            output = StringIO.StringIO()
+            if output_format == 'WEBP' and image.mode in ['P', 'LA']:
+                image.convert(mode='RGBA').save(output, 'WEBP', lossless=True)
+            elif output_format == 'WEBP':
+                image.save(output, 'WEBP', quality=self.config['quality'])
+            elif output_format == 'PNG' and image.mode not in PNG_MODES:
+                self._reserve_memory(image.size, 'RGB')
+                image.convert(mode='RGB').save(output, 'PNG', optimize=True)
+            else:
+                image.save(output, output_format, optimize=True)
+            raw = output.getvalue()
+            profile.mark_time('%s.%s:save' % (size['name'], extension))
+            if output_format == 'PNG' and len(raw) >= jpeg_size:
+                continue
+            variants[extension] = raw
+            profile.mark('%s.%s:size' % (size['name'], extension), len(raw))
+        self.variants[size['name']] = variants
+        self.info.setdefault('variants', {})[size['name']] = \
+            sorted(variants)
+
+    def _encode_budget(self, image, size, profile):
+        '''Encode the image with the highest quality that fits in the byte
+        budget for the size. This does a binary search between
+        budget_min_quality and quality, running no more than
+        budget_attempts encodes in total. The resized image and the best
+        encoding found so far are reused between attempts. If nothing fits,
+        the lowest quality is used, so one attempt is kept back for that
+        encode until something fits.'''
+        low = min(self.config['budget_min_quality'], self.config['quality'])
+        high = self.config['quality']
+        best = low
+        encoded = {}
+        while low <= high and len(encoded) + (best not in encoded) < \
+                self.config['budget_attempts']:
+            if len(encoded) == 0:
+                quality = high
+            else:
+                quality = (low + high + 1) / 2
+            encoded[quality] = self._encode(image, quality)
+            if len(encoded[quality]) <= size['budget']:
+                best = quality
+                low = quality + 1
+            else:
+                high = quality - 1
+        attempts = len(encoded)
+        if best not in encoded:
+            encoded[best] = self._encode(image, best)
+            attempts += 1
+        self.info.setdefault('budget_quality', {})[size['name']] = best
+        self.info.setdefault('budget_attempts', {})[size['name']] = attempts
+        profile.mark('%s:quality' % size['name'], best)
+        profile.mark('%s:attempts' % size['name'], attempts)
+        return encoded[best]
+
     def _crop(self, image, end_width, end_height):
         '''Crop the image if needed.'''
         width, height = image.size
@@ -322,43 +1186,148 @@ class Processor(object):
         (truncation, bad headers, etc). This seems to be rare, but this
         way we can process more things successfully. We want to still
         use PIL for all other operations we perform since they are faster
-        than pgmagick.'''
+        than pgmagick. The decoded pixels are exported raw and wrapped in a
+        PIL image with frombuffer instead of being encoded again, and that
+        image is shared by all sizes. The EXIF profile is kept in the image
+        info so the orientation is still applied.'''
         if self._pgmagick_ran:
-            raise BadImage(_('Already converted with pgmagick'))
+            raise InvalidImage(_('Already converted with pgmagick'))
         self._pgmagick_ran = True
         blob = pgmagick.Blob(self.raw)
         image = pgmagick.Image()
         image.ping(blob)
-        self._check_info(dict(format=image.magick(), width=image.columns(),
+        image_format = image.magick()
+        self._check_info(dict(format=image_format, width=image.columns(),
             height=image.rows()))
+        self._reserve_memory((image.columns(), image.rows()), None)
         image = pgmagick.Image(blob)
-        image.quality(self.config['quality'])
+        self.profile.mark_time('pgmagick')
+        mode = 'RGB'
+        if image.matte():
+            mode = 'RGBA'
+        image.magick(mode)
+        image.depth(8)
+        self._reserve_memory((image.columns(), image.rows()), mode)
         blob = pgmagick.Blob()
         image.write(blob)
-        self.raw = blob.data
-        self.profile.mark_time('pgmagick')
-        self.profile.mark('pgmagick_size', len(self.raw))
+        pixels = blob.data
+        self.profile.mark_time('pgmagick_export')
+        decoded = PIL.Image.frombuffer(mode, (image.columns(), image.rows()),
+            pixels, 'raw', mode, 0, 1)
+        decoded.format = image_format
+        exif = image.profile('EXIF')
+        if exif.length() > 0:
+            decoded.info['exif'] = exif.data
+        self._decoded = decoded
+        self.profile.mark_time('pgmagick_buffer')
+        self.profile.mark('pgmagick_size', len(pixels))
+        return decoded
 
     def _save_blob(self):
-        '''Save the image to the blob service.'''
-        checksum = int(self.info['checksum'][:16], 16)
-        checksum = clcommon.anybase.encode(checksum, 62)
-        name = self._blob_client.name(checksum)
-        pool = clcommon.worker.Pool(4, True)
-        batch = pool.batch()
-        batch.start(self._blob_client.put, '%s.json' % name,
-            json.dumps(self.info), self.config['ttl'], encoded=True)
-        self.info['blob_info_name'] = '%s.json' % name
-        self.info['blob_names'] = {}
+        '''Save the image to the blob service. If any upload fails, the
+        images that were uploaded are deleted again.'''
+        name = self._blob_name()
+        batch = self._get_uploader().batch()
+        ttl = self.config['ttl']
+        self._set_blob_names(name)
+        self._set_save_info()
+        if self.config['save_info']:
+            batch.put('%s.json' % name, json.dumps(self.info), ttl)
+        if self.config['save_original']:
+            batch.put('%s_original' % name, self.raw, ttl)
         for size in self._processed:
-            batch.start(self._blob_client.put, '%s_%s.jpg' % (name, size),
-                self._processed[size], self.config['ttl'], encoded=True)
-            self.info['blob_names'][size] = '%s_%s.jpg' % (name, size)
-        batch.wait_all()
-        pool.stop()
+            batch.put('%s_%s.jpg' % (name, size), self._processed[size], ttl)
+            for extension, raw in self.variants.get(size, {}).iteritems():
+                batch.put('%s_%s.%s' % (name, size, extension), raw, ttl)
+        try:
+            batch.wait()
+        except Exception:
+            batch.abort()
+            raise
+        self._saved(name)
+
+    def _start_pipeline(self):
+        '''Start the batch that sizes are uploaded to as they are encoded,
+        starting with the original if it is being saved.'''
+        self._pipeline = self._get_uploader().batch()
+        if self.config['save_original']:
+            self._pipeline_put('%s_original' % self._blob_name(), self.raw)
+
+    def _save_size(self, size):
+        '''Start uploading an encoded size and its variants.'''
+        name = self._blob_name()
+        self._pipeline_put('%s_%s.jpg' % (name, size), self._processed[size])
+        for extension, raw in self.variants.get(size, {}).iteritems():
+            self._pipeline_put('%s_%s.%s' % (name, size, extension), raw)
+
+    def _pipeline_put(self, name, data):
+        '''Add an upload to the pipeline batch, noting when the first one
+        started.'''
+        with self._pipeline_lock:
+            if self._pipeline_start is None:
+                self._pipeline_start = time.time()
+            self._pipeline.put(name, data, self.config['ttl'])
+
+    def _finish_pipeline(self):
+        '''Wait for all sizes to be uploaded, and then save the info so it
+        never names images that are not saved yet. The time uploads ran
+        while sizes were still being encoded is marked as overlap. If an
+        upload fails, the caller aborts the pipeline to delete the rest.'''
+        encoded = time.time()
+        name = self._blob_name()
+        self._pipeline.wait()
+        self._set_blob_names(name)
+        self._set_save_info()
+        if self.config['save_info']:
+            batch = self._get_uploader().batch()
+            batch.put('%s.json' % name, json.dumps(self.info),
+                self.config['ttl'])
+            batch.wait()
+        if self._pipeline_start is not None:
+            self.profile.mark('save_overlap', encoded - self._pipeline_start)
+            self.profile.mark('save_upload',
+                time.time() - self._pipeline_start)
+        self._saved(name)
+
+    def _get_uploader(self):
+        '''Get the uploader, creating one just for this image if none was
+        given.'''
+        if self._uploader is None:
+            self._uploader = climage.upload.Uploader(self._blob_client, 4)
+            self._stop_uploader = True
+        return self._uploader
+
+    def _saved(self, name):
+        '''Finish saving the image to the blob service.'''
+        index = get_checksum_index(self.config['dedup_index'])
+        if index is not None:
+            index.add(self.info['checksum'])
         self.log.info('save_blob_name: %s', name)
         self.profile.mark_time('save_blob')
 
+    def _set_save_info(self):
+        '''Set the quality and the time the blobs expire in the info, so
+        later dedup lookups can tell if the saved images can be reused.'''
+        self.info['quality'] = self.config['quality']
+        if self.config['ttl'] is not None:
+            self.info['blob_expires'] = int(time.time()) + self.config['ttl']
+
+    def _set_blob_names(self, name):
+        '''Set the blob names in the info for all saved images.'''
+        if self.config['save_info']:
+            self.info['blob_info_name'] = '%s.json' % name
+        if self.config['save_original']:
+            self.info['blob_original_name'] = '%s_original' % name
+        self.info['blob_names'] = {}
+        for size in self._processed:
+            self.info['blob_names'][size] = '%s_%s.jpg' % (name, size)
+        if len(self.variants) > 0:
+            self.info['blob_variant_names'] = {}
+        for size in self.variants:
+            self.info['blob_variant_names'][size] = dict(
+                (extension, '%s_%s.%s' % (name, size, extension))
+                for extension in self.variants[size])
+
 
 class ProcessingError(Exception):
     '''Exception raised when a processing error is encountered.'''
@@ -372,6 +1341,112 @@ class BadImage(Exception):
     pass
 
 
+class InvalidImage(BadImage):
+    '''Exception raised when an image is rejected for reasons that only
+    depend on its data, so the same bytes will always be rejected.'''
+
+    pass
+
+
+class Busy(Exception):
+    '''Exception raised when an image could not be processed in time
+    because of other jobs, so it can be retried later.'''
+
+    pass
+
+
+def _decode_error(message, exception):
+    '''Get the exception to raise when an image can't be decoded. Running
+    out of memory or other system errors may not happen again, so the
+    image is only marked invalid for other errors.'''
+    if isinstance(exception, InvalidImage) or not isinstance(exception,
+            (BadImage, MemoryError, OSError)):
+        return InvalidImage(message % exception)
+    return BadImage(message % exception)
+
+
+def _batch(config, filenames):
+    '''Process many files at once, sharing one worker pool, blob client,
+    and process engine between them. Filenames come from the command line
+    and the manifest file, or from stdin if neither gives any. A JSON line
+    is written to stdout for each image as it finishes, and a throughput
+    summary is written to stderr at the end.'''
+    processor_config = config['climage']['processor']
+    if processor_config['manifest'] is not None:
+        filenames = filenames + _read_manifest(processor_config['manifest'])
+    elif len(filenames) == 0:
+        filenames = _read_manifest('-')
+    engine = None
+    if processor_config['engine'] == 'process':
+        engine = ProcessEngine(config)
+    pool = clcommon.worker.Pool(processor_config['pool_size'])
+    blob_client = None
+    if processor_config['save_blob']:
+        blob_client = clblob.client.Client(config)
+    batch_pool = clcommon.worker.Pool(processor_config['batch_size'])
+    totals = dict(images=0, errors=0, bytes_in=0, bytes_out=0)
+    lock = threading.Lock()
+    start = time.time()
+    batch = batch_pool.batch()
+    for filename in filenames:
+        batch.start(_batch_process, config, filename, pool, blob_client,
+            engine, totals, lock)
+    batch.wait_all()
+    totals['seconds'] = max(time.time() - start, 0.000001)
+    totals['images_per_second'] = totals['images'] / totals['seconds']
+    totals['bytes_per_second'] = totals['bytes_in'] / totals['seconds']
+    sys.stderr.write('%s\n' % json.dumps(totals, sort_keys=True))
+    batch_pool.stop()
+    if engine is not None:
+        engine.stop()
+    if blob_client is not None:
+        blob_client.stop()
+    pool.stop()
+    close_checksum_indexes()
+
+
+def _read_manifest(manifest):
+    '''Read a list of filenames, one per line, from a manifest file or
+    stdin if the manifest is '-'.'''
+    if manifest == '-':
+        lines = sys.stdin.readlines()
+    else:
+        lines = open(manifest).readlines()
+    return [line.strip() for line in lines if line.strip() != '']
+
+
+def _batch_process(config, filename, pool, blob_client, engine, totals,
+        lock):
+    '''Process a single file for batch mode and write the JSON line. Any
+    error is written in the line for the file, so there is always one
+    line for each file.'''
+    config = clcommon.config.update_option(config,
+        'climage.processor.filename', filename)
+    record = dict(filename=filename)
+    try:
+        processor = Processor(config, open(filename), pool, blob_client,
+            engine)
+        processed = processor.process()
+        record['info'] = processor.info
+        record['sizes'] = dict((size, len(processed[size]))
+            for size in processed)
+        record['profile'] = dict(processor.profile.marks)
+    except (BadImage, Busy, ProcessingError, IOError), exception:
+        record['error'] = str(exception)
+    except Exception, exception:
+        record['error'] = '%s: %s' % (exception.__class__.__name__,
+            exception)
+    with lock:
+        if 'error' in record:
+            totals['errors'] += 1
+        else:
+            totals['images'] += 1
+            totals['bytes_in'] += record['profile'].get('original_size', 0)
+            totals['bytes_out'] += sum(record['sizes'].values())
+        sys.stdout.write('%s\n' % json.dumps(record, sort_keys=True))
+        sys.stdout.flush()
+
+
 def _main():
     '''Run the image tool.'''
     config = clcommon.config.update(DEFAULT_CONFIG,
@@ -379,6 +1454,9 @@ def _main():
     config, filenames = clcommon.config.load(config, DEFAULT_CONFIG_FILES,
         DEFAULT_CONFIG_DIRS)
     clcommon.log.setup(config)
+    if config['climage']['processor']['batch']:
+        _batch(config, filenames)
+        return
     if len(filenames) == 0:
         filenames = ['-']
     for filename in filenames:
@@ -20,24 +20,59 @@ return either the info or any size image that was requested after being
 processed. This maintains a worker pool and blob client that is shared
 between all requests.'''
 
+import hashlib
 import json
 import os
+import Queue
+import random
+import re
+import struct
+import threading
 import time
 
+import clblob
 import clblob.client
 import clcommon.config
 import clcommon.http
+import clcommon.log
 import clcommon.server
 import clcommon.worker
+import climage.cache
 import climage.processor
+import climage.upload
 
 DEFAULT_CONFIG = clcommon.config.update(climage.processor.DEFAULT_CONFIG,
     clcommon.http.DEFAULT_CONFIG)
 DEFAULT_CONFIG = clcommon.config.update(DEFAULT_CONFIG, {
     'climage': {
         'server': {
+            'admission_limit': 0,
+            'admission_retry_after': 1,
+            'admission_timeout': 1.0,
+            'batch_max_images': 24,
+            'batch_path': '/_batch',
+            'batch_pool_slots': 4,
+            'cache_size': 0,
+            'cache_ttl': None,
+            'disk_cache_path': None,
+            'disk_cache_segment_size': 67108864,
+            'disk_cache_size': 1073741824,
+            'drain_size': 1048576,
+            'metrics_path': '/_metrics',
+            'negative_cache_size': 0,
+            'negative_cache_ttl': 3600,
+            'render_on_read': False,
+            'render_sizes': None,
             'response': 'checksum',
-            'save_bad_path': None}}})
+            'save_bad_max_bytes': 1073741824,
+            'save_bad_max_files': 1000,
+            'save_bad_path': None,
+            'save_bad_queue_size': 64,
+            'save_bad_rate': 10,
+            'spool_path': None,
+            'upload_pool_size': 16,
+            'upload_retries': 2,
+            'upload_retry_delay': 0.5}}})
 
 DEFAULT_CONFIG_FILES = climage.processor.DEFAULT_CONFIG_FILES + [
     '/etc/climageserver.conf',
@@ -49,34 +84,124 @@ DEFAULT_CONFIG_DIRS = climage.processor.DEFAULT_CONFIG_DIRS + [
 
 VALID_RESPONSES = ['none', 'checksum', 'info']
 
+RENDER_PATH_REGEX = re.compile('^/([0-9a-f]{64})/([^/]+)$')
+
+BOUNDARY_REGEX = re.compile('boundary="?([^";]+)"?')
+
+FILENAME_REGEX = re.compile('filename="([^"]*)"')
+
+CHECKSUM_REGEX = re.compile('^[0-9a-f]{64}$')
+
+HISTOGRAM_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+    0.5, 1, 2.5, 5, 10]
+
 
 class Request(clcommon.http.Request):
     '''Request handler for image processing.'''
 
     def run(self):
         '''Run the request.'''
+        if self.method == 'GET' and self.env.get('PATH_INFO') == \
+                self.server.config['climage']['server']['metrics_path']:
+            self.headers.append(('Content-type', 'text/plain'))
+            return self.ok(self.server.metrics.render(self.server))
+        if self.method == 'GET' and \
+                self.server.config['climage']['server']['render_on_read']:
+            match = RENDER_PATH_REGEX.match(self.env.get('PATH_INFO', ''))
+            if match is not None:
+                return self._render(match.group(1), match.group(2))
         if self.method not in ['POST', 'PUT']:
             raise clcommon.http.MethodNotAllowed()
         config = self.parse_params(['filename'], ['quality', 'ttl'],
             ['save', 'save_blob'], ['sizes'])
         config = clcommon.config.update(self.server.config,
             {'climage': {'processor': config}})
+        if self.env.get('PATH_INFO') == \
+                config['climage']['server']['batch_path']:
+            return self._batch(config)
         response = config['climage']['server']['response']
         response = self.params.get('response', response).lower()
         sizes = config['climage']['processor']['sizes']
+        if ',' in response:
+            items = response.split(',')
+            for item in items:
+                if item not in ['checksum', 'info'] + sizes:
+                    raise clcommon.http.BadRequest(
+                        _('Invalid response parameter: %s') % item)
+            if config['climage']['server']['render_on_read']:
+                # Only render the sizes being returned, the rest are
+                # rendered from the saved original when first read.
+                config = clcommon.config.update(config, {'climage': {
+                    'processor': {
+                        'save_original': True,
+                        'sizes': [size for size in sizes if size in items]}}})
+            elif not config['climage']['processor']['save']:
+                # Only process the sizes being returned.
+                config = clcommon.config.update_option(config,
+                    'climage.processor.sizes',
+                    [size for size in sizes if size in items])
+            return self._multiple(config, items)
         if response not in VALID_RESPONSES + sizes:
             raise clcommon.http.BadRequest(
                 _('Invalid response parameter: %s') % response)
+        if response in VALID_RESPONSES and \
+                not config['climage']['processor']['save']:
+            # Sizes would be thrown away, so only get the info.
+            config = clcommon.config.update_option(config,
+                'climage.processor.sizes', [])
+        elif config['climage']['server']['render_on_read']:
+            # Only render the size being returned, the rest are rendered
+            # from the saved original when first read.
+            config = clcommon.config.update(config, {'climage': {
+                'processor': {
+                    'save_original': True,
+                    'sizes': [size for size in sizes if size == response]}}})
+        body = self._body()
+        processor = None
+        cost = None
+        self.server.metrics.start()
         try:
-            processor = climage.processor.Processor(config, self.body_data,
-                self.server.image_processor_pool, self.server.blob_client)
+            processor = climage.processor.Processor(config, body,
+                self.server.image_processor_pool, self.server.blob_client,
+                self.server.image_processor_engine,
+                self.server.image_processor_scheduler,
+                self.server.blob_uploader)
+            self._check_negative(config, processor.checksum)
+            if response in sizes:
+                cached = self._cache_get(config, processor.checksum, response)
+                if cached is not None:
+                    return cached
+            elif response == 'info':
+                cached = self._cache_get_info(config, processor.checksum)
+                if cached is not None:
+                    self.headers.append(('Content-type', 'application/json'))
+                    return self.ok(cached)
+            cost = self._admit(processor)
             processed = processor.process()
         except climage.processor.ProcessingError, exception:
+            self.server.metrics.count('processing_errors')
             raise clcommon.http.BadRequest(str(exception))
+        except climage.processor.Busy, exception:
+            self._busy(exception)
         except climage.processor.BadImage, exception:
-            self.log.warning(_('Bad image file: %s%s'), exception,
-                self._save_bad())
+            self.server.metrics.count('bad_images')
+            data = body
+            checksum = None
+            if processor is not None:
+                data = processor.raw
+                checksum = processor.checksum
+            elif isinstance(body, BodyStream):
+                data = body.data
+            self._put_negative(config, body, processor, exception)
+            self.log.warning(_('Bad image file: %s'), exception)
+            self._save_bad(data, checksum)
             raise clcommon.http.UnsupportedMediaType(_('Bad image file'))
+        finally:
+            self._drain(body)
+            if cost is not None:
+                self.server.admission.release(cost)
+            self.server.metrics.finish(processor)
+        self._cache_put(config, processor, processed)
         body = None
         if response == 'checksum':
             body = processor.info['checksum']
@@ -85,55 +210,1180 @@ class Request(clcommon.http.Request):
             body = json.dumps(processor.info)
             self.headers.append(('Content-type', 'application/json'))
         elif response in sizes:
-            body = processed[response]
-            self.headers.append(('Content-type', 'image/jpeg'))
+            variants = processor.variants.get(response, {})
+            extension = self._negotiate(variants)
+            return self._image_ok(variants.get(extension, processed[response]),
+                extension, variants)
         return self.ok(body)
 
-    def _save_bad(self):
-        '''Save bad image file to some location if enabled.'''
-        path = self.server.config['climage']['server']['save_bad_path']
-        if path is None:
+    def _batch(self, config):
+        '''Process all images in a batch request concurrently using the
+        same parameters, responding with a JSON list holding the info for
+        each image, or the error and status code if it failed. Each image
+        is a job in the shared worker pool, and its processor runs the
+        load and size steps inline in that job. Jobs can block in the pool
+        waiting for admission, the scheduler, or the memory budget, so no
+        more than batch_pool_slots batch and multipart jobs from all
+        requests are in the pool at once. The request thread waits for a
+        free slot before starting each job, leaving the rest of the pool
+        for single images. The slots are capped at one less than the pool
+        size, so a thread is always left when there is more than one.'''
+        images = self._batch_images()
+        max_images = config['climage']['server']['batch_max_images']
+        if len(images) > max_images:
+            raise clcommon.http.BadRequest(
+                _('Too many images in batch: %d > %d') % (len(images),
+                max_images))
+        if not config['climage']['processor']['save']:
+            # Sizes would be thrown away, so only get the info.
+            config = clcommon.config.update_option(config,
+                'climage.processor.sizes', [])
+        pool = clcommon.worker.Pool(0)
+        jobs = []
+        for image, filename in images:
+            if self.server.batch_slots is not None:
+                self.server.batch_slots.acquire()
+            jobs.append(self.server.image_processor_pool.start(
+                self._batch_job, config, image, filename, pool))
+        results = []
+        for job in jobs:
+            info, error = job.wait()
+            results.append(error if info is None else info)
+        pool.stop()
+        self.headers.append(('Content-type', 'application/json'))
+        return self.ok(json.dumps(results))
+
+    def _batch_job(self, config, image, filename, pool):
+        '''Process one image for a batch, freeing its slot when done.'''
+        try:
+            return self._process_job(config, image, filename, pool)
+        finally:
+            if self.server.batch_slots is not None:
+                self.server.batch_slots.release()
+
+    def _batch_images(self):
+        '''Split a batch request body into a list of (image, filename)
+        tuples. Multipart bodies are split on the boundary, anything else
+        is read as images that are each prefixed with a 4 byte big-endian
+        length.'''
+        body = self.body_data
+        content_type = self.env.get('CONTENT_TYPE', '')
+        if content_type.startswith('multipart/'):
+            match = BOUNDARY_REGEX.search(content_type)
+            if match is None:
+                raise clcommon.http.BadRequest(
+                    _('Missing multipart boundary'))
+            return split_multipart(body, match.group(1))
+        images = []
+        offset = 0
+        while offset < len(body):
+            if offset + 4 > len(body):
+                raise clcommon.http.BadRequest(_('Truncated batch request'))
+            length = struct.unpack('!I', body[offset:offset + 4])[0]
+            offset += 4
+            if offset + length > len(body):
+                raise clcommon.http.BadRequest(_('Truncated batch request'))
+            images.append((body[offset:offset + length], None))
+            offset += length
+        return images
+
+    def _process_job(self, config, image, filename, pool, callback=None,
+            items=None):
+        '''Process one image for a batch or multipart response, returning
+        a tuple of the info and None, or None and a dictionary with the
+        error and status code. If the items for a multipart response are
+        given and all of them are cached, the cached sizes are sent to the
+        callback instead of processing the image.'''
+        if filename is not None:
+            config = clcommon.config.update(config,
+                {'climage': {'processor': {'filename': filename}}})
+        processor = None
+        cost = None
+        self.server.metrics.start()
+        try:
+            processor = climage.processor.Processor(config, image, pool,
+                self.server.blob_client, self.server.image_processor_engine,
+                self.server.image_processor_scheduler,
+                self.server.blob_uploader)
+            if self.server.negative_cache is not None and \
+                    self.server.negative_cache.get(negative_cache_key(
+                    config, processor.checksum)) is not None:
+                return None, dict(error=_('Bad image file'), status=415)
+            if items is not None:
+                info = self._cache_get_items(config, processor.checksum,
+                    items, callback)
+                if info is not None:
+                    return info, None
+            cost = processor.estimate_cost()
+            if not self.server.admission.acquire(cost):
+                cost = None
+                return None, dict(error=_('Server is busy'), status=503)
+            processed = processor.process(callback)
+        except climage.processor.ProcessingError, exception:
+            self.server.metrics.count('processing_errors')
+            return None, dict(error=str(exception), status=400)
+        except climage.processor.Busy, exception:
+            self.server.metrics.count('busy')
+            return None, dict(error=_('Server is busy'), status=503)
+        except climage.processor.BadImage, exception:
+            self.server.metrics.count('bad_images')
+            data = image
+            checksum = None
+            if processor is not None:
+                data = processor.raw
+                checksum = processor.checksum
+            elif isinstance(image, BodyStream):
+                data = image.data
+            self._put_negative(config, image, processor, exception)
+            self.log.warning(_('Bad image file: %s'), exception)
+            self._save_bad(data, checksum)
+            return None, dict(error=_('Bad image file'), status=415)
+        except Exception, exception:
+            self.log.error(_('Could not process image: %s'), exception)
+            return None, dict(error=_('Could not process image'), status=500)
+        finally:
+            self._drain(image)
+            if cost is not None:
+                self.server.admission.release(cost)
+            self.server.metrics.finish(processor)
+        self._cache_put(config, processor, processed)
+        return processor.info, None
+
+    def _multiple(self, config, items):
+        '''Respond with several items in one multipart/mixed body. Sizes
+        are sent as soon as each is encoded, followed by the checksum and
+        info once processing is done, so the body is streamed out instead
+        of being built in memory. The image goes through the same negative
+        cache, caches, and admission control as a single image. Processing
+        is a job in the shared worker pool with its steps run inline, and
+        it takes a batch slot like batch images do. This waits for the
+        first size (or the result) before responding, so errors before any
+        part is ready get the right status code. An error after that can't
+        change the status, so it is sent as a last part named error that
+        holds a JSON object with the error and status code.'''
+        events = Queue.Queue()
+
+        def callback(size, raw, variants):
+            '''Queue each size as it is ready.'''
+            events.put((size, raw, variants))
+
+        def run():
+            '''Process the image, queueing the result when done.'''
+            try:
+                result = self._process_job(config, body, None, pool,
+                    callback, items)
+            except Exception, exception:
+                self.log.error(_('Could not process image: %s'), exception)
+                result = None, dict(error=str(exception), status=500)
+            finally:
+                pool.stop()
+                if self.server.batch_slots is not None:
+                    self.server.batch_slots.release()
+            events.put(result)
+
+        body = self._body()
+        pool = clcommon.worker.Pool(0)
+        if self.server.batch_slots is not None:
+            self.server.batch_slots.acquire()
+        self.server.image_processor_pool.start(run)
+        event = events.get()
+        if len(event) == 2 and event[0] is None:
+            self._raise_error(event[1])
+        boundary = '%032x' % random.getrandbits(128)
+        self.headers.append(('Content-type',
+            'multipart/mixed; boundary=%s' % boundary))
+        if len(config['climage']['processor']['output_formats']) > 0:
+            self.headers.append(('Vary', 'Accept'))
+        return self.ok(self._parts(boundary, items, events, event))
+
+    def _raise_error(self, error):
+        '''Raise the HTTP error for an error from _process_job.'''
+        if error['status'] == 400:
+            raise clcommon.http.BadRequest(error['error'])
+        elif error['status'] == 415:
+            raise clcommon.http.UnsupportedMediaType(error['error'])
+        elif error['status'] == 503:
+            self.headers.append(('Retry-After', str(self.server.config[
+                'climage']['server']['admission_retry_after'])))
+            raise clcommon.http.ServiceUnavailable(error['error'])
+        # Anything else is unexpected, so the server responds with 500.
+        raise RuntimeError(error['error'])
+
+    def _parts(self, boundary, items, events, event):
+        '''Generate the multipart body for the requested items from the
+        queued events.'''
+        while True:
+            parts = []
+            if len(event) == 3:
+                size, raw, variants = event
+                if size in items:
+                    extension = self._negotiate(variants)
+                    parts.append((size,
+                        climage.processor.CONTENT_TYPES[extension],
+                        variants.get(extension, raw)))
+            elif event[0] is None:
+                parts.append(('error', 'application/json',
+                    json.dumps(event[1])))
+            else:
+                for item in items:
+                    if item == 'checksum':
+                        parts.append((item, 'text/plain',
+                            event[0]['checksum']))
+                    elif item == 'info':
+                        parts.append((item, 'application/json',
+                            json.dumps(event[0])))
+            for name, content_type, data in parts:
+                for chunk in part(boundary, name, content_type, data):
+                    yield chunk
+            if len(event) == 2:
+                break
+            event = events.get()
+        yield '--%s--\r\n' % boundary
+
+    def _check_negative(self, config, checksum):
+        '''Respond with 415 right away if this image was already rejected
+        as bad, using the reason from the first rejection.'''
+        if self.server.negative_cache is None:
+            return
+        reason = self.server.negative_cache.get(
+            negative_cache_key(config, checksum))
+        if reason is not None:
+            self.log.info(_('Known bad image file: %s'), reason)
+            raise clcommon.http.UnsupportedMediaType(_('Bad image file'))
+
+    def _put_negative(self, config, body, processor, exception):
+        '''Remember an image was rejected as bad. Only rejections that
+        depend on the image data alone are kept, since other failures
+        (such as running out of memory) may not happen again. If the
+        image was rejected while streaming in, before the processor was
+        created, the rest of the body is drained to get the checksum.'''
+        if self.server.negative_cache is None or \
+                not isinstance(exception, climage.processor.InvalidImage):
+            return
+        if processor is not None:
+            checksum = processor.checksum
+        elif isinstance(body, BodyStream):
+            body.drain(self.server.config['climage']['server']['drain_size'])
+            checksum = body.checksum
+        else:
+            checksum = hashlib.sha256(body).hexdigest()
+        if checksum is not None:
+            self.server.negative_cache.put(
+                negative_cache_key(config, checksum), str(exception), 1)
+
+    def _busy(self, exception):
+        '''Respond with 503 for an image that timed out waiting for other
+        jobs.'''
+        self.server.metrics.count('busy')
+        self.log.warning(_('Server is busy: %s'), exception)
+        self.headers.append(('Retry-After', str(self.server.config[
+            'climage']['server']['admission_retry_after'])))
+        raise clcommon.http.ServiceUnavailable(_('Server is busy'))
+
+    def _admit(self, processor):
+        '''Wait for the estimated cost of processing an image to fit under
+        the admission limit, and respond with 503 if it does not fit before
+        the timeout. Returns the cost to release once processing is done.'''
+        cost = processor.estimate_cost()
+        if not self.server.admission.acquire(cost):
+            self.headers.append(('Retry-After', str(self.server.config[
+                'climage']['server']['admission_retry_after'])))
+            raise clcommon.http.ServiceUnavailable(_('Server is busy'))
+        return cost
+
+    def _cache_get(self, config, checksum, size):
+        '''Respond with a cached image if there is one in the format
+        negotiated for this request.'''
+        cached = self._cache_lookup(config, checksum, size)
+        if cached is None:
+            return None
+        body, extension, extensions = cached
+        return self._image_ok(body, extension, extensions)
+
+    def _cache_get_items(self, config, checksum, items, callback):
+        '''Send the sizes requested for a multipart response from the
+        caches to the callback and return the info. If anything requested
+        is not cached, None is returned without sending any sizes.'''
+        sizes = config['climage']['processor']['sizes']
+        images = {}
+        for item in items:
+            if item in sizes:
+                cached = self._cache_lookup(config, checksum, item)
+                if cached is None:
+                    return None
+                images[item] = cached
+        info = dict(checksum=checksum)
+        if 'info' in items:
+            cached = self._cache_get_info(config, checksum)
+            if cached is None:
+                return None
+            info = json.loads(cached)
+        for size, (body, extension, _extensions) in images.iteritems():
+            callback(size, body, {extension: body})
+        return info
+
+    def _cache_lookup(self, config, checksum, size):
+        '''Get a cached image in the format negotiated for this request,
+        as a tuple of the image, its extension, and the extensions it can
+        be sent in, or None if there is none. The in-memory cache is
+        checked before the disk cache. Images that were cached without
+        being saved are not used if this request should save them. The
+        blob ttl is part of the key since saved images are only cached for
+        as long as their blobs last.'''
+        if self.server.cache is None and self.server.disk_cache is None:
+            return None
+        processor_config = config['climage']['processor']
+        extensions = [climage.processor.EXTENSIONS[output_format]
+            for output_format in processor_config['output_formats']]
+        extension = self._negotiate(extensions)
+        key = (checksum, size, processor_config['quality'],
+            processor_config['ttl'], extension)
+        cached = None
+        if self.server.cache is not None:
+            cached = self.server.cache.get(key)
+        if cached is None and self.server.disk_cache is not None:
+            body = self.server.disk_cache.get(disk_cache_key(key))
+            if body is not None:
+                cached = (body, True)
+        if cached is None:
+            return None
+        body, saved = cached
+        if processor_config['save'] and processor_config['save_blob'] and \
+                not saved:
+            return None
+        return body, extension, extensions
+
+    def _cache_get_info(self, config, checksum):
+        '''Get cached info JSON for an image that was saved with the same
+        processor config, or None if there is none. The filename is set
+        from this request since it is not part of the key.'''
+        processor_config = config['climage']['processor']
+        if self.server.disk_cache is None or not processor_config['save']:
+            return None
+        cached = self.server.disk_cache.get(info_cache_key(config, checksum))
+        if cached is None:
+            return None
+        info = json.loads(str(cached))
+        info.pop('filename', None)
+        if 'filename' in processor_config:
+            info['filename'] = processor_config['filename']
+        return json.dumps(info)
+
+    def _cache_put(self, config, processor, processed):
+        '''Add all images from a processor to the caches. Only images that
+        were saved are added to the disk cache, along with the info.'''
+        processor_config = config['climage']['processor']
+        saved = processor_config['save'] and processor_config['save_blob']
+        quality = processor_config['quality']
+        ttl = processor_config['ttl']
+        checksum = processor.checksum
+        for size in processed:
+            images = processor.variants.get(size, {}).items()
+            images.append(('jpg', processed[size]))
+            for extension, body in images:
+                self._cache_put_image((checksum, size, quality, ttl,
+                    extension), body, saved, ttl)
+        if saved and self.server.disk_cache is not None and \
+                processor_config['save_info']:
+            self.server.disk_cache.put(info_cache_key(config, checksum),
+                json.dumps(processor.info), ttl)
+
+    def _cache_put_image(self, key, body, saved, ttl):
+        '''Add an image to the caches. Saved images expire from the caches
+        no later than their blobs, after ttl seconds.'''
+        if self.server.cache is not None:
+            if not saved:
+                ttl = None
+            self.server.cache.put(key, (body, saved), len(body), ttl)
+        if saved and self.server.disk_cache is not None:
+            self.server.disk_cache.put(disk_cache_key(key), body, ttl)
+
+    def _negotiate(self, variants):
+        '''Pick the extension of the image format to respond with from the
+        Accept header. Extra formats are only used if the client lists
+        them by type with a quality value that is non-zero and no lower
+        than the one for JPEG. WebP is preferred over PNG.'''
+        accepted = {}
+        for media_range in self.env.get('HTTP_ACCEPT', '').split(','):
+            parts = media_range.split(';')
+            quality = 1.0
+            for param in parts[1:]:
+                key, _separator, value = param.strip().partition('=')
+                if key == 'q':
+                    try:
+                        quality = float(value)
+                    except ValueError:
+                        quality = 0.0
+            accepted[parts[0].strip().lower()] = quality
+        jpeg_quality = accepted.get('image/jpeg', 0.0)
+        for extension in ['webp', 'png']:
+            if extension not in variants:
+                continue
+            quality = accepted.get(
+                climage.processor.CONTENT_TYPES[extension], 0.0)
+            if quality > 0 and quality >= jpeg_quality:
+                return extension
+        return 'jpg'
+
+    def _render(self, checksum, size):
+        '''Get a size for a saved image, rendering it from the saved
+        original and saving it if it has not been rendered yet. Concurrent
+        requests for the same size share one render.'''
+        config = self.server.config
+        allowed = config['climage']['server']['render_sizes']
+        if allowed is None:
+            allowed = config['climage']['processor']['sizes']
+        if size not in allowed or self.server.blob_client is None:
+            raise clcommon.http.NotFound()
+        cached = self._cache_get(config, checksum, size)
+        if cached is not None:
+            return cached
+        name = climage.processor.blob_name(self.server.blob_client, checksum)
+        extensions = [climage.processor.EXTENSIONS[output_format]
+            for output_format in config['climage']['processor']
+            ['output_formats']]
+        for extension in sorted(set([self._negotiate(extensions), 'jpg']),
+                key=lambda extension: extension == 'jpg'):
+            body = self._blob_get('%s_%s.%s' % (name, size, extension))
+            if body is not None:
+                ttl = config['climage']['processor']['ttl']
+                self._cache_put_image((checksum, size,
+                    config['climage']['processor']['quality'], ttl,
+                    extension), body, True, ttl)
+                return self._image_ok(body, extension, extensions)
+        raw, variants = self.server.renders.call((checksum, size),
+            self._render_original, checksum, size)
+        extension = self._negotiate(variants)
+        return self._image_ok(variants.get(extension, raw), extension,
+            variants)
+
+    def _render_original(self, checksum, size):
+        '''Render a size from the saved original, returning the JPEG image
+        and the variants. This goes through admission control like any
+        other processing.'''
+        original = self._blob_get('%s_original' %
+            climage.processor.blob_name(self.server.blob_client, checksum))
+        if original is None:
+            raise clcommon.http.NotFound()
+        config = clcommon.config.update(self.server.config, {'climage': {
+            'processor': {
+                'dedup': False,
+                'save_info': False,
+                'save_original': False,
+                'sizes': [size]}}})
+        processor = None
+        cost = None
+        self.server.metrics.start()
+        try:
+            processor = climage.processor.Processor(config, original,
+                self.server.image_processor_pool, self.server.blob_client,
+                self.server.image_processor_engine,
+                self.server.image_processor_scheduler,
+                self.server.blob_uploader)
+            cost = self._admit(processor)
+            processed = processor.process()
+        except climage.processor.Busy, exception:
+            self._busy(exception)
+        except (climage.processor.ProcessingError,
+                climage.processor.BadImage), exception:
+            self.server.metrics.count('render_errors')
+            self.log.error(_('Could not render %s for %s: %s'), size,
+                checksum, exception)
+            raise
+        finally:
+            if cost is not None:
+                self.server.admission.release(cost)
+            self.server.metrics.finish(processor)
+        self.server.metrics.count('renders')
+        self._cache_put(config, processor, processed)
+        return processed[size], processor.variants.get(size, {})
+
+    def _blob_get(self, name):
+        '''Get the data for a blob, or None if it does not exist. Any other
+        blob service error responds with 503, since the blob may still
+        exist.'''
+        try:
+            return self.server.blob_client.get(name).read()
+        except clblob.NotFound:
+            return None
+        except Exception, exception:
+            self.log.error(_('Could not get blob %s: %s'), name, exception)
+            raise clcommon.http.ServiceUnavailable(_('Blob service error'))
+
+    def _image_ok(self, body, extension, variants):
+        '''Respond with an image in the format for the given extension.'''
+        self.headers.append(('Content-type',
+            climage.processor.CONTENT_TYPES[extension]))
+        if len(variants) > 0:
+            self.headers.append(('Vary', 'Accept'))
+        return self.ok(body)
+
+    def _body(self):
+        '''Get the request body as a stream if the content length is known
+        so the processor can read it in chunks, otherwise read it all.'''
+        length = self.env.get('CONTENT_LENGTH')
+        if not length:
+            return self.body_data
+        keep = self.server.config['climage']['server']['save_bad_path']
+        return BodyStream(self.env['wsgi.input'], int(length),
+            keep is not None)
+
+    def _drain(self, body):
+        '''Read and throw away the rest of a request body that was rejected
+        before it was all read, so the leftover data isn't parsed as the
+        next request on a keep-alive connection. If more than drain_size
+        bytes are left, the connection is closed instead.'''
+        if not isinstance(body, BodyStream) or body.remaining == 0:
+            return
+        if not body.drain(
+                self.server.config['climage']['server']['drain_size']):
+            self.headers.append(('Connection', 'close'))
+
+    def _save_bad(self, data, checksum=None):
+        '''Queue bad image file to be saved to some location if enabled.
+        The spool logs the file name once it has been saved.'''
+        if self.server.bad_image_spool is None:
+            return
+        filename = self.params.get('filename', '')
+        filename = ''.join(char for char in filename
+            if 32 < ord(char) < 127 and char != '/')
+        self.server.bad_image_spool.put(filename, data, checksum)
+
+
+class BodyStream(object):
+    '''File-like wrapper for the request body that reads no more than the
+    content length. If keep is set, the data read is also kept so it can be
+    saved when the image is rejected before the processor has it all. The
+    checksum of everything read, including drained data, is kept too.'''
+
+    def __init__(self, body, length, keep=False):
+        self._body = body
+        self._remaining = length
+        self._chunks = [] if keep else None
+        self._checksum = hashlib.sha256()  # pylint: disable=E1101
+
+    @property
+    def data(self):
+        '''Data read so far if keep was set, otherwise an empty string.'''
+        return ''.join(self._chunks or [])
+
+    @property
+    def remaining(self):
+        '''Number of bytes of the body not read yet.'''
+        return self._remaining
+
+    @property
+    def checksum(self):
+        '''SHA-256 checksum of the whole body once it has all been read or
+        drained, otherwise None.'''
+        if self._remaining > 0:
+            return None
+        return self._checksum.hexdigest()
+
+    def drain(self, limit, chunk_size=65536):
+        '''Read and throw away the rest of the body if no more than limit
+        bytes are left. Returns True if the whole body has been read.'''
+        if self._remaining > limit:
+            return False
+        while self._remaining > 0:
+            data = self._body.read(min(chunk_size, self._remaining))
+            if len(data) == 0:
+                break
+            self._checksum.update(data)
+            self._remaining -= len(data)
+        self._remaining = 0
+        return True
+
+    def read(self, size=-1):
+        '''Read up to size bytes, or the rest of the body if size is
+        negative.'''
+        if size < 0 or size > self._remaining:
+            size = self._remaining
+        if size == 0:
             return ''
+        data = self._body.read(size)
+        self._checksum.update(data)
+        self._remaining -= len(data)
+        if len(data) == 0:
+            self._remaining = 0
+        if self._chunks is not None:
+            self._chunks.append(data)
+        return data
+
+
+class BadImageSpool(object):
+    '''Background writer for bad image files. Files are queued by request
+    threads and written by a single spool thread, so saving them never
+    slows down responses. When the queue is full, or more than
+    save_bad_rate files per second are queued, files are dropped so only
+    a sample is kept. Saved files are named by the time they were queued,
+    their checksum, and the given file name, so files with a checksum that
+    is already in the spool directory are skipped, even across restarts.
+    The oldest files are removed to stay under the byte and file
+    quotas.'''
+
+    def __init__(self, config):
+        self.config = config['climage']['server']
+        self.path = self.config['save_bad_path']
+        self.log = clcommon.log.get_log('climage_bad_image_spool',
+            config['climage']['processor']['log_level'])
+        self.stats = dict(written=0, dropped=0, sampled=0, duplicates=0,
+            evicted=0, failed=0)
+        self._lock = threading.Lock()
+        self._queue = Queue.Queue(self.config['save_bad_queue_size'])
+        self._checksums = {}
+        self._files = []
+        self._bytes = 0
+        self._tokens = self.config['save_bad_rate']
+        self._last = time.time()
+        self._thread = None
+
+    def start(self):
+        '''Start the spool thread, finding files already saved so they
+        count toward the quotas.'''
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        files = []
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            stat = os.stat(path)
+            files.append((stat.st_mtime, path, stat.st_size))
+        for _mtime, path, size in sorted(files):
+            self._add(path, size, bad_file_checksum(path))
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        '''Write all queued files and stop the spool thread.'''
+        self._queue.put(None)
+        self._thread.join()
+
+    def put(self, filename, data, checksum=None):
+        '''Queue a file to be saved. Returns False if it was dropped.'''
+        queued = time.time()
+        with self._lock:
+            rate = self.config['save_bad_rate']
+            if rate > 0:
+                now = time.time()
+                self._tokens = min(self._tokens + (now - self._last) * rate,
+                    rate)
+                self._last = now
+                if self._tokens < 1:
+                    self.stats['sampled'] += 1
+                    return False
+                self._tokens -= 1
+        try:
+            self._queue.put_nowait((queued, filename, data, checksum))
+        except Queue.Full:
+            with self._lock:
+                self.stats['dropped'] += 1
+            return False
+        return True
+
+    def _run(self):
+        '''Write queued files until stopped.'''
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            self._write(*item)
+
+    def _write(self, queued, filename, data, checksum):
+        '''Write a file if it is not already in the spool, and remove the
+        oldest files while over the quotas.'''
+        if checksum is None:
+            # pylint: disable=E1101
+            checksum = hashlib.sha256(data).hexdigest()
+        if checksum in self._checksums:
+            self._count('duplicates')
+            return
+        path = os.path.join(self.path,
+            '%f.%s.%s' % (queued, checksum, filename[:50]))
         try:
-            if not os.path.isdir(path):
-                os.makedirs(path)
-            filename = self.params.get('filename', '')
-            filename = ''.join(char for char in filename
-                if 32 < ord(char) < 127 and char != '/')
-            filename = '%f.%s' % (time.time(), filename)
-            filename = os.path.join(path, filename[:100])
-            bad_file = open(filename, 'w')
-            bad_file.write(self.body_data)
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            bad_file = open(path, 'w')
+            bad_file.write(data)
             bad_file.close()
-            return ' (%s)' % filename
         except Exception, exception:
             self.log.warning(_('Could not save bad file: %s'), exception)
-            return ''
+            self._count('failed')
+            return
+        self._add(path, len(data), checksum)
+        self._count('written')
+        while len(self._files) > 1 and (
+                self._bytes > self.config['save_bad_max_bytes'] or
+                len(self._files) > self.config['save_bad_max_files']):
+            old_path, size, old_checksum = self._files.pop(0)
+            self._bytes -= size
+            if self._checksums.get(old_checksum) == old_path:
+                del self._checksums[old_checksum]
+            try:
+                os.unlink(old_path)
+            except OSError:
+                pass
+            self._count('evicted')
+        self.log.info(_('Saved bad image file: %s'), path)
+
+    def _add(self, path, size, checksum):
+        '''Track a file saved in the spool.'''
+        self._files.append((path, size, checksum))
+        self._checksums[checksum] = path
+        self._bytes += size
+
+    def _count(self, name):
+        '''Increment a counter.'''
+        with self._lock:
+            self.stats[name] += 1
+
+
+class Admission(object):
+    '''Admission control for processing jobs. Jobs are admitted as long as
+    the total cost of jobs in flight stays under the limit (in megapixels
+    times sizes), and otherwise wait up to timeout seconds for others to
+    finish. A job is always admitted when nothing else is in flight so
+    large images can still run. A limit of 0 admits everything.'''
+
+    def __init__(self, limit, timeout):
+        self.limit = int(limit * 1000000)
+        self.timeout = timeout
+        self.cost = 0
+        self.queued = 0
+        self.stats = dict(admitted=0, queued=0, shed=0)
+        self._condition = threading.Condition()
+
+    def acquire(self, cost):
+        '''Wait for a job with the given cost to be admitted. Returns
+        False if it was shed.'''
+        with self._condition:
+            if not self._fits(cost):
+                self.queued += 1
+                self.stats['queued'] += 1
+                deadline = time.time() + self.timeout
+                try:
+                    while not self._fits(cost):
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            self.stats['shed'] += 1
+                            return False
+                        self._condition.wait(remaining)
+                finally:
+                    self.queued -= 1
+            self.cost += cost
+            self.stats['admitted'] += 1
+            return True
+
+    def release(self, cost):
+        '''Release the cost of a finished job and wake waiting jobs.'''
+        with self._condition:
+            self.cost -= cost
+            self._condition.notify_all()
+
+    def _fits(self, cost):
+        '''Check if a job fits under the limit, lock must be held.'''
+        return self.limit == 0 or self.cost == 0 or \
+            self.cost + cost <= self.limit
+
+
+class Metrics(object):
+    '''Aggregate processor metrics across all requests. This keeps
+    histograms of each profile stage time along with counters for bytes,
+    errors, and fallbacks, and renders them as text for the metrics
+    endpoint. All methods are thread safe.'''
+
+    COUNTER_MARKS = ['attempts', 'cascade', 'dedup_hit', 'dedup_miss']
+
+    IGNORE_MARKS = ['quality']
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.in_progress = 0
+
+    def start(self):
+        '''Mark the start of a processing request.'''
+        with self._lock:
+            self.in_progress += 1
+
+    def finish(self, processor):
+        '''Mark the end of a processing request and add its profile.'''
+        with self._lock:
+            self.in_progress -= 1
+            self._count('requests', 1)
+            if processor is None:
+                return
+            for mark, value in processor.profile.marks.iteritems():
+                stage = mark.split(':')[-1]
+                if stage in self.IGNORE_MARKS:
+                    continue
+                if stage in self.COUNTER_MARKS:
+                    self._count(stage, value)
+                elif stage == 'original_size':
+                    self._count('bytes_in', value)
+                elif stage == 'size':
+                    self._count('bytes_out', value)
+                elif stage == 'pgmagick_size':
+                    self._count('pgmagick_fallbacks', 1)
+                else:
+                    self._observe(stage, value)
+
+    def count(self, name, value=1):
+        '''Increment a counter.'''
+        with self._lock:
+            self._count(name, value)
+
+    def _count(self, name, value):
+        '''Increment a counter, lock must be held.'''
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def _observe(self, name, value):
+        '''Add a value to a histogram, lock must be held.'''
+        if name not in self.histograms:
+            self.histograms[name] = dict(count=0, sum=0,
+                buckets=[0] * len(HISTOGRAM_BUCKETS))
+        histogram = self.histograms[name]
+        histogram['count'] += 1
+        histogram['sum'] += value
+        for index, bucket in enumerate(HISTOGRAM_BUCKETS):
+            if value <= bucket:
+                histogram['buckets'][index] += 1
+
+    def render(self, server):
+        '''Render all metrics as text, one value per line.'''
+        lines = []
+        with self._lock:
+            pool = server.image_processor_pool
+            lines.append('climage_in_progress %d' % self.in_progress)
+            lines.append('climage_pool_size %d' % pool.size)
+            lines.append('climage_pool_busy %d' % pool.busy)
+            lines.append('climage_pool_queued %d' % pool.queued)
+            lines.append('climage_pool_utilization %f' %
+                (float(pool.busy) / max(pool.size, 1)))
+            for name in sorted(self.counters):
+                lines.append('climage_%s %s' % (name, self.counters[name]))
+            for name in sorted(server.admission.stats):
+                lines.append('climage_admission_%s %d' % (name,
+                    server.admission.stats[name]))
+            lines.append('climage_admission_cost %d' % server.admission.cost)
+            lines.append('climage_admission_queue_depth %d' %
+                server.admission.queued)
+            lines.append('climage_render_shared %d' %
+                server.renders.stats['shared'])
+            if server.bad_image_spool is not None:
+                for name in sorted(server.bad_image_spool.stats):
+                    lines.append('climage_bad_image_spool_%s %d' % (name,
+                        server.bad_image_spool.stats[name]))
+            if server.blob_uploader is not None:
+                for name in sorted(server.blob_uploader.stats):
+                    lines.append('climage_upload_%s %d' % (name,
+                        server.blob_uploader.stats[name]))
+            memory_budget = climage.processor.get_memory_budget(
+                server.config['climage']['processor']['memory_budget'])
+            if memory_budget is not None:
+                lines.append('climage_memory_reserved_bytes %d' %
+                    memory_budget.current)
+                lines.append('climage_memory_reserved_peak_bytes %d' %
+                    memory_budget.peak)
+                lines.append('climage_memory_waits %d' % memory_budget.waits)
+            scheduler = server.image_processor_scheduler
+            if scheduler is not None:
+                for lane in scheduler.LANES:
+                    lines.append('climage_scheduler_running{lane="%s"} %d' %
+                        (lane, scheduler.running[lane]))
+                    lines.append('climage_scheduler_waiting{lane="%s"} %d' %
+                        (lane, scheduler.waiting(lane)))
+                lines.append('climage_scheduler_timeouts %d' %
+                    scheduler.timeouts)
+            if server.cache is not None:
+                for name in sorted(server.cache.stats):
+                    lines.append('climage_cache_%s %d' % (name,
+                        server.cache.stats[name]))
+                lines.append('climage_cache_bytes %d' % server.cache.size)
+                lines.append('climage_cache_entries %d' % len(server.cache))
+            if server.negative_cache is not None:
+                for name in sorted(server.negative_cache.stats):
+                    lines.append('climage_negative_cache_%s %d' % (name,
+                        server.negative_cache.stats[name]))
+                lines.append('climage_negative_cache_entries %d' %
+                    len(server.negative_cache))
+            if server.disk_cache is not None:
+                for name in sorted(server.disk_cache.stats):
+                    lines.append('climage_disk_cache_%s %d' % (name,
+                        server.disk_cache.stats[name]))
+                lines.append('climage_disk_cache_bytes %d' %
+                    server.disk_cache.size)
+                lines.append('climage_disk_cache_entries %d' %
+                    len(server.disk_cache))
+            for name in sorted(self.histograms):
+                histogram = self.histograms[name]
+                for index, bucket in enumerate(HISTOGRAM_BUCKETS):
+                    lines.append('climage_stage_seconds_bucket'
+                        '{stage="%s",le="%s"} %d' % (name, bucket,
+                        histogram['buckets'][index]))
+                lines.append('climage_stage_seconds_bucket'
+                    '{stage="%s",le="+Inf"} %d' % (name, histogram['count']))
+                lines.append('climage_stage_seconds_sum{stage="%s"} %f' %
+                    (name, histogram['sum']))
+                lines.append('climage_stage_seconds_count{stage="%s"} %d' %
+                    (name, histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+
+class SharedCalls(object):
+    '''Runs only one call at a time for each key. Callers that ask for a
+    key while a call for it is running wait for that call and share its
+    result, or its exception, instead of doing the same work again.'''
+
+    def __init__(self):
+        self.stats = dict(shared=0)
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def call(self, key, function, *args):
+        '''Call the function with args, or wait for the running call with
+        the same key, returning its result.'''
+        with self._lock:
+            shared = self._calls.get(key)
+            if shared is None:
+                shared = self._calls[key] = [threading.Event(), None, None]
+                running = False
+            else:
+                self.stats['shared'] += 1
+                running = True
+        if running:
+            shared[0].wait()
+            if shared[2] is not None:
+                raise shared[2]
+            return shared[1]
+        try:
+            shared[1] = function(*args)
+        except Exception, exception:
+            shared[2] = exception
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            shared[0].set()
+        return shared[1]
+
+
+class CountingPool(object):
+    '''Worker pool that counts the jobs waiting for a pool thread and the
+    jobs running on one, so the metrics can show how busy the pool is.'''
+
+    def __init__(self, size):
+        self.size = size
+        self.queued = 0
+        self.busy = 0
+        self._lock = threading.Lock()
+        self._pool = clcommon.worker.Pool(size)
+
+    def start(self, function, *args):
+        '''Start a job in the pool.'''
+        self._queue()
+        return self._pool.start(self._run, function, *args)
+
+    def batch(self):
+        '''Get a new batch of jobs to wait on.'''
+        return CountingBatch(self._pool.batch(), self._queue, self._run)
+
+    def stop(self):
+        '''Stop the worker pool.'''
+        self._pool.stop()
+
+    def _queue(self):
+        '''Count a job waiting for a pool thread.'''
+        with self._lock:
+            self.queued += 1
+
+    def _run(self, function, *args):
+        '''Run a job, counting it as busy instead of queued.'''
+        with self._lock:
+            self.queued -= 1
+            self.busy += 1
+        try:
+            return function(*args)
+        finally:
+            with self._lock:
+                self.busy -= 1
+
+
+class CountingBatch(object):
+    '''Batch of jobs in a counting pool. Each job is counted as queued
+    when started and then run through the pool's run function.'''
+
+    def __init__(self, batch, queue, run):
+        self._batch = batch
+        self._queue = queue
+        self._run = run
+
+    def start(self, function, *args):
+        '''Start a job in the batch.'''
+        self._queue()
+        return self._batch.start(self._run, function, *args)
+
+    def wait_all(self):
+        '''Wait for all jobs in the batch.'''
+        return self._batch.wait_all()
+
+
+def part(boundary, name, content_type, data):
+    '''Get the chunks for one part of a multipart/mixed body. The data is
+    its own chunk so it is not copied.'''
+    return ['--%s\r\nContent-Type: %s\r\nContent-Disposition: inline; '
+        'name="%s"\r\nContent-Length: %d\r\n\r\n' % (boundary,
+        content_type, name, len(data)), data, '\r\n']
+
+
+def split_multipart(body, boundary):
+    '''Split a multipart body into a list of (data, filename) tuples. The
+    filename is None if the part has none.'''
+    parts = []
+    for part in ('\r\n' + body).split('\r\n--%s' % boundary)[1:]:
+        if part.startswith('--'):
+            break
+        part = part.partition('\r\n')[2]
+        if part.startswith('\r\n'):
+            headers, data = '', part[2:]
+        else:
+            headers, _separator, data = part.partition('\r\n\r\n')
+        filename = None
+        match = FILENAME_REGEX.search(headers)
+        if match is not None:
+            filename = match.group(1)
+        parts.append((data, filename))
+    return parts
+
+
+def negative_cache_key(config, checksum):
+    '''Get the negative cache key for an image. Whether any sizes are
+    being processed is part of the key since an image that can't be
+    decoded may still be probed for info.'''
+    return (checksum, len(config['climage']['processor']['sizes']) > 0)
+
+
+def bad_file_checksum(path):
+    '''Get the checksum of a file in the bad image spool from its name, or
+    from its contents if it was not named by the spool.'''
+    # Names are <seconds>.<microseconds>.<checksum>.<filename>.
+    parts = os.path.basename(path).split('.', 3)
+    if len(parts) > 2 and CHECKSUM_REGEX.match(parts[2]):
+        return parts[2]
+    bad_file = open(path)
+    try:
+        # pylint: disable=E1101
+        return hashlib.sha256(bad_file.read()).hexdigest()
+    finally:
+        bad_file.close()
+
+
+def disk_cache_key(key):
+    '''Get the string key used in the disk cache for a cache key.'''
+    return '/'.join(str(part) for part in key)
+
+
+def info_cache_key(config, checksum):
+    '''Get the disk cache key for the info of an image. The whole processor
+    config except the filename is part of the key, so info is only shared
+    between requests that would have produced the same document.'''
+    processor_config = dict(config['climage']['processor'])
+    processor_config.pop('filename', None)
+    # pylint: disable=E1101
+    digest = hashlib.sha1(json.dumps(processor_config,
+        sort_keys=True)).hexdigest()
+    return disk_cache_key((checksum, 'info', digest))
 
 
 class Server(clcommon.http.Server):
-    '''Wrapper for the HTTP server that adds an image processing pool so
-    we can use it across all requests.'''
+    '''Wrapper for the HTTP server that adds an image processing pool, blob
+    uploader, and optional process engine and scheduler so we can use them
+    across all requests.'''
 
     def __init__(self, config, request):
         super(Server, self).__init__(config, request)
         self.blob_client = None
+        self.blob_uploader = None
         self.image_processor_pool = None
+        self.image_processor_engine = None
+        self.image_processor_scheduler = None
+        self.metrics = Metrics()
+        self.renders = SharedCalls()
+        self.bad_image_spool = None
+        self.batch_slots = None
+        batch_pool_slots = config['climage']['server']['batch_pool_slots']
+        pool_size = config['climage']['processor']['pool_size']
+        if pool_size > 0:
+            # Leave a thread for single images unless there is only one.
+            batch_pool_slots = min(batch_pool_slots, max(pool_size - 1, 1))
+        if batch_pool_slots > 0:
+            self.batch_slots = threading.Semaphore(batch_pool_slots)
+        self.admission = Admission(
+            config['climage']['server']['admission_limit'],
+            config['climage']['server']['admission_timeout'])
+        self.cache = None
+        cache_size = config['climage']['server']['cache_size']
+        if cache_size > 0:
+            self.cache = climage.cache.Cache(cache_size,
+                config['climage']['server']['cache_ttl'])
+        self.negative_cache = None
+        server_config = config['climage']['server']
+        if server_config['negative_cache_size'] > 0:
+            self.negative_cache = climage.cache.Cache(
+                server_config['negative_cache_size'],
+                server_config['negative_cache_ttl'])
+        self.disk_cache = None
+        disk_cache_path = config['climage']['server']['disk_cache_path']
+        if disk_cache_path is not None:
+            self.disk_cache = climage.cache.DiskCache(disk_cache_path,
+                config['climage']['server']['disk_cache_size'],
+                config['climage']['server']['disk_cache_segment_size'],
+                config['climage']['server']['cache_ttl'])
 
     def start(self):
+        # The process pool is forked, so it must be created before any
+        # threads are started.
+        if self.config['climage']['processor']['engine'] == 'process':
+            self.image_processor_engine = \
+                climage.processor.ProcessEngine(self.config)
         if self.config['climage']['processor']['save_blob']:
             self.blob_client = clblob.client.Client(self.config)
-        self.image_processor_pool = clcommon.worker.Pool(
+            self.blob_uploader = climage.upload.Uploader(self.blob_client,
+                self.config['climage']['server']['upload_pool_size'],
+                self.config['climage']['server']['spool_path'],
+                self.config['climage']['processor']['log_level'],
+                self.config['climage']['server']['upload_retries'],
+                self.config['climage']['server']['upload_retry_delay'])
+            self.blob_uploader.replay()
+        if self.config['climage']['server']['save_bad_path'] is not None:
+            self.bad_image_spool = BadImageSpool(self.config)
+            self.bad_image_spool.start()
+        self.image_processor_pool = CountingPool(
             self.config['climage']['processor']['pool_size'])
+        if self.config['climage']['processor']['scheduler']:
+            self.image_processor_scheduler = \
+                climage.processor.Scheduler(self.config)
         super(Server, self).start()
 
     def stop(self, timeout=None):
         super(Server, self).stop(timeout)
+        if self.bad_image_spool is not None:
+            self.bad_image_spool.stop()
+            self.bad_image_spool = None
+        if self.blob_uploader is not None:
+            self.blob_uploader.stop()
+            self.blob_uploader = None
         if self.blob_client is not None:
             self.blob_client.stop()
             self.blob_client = None
         self.image_processor_pool.stop()
         self.image_processor_pool = None
+        if self.image_processor_engine is not None:
+            self.image_processor_engine.stop()
+            self.image_processor_engine = None
+        self.image_processor_scheduler = None
+        climage.processor.close_checksum_indexes()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,194 @@
+# Copyright 2013 craigslist
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''craigslist image upload module.
+
+This provides an uploader that saves images to the blob service using a
+long-lived worker pool, so it can be shared across processor objects. With
+a spool path, it can also write behind: each image is written to a local
+spool file and the put returns once that file is synced, while the upload
+to the blob service finishes in the background. Failed uploads are
+retried a few times with exponential backoff. Spool files are removed
+once uploaded, and any left over (such as after a crash or an upload that
+failed every retry) are uploaded again by replay.'''
+
+import json
+import os
+import tempfile
+import threading
+import time
+
+import clcommon.log
+import clcommon.worker
+
+
+class Uploader(object):
+    '''Blob uploader with a bounded worker pool and optional write-behind
+    spool. Each upload is tried up to retries more times after failing,
+    waiting retry_delay seconds before the first retry and doubling that
+    each time. Counters for uploaded, retried, failed, deleted, spooled,
+    and replayed images are kept in the stats attribute.'''
+
+    def __init__(self, blob_client, pool_size, spool_path=None,
+            log_level='NOTSET', retries=2, retry_delay=0.1):
+        self._blob_client = blob_client
+        self._pool = clcommon.worker.Pool(pool_size, True)
+        self.spool_path = spool_path
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.log = clcommon.log.get_log('climage_upload', log_level)
+        self.stats = dict(uploaded=0, retried=0, failed=0, deleted=0,
+            spooled=0, replayed=0)
+        self._lock = threading.Lock()
+        if spool_path is not None and not os.path.isdir(spool_path):
+            os.makedirs(spool_path)
+
+    def batch(self):
+        '''Get a new batch of uploads to wait on.'''
+        return Batch(self, self._pool.batch())
+
+    def put(self, name, data, ttl, batch=None):
+        '''Start uploading an image. Without a spool, the upload runs in
+        the given worker pool batch if there is one so it can be waited
+        on. With a spool, this returns once the image is spooled and the
+        upload finishes in the background.'''
+        if self.spool_path is None:
+            (batch or self._pool).start(self._put, name, data, ttl)
+            return
+        self._pool.start(self._upload_spooled, self._spool(name, data, ttl))
+
+    def delete(self, name):
+        '''Delete an uploaded image from the blob service. This is only
+        used to clean up, so failures are logged instead of raised.'''
+        try:
+            self._blob_client.delete(name)
+        except Exception, exception:
+            self.log.warning(_('Could not delete %s: %s'), name, exception)
+            return
+        self._count('deleted', 1)
+
+    def replay(self):
+        '''Start uploading all images left in the spool. Returns the
+        number of images found.'''
+        if self.spool_path is None:
+            return 0
+        count = 0
+        for filename in sorted(os.listdir(self.spool_path)):
+            if filename.endswith('.spool'):
+                self._pool.start(self._upload_spooled,
+                    os.path.join(self.spool_path, filename))
+                count += 1
+        self._count('replayed', count)
+        return count
+
+    def stop(self):
+        '''Stop the worker pool.'''
+        self._pool.stop()
+
+    def _put(self, name, data, ttl):
+        '''Upload an image to the blob service, retrying with backoff.'''
+        delay = self.retry_delay
+        for attempt in xrange(self.retries + 1):
+            try:
+                self._blob_client.put(name, data, ttl, encoded=True)
+                break
+            except Exception, exception:
+                if attempt == self.retries:
+                    self._count('failed', 1)
+                    raise
+                self.log.info(_('Retrying upload of %s in %fs: %s'), name,
+                    delay, exception)
+                self._count('retried', 1)
+                time.sleep(delay)
+                delay *= 2
+        self._count('uploaded', 1)
+
+    def _spool(self, name, data, ttl):
+        '''Write an image to a spool file, returning the file name once it
+        has been synced to disk.'''
+        descriptor, temp_name = tempfile.mkstemp(prefix='climage',
+            suffix='.tmp', dir=self.spool_path)
+        spool_file = os.fdopen(descriptor, 'wb')
+        try:
+            spool_file.write(json.dumps([name, ttl]) + '\n')
+            spool_file.write(data)
+            spool_file.flush()
+            os.fsync(spool_file.fileno())
+        finally:
+            spool_file.close()
+        spool_name = temp_name[:-len('.tmp')] + '.spool'
+        os.rename(temp_name, spool_name)
+        self._count('spooled', 1)
+        return spool_name
+
+    def _upload_spooled(self, spool_name):
+        '''Upload an image from a spool file and remove it. The file is
+        left in the spool if the upload fails so it can be replayed.'''
+        try:
+            spool_file = open(spool_name, 'rb')
+            try:
+                name, ttl = json.loads(spool_file.readline())
+                data = spool_file.read()
+            finally:
+                spool_file.close()
+            self._put(name, data, ttl)
+            os.unlink(spool_name)
+        except Exception, exception:
+            self.log.warning(_('Could not upload spooled image %s: %s'),
+                spool_name, exception)
+
+    def _count(self, name, value):
+        '''Increment a counter.'''
+        with self._lock:
+            self.stats[name] += value
+
+
+class Batch(object):
+    '''Batch of uploads for a single image. Without a spool, wait returns
+    once all uploads finish and raises the first error. With a spool,
+    images are held until wait, which returns once they are all spooled.
+    A batch that is aborted instead leaves nothing behind.'''
+
+    def __init__(self, uploader, batch):
+        self._uploader = uploader
+        self._batch = batch
+        self._names = []
+        self._held = []
+
+    def put(self, name, data, ttl):
+        '''Add an upload to the batch.'''
+        if self._uploader.spool_path is None:
+            self._names.append(name)
+            self._uploader.put(name, data, ttl, self._batch)
+        else:
+            self._held.append((name, data, ttl))
+
+    def wait(self):
+        '''Wait for all uploads in the batch.'''
+        held = self._held
+        self._held = []
+        for name, data, ttl in held:
+            self._uploader.put(name, data, ttl)
+        self._batch.wait_all()
+
+    def abort(self):
+        '''Cancel the batch. Held images are dropped, and images already
+        started are deleted once their uploads finish.'''
+        self._held = []
+        try:
+            self._batch.wait_all()
+        except Exception:
+            pass
+        for name in self._names:
+            self._uploader.delete(name)
@@ -38,6 +38,8 @@ image_config='
     --climage.processor.save_blob=false'
 $coverage run -p climage/processor.py -n $image_config test/test.jpg
 $coverage run -p climage/processor.py -n $image_config < test/test.jpg
+ls test/*.jpg | $coverage run -p climage/processor.py -n $image_config \
+    --climage.processor.batch=true
 echo
 
 for signal in 2 9 15; do
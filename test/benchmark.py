@@ -0,0 +1,343 @@
+# Copyright 2013 craigslist
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Benchmarks for craigslist image processor module.
+
+This generates a synthetic corpus of images in all supported formats,
+sizes, EXIF orientations, and modes (including truncated files that take
+the pgmagick path), runs the processor over it, and reports percentiles
+for each profile stage. Results can be written as a baseline and later
+runs compared against it to flag regressions. With quality set, this
+instead compares the output of each resize filter (with the reduce step
+and cascading) against a plain ANTIALIAS resize of the decoded image,
+reporting the mean PSNR, SSIM, and resize time for each filter and size.
+Run with::
+
+    python -m test.benchmark --climage.benchmark.write_baseline=true
+    python -m test.benchmark
+    python -m test.benchmark --climage.benchmark.quality=true'''
+
+import json
+import math
+import PIL.Image
+import PIL.ImageChops
+import PIL.ImageDraw
+import random
+import struct
+import StringIO
+import sys
+import time
+
+import clcommon.config
+import clcommon.log
+import climage.processor
+
+DEFAULT_CONFIG = clcommon.config.update(climage.processor.DEFAULT_CONFIG, {
+    'climage': {
+        'benchmark': {
+            'baseline': 'test/benchmark_baseline.json',
+            'filters': ['antialias', 'bicubic', 'bilinear'],
+            'formats': ['JPEG', 'PNG', 'GIF', 'BMP', 'TIFF'],
+            'iterations': 3,
+            'quality': False,
+            'resolutions': ['160x120', '640x480', '1600x1200', '3200x2400'],
+            'seed': 0,
+            'threshold': 0.2,
+            'write_baseline': False},
+        'processor': {
+            'save': False,
+            'save_blob': False}}})
+
+# Profile marks that are counts or sizes instead of times. Every other
+# mark is reported as a stage, so new stages show up without changes here.
+COUNT_MARKS = ['attempts', 'cascade', 'dedup_hit', 'dedup_miss',
+    'original_size', 'pgmagick_size', 'quality', 'size']
+
+PERCENTILES = [50, 95, 99]
+
+# Constants for SSIM over 8 bit luminance.
+SSIM_BLOCK = 8
+SSIM_C1 = (0.01 * 255) ** 2
+SSIM_C2 = (0.03 * 255) ** 2
+
+# PSNR reported for identical images.
+PSNR_MAX = 100.0
+
+
+def generate_image(size, seed):
+    '''Generate a synthetic image with random shapes so encoders have some
+    detail to work with.'''
+    rand = random.Random(seed)
+    image = PIL.Image.new('RGB', size, (rand.randint(0, 255),
+        rand.randint(0, 255), rand.randint(0, 255)))
+    draw = PIL.ImageDraw.Draw(image)
+    width, height = size
+    for _count in xrange(200):
+        left, right = sorted([rand.randint(0, width),
+            rand.randint(0, width)])
+        upper, lower = sorted([rand.randint(0, height),
+            rand.randint(0, height)])
+        box = (left, upper, right, lower)
+        color = (rand.randint(0, 255), rand.randint(0, 255),
+            rand.randint(0, 255))
+        if rand.random() < 0.5:
+            draw.ellipse(box, fill=color)
+        else:
+            draw.rectangle(box, fill=color)
+    return image
+
+
+def encode(image, image_format):
+    '''Encode an image in the given format.'''
+    output = StringIO.StringIO()
+    image.save(output, image_format)
+    return output.getvalue()
+
+
+def add_orientation(raw, orientation):
+    '''Insert an EXIF APP1 segment with the given orientation tag right
+    after the SOI marker of a JPEG image.'''
+    tiff = 'MM\x00\x2a' + struct.pack('>I', 8)
+    tiff += struct.pack('>H', 1)
+    tiff += struct.pack('>HHIHH', 0x0112, 3, 1, orientation, 0)
+    tiff += struct.pack('>I', 0)
+    app1 = 'Exif\x00\x00' + tiff
+    return raw[:2] + '\xff\xe1' + struct.pack('>H', len(app1) + 2) + app1 + \
+        raw[2:]
+
+
+def generate_corpus(config):
+    '''Generate the benchmark corpus as a list of (name, raw) tuples.'''
+    corpus = []
+    seed = config['seed']
+    for resolution in config['resolutions']:
+        width, height = [int(value) for value in resolution.split('x')]
+        image = generate_image((width, height), seed)
+        seed += 1
+        for image_format in config['formats']:
+            corpus.append(('%s_%s' % (image_format.lower(), resolution),
+                encode(image, image_format)))
+        raw = encode(image, 'JPEG')
+        for orientation in xrange(1, 9):
+            corpus.append(('jpeg_%s_orientation%d' % (resolution,
+                orientation), add_orientation(raw, orientation)))
+        corpus.append(('jpeg_%s_truncated' % resolution,
+            raw[:len(raw) * 3 / 4]))
+        for mode, image_format in [('P', 'PNG'), ('P', 'GIF'),
+                ('LA', 'PNG')]:
+            corpus.append(('%s_%s_%s' % (image_format.lower(), resolution,
+                mode), encode(image.convert(mode), image_format)))
+    return corpus
+
+
+def percentile(values, percent):
+    '''Get a percentile of a list of values using the nearest rank.'''
+    values = sorted(values)
+    index = max(int(round(percent / 100.0 * len(values))) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+
+def stage(mark):
+    '''Get the stage name for a profile mark, or None if the mark is not
+    a timing mark. Per-size marks such as 50x50c:resize are grouped under
+    the stage name.'''
+    mark = mark.split(':')[-1]
+    if mark in COUNT_MARKS:
+        return None
+    return mark
+
+
+def run(config, corpus):
+    '''Run the processor over the corpus and return percentiles for each
+    stage, along with the number of samples and errors.'''
+    samples = {}
+    errors = 0
+    for _iteration in xrange(config['climage']['benchmark']['iterations']):
+        for _name, raw in corpus:
+            processor = climage.processor.Processor(config, raw)
+            try:
+                processor.process()
+            except climage.processor.BadImage:
+                errors += 1
+            for mark, value in processor.profile.marks.iteritems():
+                name = stage(mark)
+                if name is not None:
+                    samples.setdefault(name, []).append(value)
+    results = dict(errors=errors, stages={})
+    for name, values in samples.iteritems():
+        results['stages'][name] = dict(count=len(values))
+        for percent in PERCENTILES:
+            results['stages'][name]['p%d' % percent] = \
+                percentile(values, percent)
+    return results
+
+
+def compare(results, baseline, threshold):
+    '''Compare results against a baseline, returning a list of regression
+    descriptions for stage percentiles that are more than threshold
+    (a fraction) slower than the baseline.'''
+    regressions = []
+    for name in sorted(results['stages']):
+        if name not in baseline['stages']:
+            sys.stderr.write('new stage not in baseline: %s\n' % name)
+            continue
+        for percent in PERCENTILES:
+            key = 'p%d' % percent
+            old = baseline['stages'][name][key]
+            new = results['stages'][name][key]
+            if old > 0 and new > old * (1 + threshold):
+                regressions.append('%s %s: %f -> %f (+%d%%)' % (name, key,
+                    old, new, (new / old - 1) * 100))
+    return regressions
+
+
+def psnr(image, reference):
+    '''Get the peak signal to noise ratio between two images in dB.'''
+    difference = PIL.ImageChops.difference(image.convert('RGB'),
+        reference.convert('RGB'))
+    total = 0
+    for index, count in enumerate(difference.histogram()):
+        total += count * (index % 256) ** 2
+    mse = float(total) / (image.size[0] * image.size[1] * 3)
+    if mse == 0:
+        return PSNR_MAX
+    return 10 * math.log10(255 ** 2 / mse)
+
+
+def ssim(image, reference):
+    '''Get the mean structural similarity of the luminance of two images
+    over blocks of SSIM_BLOCK pixels square.'''
+    width, height = image.size
+    first = list(image.convert('L').getdata())
+    second = list(reference.convert('L').getdata())
+    total = 0.0
+    count = 0
+    for top in xrange(0, height - SSIM_BLOCK + 1, SSIM_BLOCK):
+        for left in xrange(0, width - SSIM_BLOCK + 1, SSIM_BLOCK):
+            xs = []
+            ys = []
+            for row in xrange(top, top + SSIM_BLOCK):
+                offset = row * width + left
+                xs.extend(first[offset:offset + SSIM_BLOCK])
+                ys.extend(second[offset:offset + SSIM_BLOCK])
+            samples = float(len(xs))
+            mean_x = sum(xs) / samples
+            mean_y = sum(ys) / samples
+            variance_x = sum((x - mean_x) ** 2 for x in xs) / samples
+            variance_y = sum((y - mean_y) ** 2 for y in ys) / samples
+            covariance = sum((x - mean_x) * (y - mean_y)
+                for x, y in zip(xs, ys)) / samples
+            total += ((2 * mean_x * mean_y + SSIM_C1) *
+                (2 * covariance + SSIM_C2)) / \
+                ((mean_x ** 2 + mean_y ** 2 + SSIM_C1) *
+                (variance_x + variance_y + SSIM_C2))
+            count += 1
+    if count == 0:
+        return 1.0
+    return total / count
+
+
+def resize_time(processor, size):
+    '''Get the time spent reducing and resizing a size.'''
+    marks = processor.profile.marks
+    return marks.get('%s:reduce' % size, 0) + marks.get('%s:resize' % size, 0)
+
+
+def run_quality(config, corpus):
+    '''Compare the output of each filter, with the reduce step and cascade
+    settings from the config, against a single ANTIALIAS resize from the
+    decoded image without either, returning the mean PSNR, SSIM, and
+    resize time for each filter and size. The time for the plain resize is
+    reported under the reference name.'''
+    sizes = config['climage']['processor']['sizes']
+    reference_config = clcommon.config.update(config, {'climage': {
+        'processor': {
+            'cascade': False,
+            'reduce': False,
+            'resize_filter': 'antialias'}}})
+    flags = dict((name, flag)
+        for flag, name in climage.processor.FILTER_FLAGS.iteritems())
+    samples = {}
+    for _name, raw in corpus:
+        processor = climage.processor.Processor(reference_config, raw)
+        try:
+            reference = processor.process()
+        except climage.processor.BadImage:
+            continue
+        for size in sizes:
+            samples.setdefault('reference:%s' % size, dict(time=[]))[
+                'time'].append(resize_time(processor, size))
+        for filter_name in config['climage']['benchmark']['filters']:
+            filter_sizes = ['%sf%s' % (size, flags[filter_name])
+                for size in sizes]
+            processor = climage.processor.Processor(
+                clcommon.config.update_option(config,
+                'climage.processor.sizes', filter_sizes), raw)
+            processed = processor.process()
+            for size, filter_size in zip(sizes, filter_sizes):
+                image = PIL.Image.open(StringIO.StringIO(
+                    processed[filter_size]))
+                reference_image = PIL.Image.open(StringIO.StringIO(
+                    reference[size]))
+                sample = samples.setdefault('%s:%s' % (filter_name, size),
+                    dict(psnr=[], ssim=[], time=[]))
+                sample['psnr'].append(psnr(image, reference_image))
+                sample['ssim'].append(ssim(image, reference_image))
+                sample['time'].append(resize_time(processor, filter_size))
+    results = {}
+    for key, sample in samples.iteritems():
+        results[key] = dict((metric, sum(values) / len(values))
+            for metric, values in sample.iteritems())
+    return results
+
+
+def _main():
+    '''Run the benchmark.'''
+    config = clcommon.config.update(DEFAULT_CONFIG,
+        clcommon.log.DEFAULT_CONFIG)
+    config, _filenames = clcommon.config.load(config,
+        climage.processor.DEFAULT_CONFIG_FILES,
+        climage.processor.DEFAULT_CONFIG_DIRS)
+    clcommon.log.setup(config)
+    benchmark_config = config['climage']['benchmark']
+    start = time.time()
+    corpus = generate_corpus(benchmark_config)
+    sys.stderr.write('generated %d images in %fs\n' % (len(corpus),
+        time.time() - start))
+    if benchmark_config['quality']:
+        results = run_quality(config, corpus)
+        print json.dumps(results, indent=4, sort_keys=True)
+        return
+    results = run(config, corpus)
+    print json.dumps(results, indent=4, sort_keys=True)
+    if benchmark_config['write_baseline']:
+        baseline_file = open(benchmark_config['baseline'], 'w')
+        baseline_file.write(json.dumps(results, indent=4, sort_keys=True))
+        baseline_file.close()
+        return
+    try:
+        baseline = json.loads(open(benchmark_config['baseline']).read())
+    except IOError:
+        sys.stderr.write('no baseline found: %s\n' %
+            benchmark_config['baseline'])
+        return
+    regressions = compare(results, baseline, benchmark_config['threshold'])
+    for regression in regressions:
+        sys.stderr.write('regression: %s\n' % regression)
+    if len(regressions) > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,164 @@
+# Copyright 2013 craigslist
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Tests for craigslist image cache module.'''
+
+import os
+import shutil
+import unittest
+
+import climage.cache
+
+
+class TestCache(unittest.TestCase):
+
+    def test_get_put(self):
+        cache = climage.cache.Cache(10)
+        self.assertEquals(None, cache.get('a'))
+        cache.put('a', 'aaaa', 4)
+        self.assertEquals('aaaa', cache.get('a'))
+        self.assertEquals(4, cache.size)
+        self.assertEquals(1, cache.stats['hits'])
+        self.assertEquals(1, cache.stats['misses'])
+
+    def test_lru(self):
+        cache = climage.cache.Cache(10)
+        cache.put('a', 'aaaa', 4)
+        cache.put('b', 'bbbb', 4)
+        cache.get('a')
+        cache.put('c', 'cccc', 4)
+        self.assertEquals(None, cache.get('b'))
+        self.assertEquals('aaaa', cache.get('a'))
+        self.assertEquals('cccc', cache.get('c'))
+        self.assertEquals(1, cache.stats['evictions'])
+        self.assertEquals(8, cache.size)
+
+    def test_replace(self):
+        cache = climage.cache.Cache(10)
+        cache.put('a', 'aaaa', 4)
+        cache.put('a', 'aa', 2)
+        self.assertEquals('aa', cache.get('a'))
+        self.assertEquals(2, cache.size)
+        self.assertEquals(1, len(cache))
+
+    def test_too_large(self):
+        cache = climage.cache.Cache(10)
+        cache.put('a', 'a' * 11, 11)
+        self.assertEquals(0, len(cache))
+        self.assertEquals(0, cache.size)
+
+    def test_ttl(self):
+        cache = climage.cache.Cache(10, -1)
+        cache.put('a', 'aaaa', 4)
+        self.assertEquals(None, cache.get('a'))
+        self.assertEquals(1, cache.stats['expired'])
+        self.assertEquals(0, cache.size)
+
+    def test_put_ttl(self):
+        cache = climage.cache.Cache(10)
+        cache.put('a', 'aaaa', 4, -1)
+        cache.put('b', 'bbbb', 4, 100)
+        self.assertEquals(None, cache.get('a'))
+        self.assertEquals('bbbb', cache.get('b'))
+        cache = climage.cache.Cache(10, -1)
+        cache.put('a', 'aaaa', 4, 100)
+        self.assertEquals(None, cache.get('a'))
+        self.assertEquals(1, cache.stats['expired'])
+
+
+class TestDiskCache(unittest.TestCase):
+
+    def setUp(self):
+        shutil.rmtree('test_cache', ignore_errors=True)
+
+    def tearDown(self):
+        shutil.rmtree('test_cache', ignore_errors=True)
+
+    def test_get_put(self):
+        cache = climage.cache.DiskCache('test_cache', 1000, 100)
+        self.assertEquals(None, cache.get('a'))
+        cache.put('a', 'aaaa')
+        self.assertEquals('aaaa', str(cache.get('a')))
+        self.assertEquals(1, cache.stats['hits'])
+        self.assertEquals(1, cache.stats['misses'])
+        cache.put('a', 'aa')
+        self.assertEquals('aa', str(cache.get('a')))
+        self.assertEquals(1, len(cache))
+
+    def test_rotate_evict(self):
+        cache = climage.cache.DiskCache('test_cache', 200, 50)
+        for index in xrange(10):
+            cache.put(str(index), str(index) * 20)
+        self.assertEquals(None, cache.get('0'))
+        self.assertEquals('9' * 20, str(cache.get('9')))
+        self.assertTrue(cache.stats['evictions'] > 0)
+        self.assertTrue(cache.size <= 200)
+        self.assertEquals(len(os.listdir('test_cache')), len(cache))
+
+    def test_replace(self):
+        cache = climage.cache.DiskCache('test_cache', 1000, 100)
+        cache.put('a', 'aaaa')
+        size = cache.size
+        for _count in xrange(10):
+            cache.put('a', 'bbbb')
+        self.assertEquals(size, cache.size)
+        self.assertEquals(0, cache.stats['evictions'])
+        self.assertEquals(1, len(os.listdir('test_cache')))
+        cache = climage.cache.DiskCache('test_cache', 1000, 100)
+        self.assertEquals(size, cache.size)
+        self.assertEquals('bbbb', str(cache.get('a')))
+
+    def test_restart(self):
+        cache = climage.cache.DiskCache('test_cache', 1000, 100)
+        cache.put('a', 'aaaa')
+        cache.put('b', 'bbbb')
+        cache.put('a', 'aa')
+        cache = climage.cache.DiskCache('test_cache', 1000, 100)
+        self.assertEquals('aa', str(cache.get('a')))
+        self.assertEquals('bbbb', str(cache.get('b')))
+        self.assertEquals(2, len(cache))
+
+    def test_restart_truncated(self):
+        cache = climage.cache.DiskCache('test_cache', 1000, 100)
+        cache.put('a', 'aaaa')
+        size = cache.size
+        segment = open(cache._filename(cache._current), 'ab')
+        segment.write(climage.cache.SEGMENT_MAGIC + 'partial')
+        segment.close()
+        cache = climage.cache.DiskCache('test_cache', 1000, 100)
+        self.assertEquals('aaaa', str(cache.get('a')))
+        self.assertEquals(size, cache.size)
+
+    def test_ttl(self):
+        cache = climage.cache.DiskCache('test_cache', 1000, 100, -1)
+        cache.put('a', 'aaaa')
+        self.assertEquals(None, cache.get('a'))
+        self.assertEquals(1, cache.stats['expired'])
+
+    def test_put_ttl(self):
+        cache = climage.cache.DiskCache('test_cache', 1000, 100)
+        cache.put('a', 'aaaa', -1)
+        cache.put('b', 'bbbb', 100)
+        cache = climage.cache.DiskCache('test_cache', 1000, 100)
+        self.assertEquals(None, cache.get('a'))
+        self.assertEquals('bbbb', str(cache.get('b')))
+        self.assertEquals(1, cache.stats['expired'])
+
+    def test_too_large(self):
+        cache = climage.cache.DiskCache('test_cache', 100, 1000)
+        cache.put('a', 'aaaa')
+        cache.put('a', 'a' * 100)
+        self.assertEquals(None, cache.get('a'))
+        self.assertEquals(0, len(cache))
+        self.assertEquals(0, cache.size)
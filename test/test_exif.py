@@ -0,0 +1,57 @@
+# Copyright 2013 craigslist
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Tests for craigslist image exif module.'''
+
+import unittest
+
+import climage.exif
+import test.test_processor
+
+
+def exif_segment(filename):
+    '''Get the EXIF APP1 segment data from a JPEG file.'''
+    data = open(filename).read()
+    return data[data.index('Exif\x00\x00'):]
+
+
+class TestExif(unittest.TestCase):
+
+    def test_parse(self):
+        exif = climage.exif.parse(exif_segment(test.test_processor.IMAGE))
+        self.assertEquals(6, exif['Orientation'])
+        self.assertEquals('Canon', exif['Make'])
+        self.assertEquals((72, 1), exif['XResolution'])
+
+    def test_gps(self):
+        exif = climage.exif.parse(
+            exif_segment(test.test_processor.EXIF_IMAGE))
+        self.assertEquals((2, 2, 0, 0), exif['GPSVersionID'])
+        self.assertEquals(((39, 1), (54, 1), (56, 1)), exif['GPSLatitude'])
+
+    def test_allowlist(self):
+        exif = climage.exif.parse(exif_segment(test.test_processor.IMAGE),
+            ['Model'])
+        self.assertEquals(dict(Model='Canon PowerShot SD200'), exif)
+
+    def test_max_size(self):
+        exif = climage.exif.parse(exif_segment(test.test_processor.IMAGE),
+            max_size=4)
+        self.assertFalse('Model' in exif)
+        self.assertEquals(6, exif['Orientation'])
+
+    def test_bad(self):
+        self.assertEquals({}, climage.exif.parse('bad data'))
+        data = exif_segment(test.test_processor.IMAGE)[:20]
+        self.assertEquals({}, climage.exif.parse(data))
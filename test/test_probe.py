@@ -0,0 +1,60 @@
+# Copyright 2013 craigslist
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Tests for craigslist image probe module.'''
+
+import PIL.Image
+import StringIO
+import unittest
+
+import climage.probe
+import test.test_processor
+
+
+class TestProbe(unittest.TestCase):
+
+    def probe_format(self, image_format, mode='RGB'):
+        '''Save the test image in the given format and probe it.'''
+        image = PIL.Image.open(open(test.test_processor.IMAGE))
+        output = StringIO.StringIO()
+        image.convert(mode).save(output, image_format)
+        return climage.probe.probe(output.getvalue())
+
+    def test_jpeg(self):
+        info = climage.probe.probe(open(test.test_processor.IMAGE).read())
+        self.assertEquals('JPEG', info['format'])
+        self.assertEquals((1000, 750), (info['width'], info['height']))
+        self.assertEquals('RGB', info['mode'])
+        self.assertEquals(6, info['orientation'])
+
+    def test_jpeg_partial(self):
+        info = climage.probe.probe(
+            open(test.test_processor.IMAGE).read()[:100])
+        self.assertEquals('JPEG', info['format'])
+        self.assertFalse(climage.probe.is_complete(info))
+
+    def test_formats(self):
+        for image_format, mode in [('PNG', 'RGB'), ('PNG', 'LA'),
+                ('GIF', 'P'), ('BMP', 'RGB'), ('TIFF', 'RGB')]:
+            info = self.probe_format(image_format, mode)
+            self.assertEquals(image_format, info['format'])
+            self.assertEquals((1000, 750), (info['width'], info['height']))
+            self.assertTrue(climage.probe.is_complete(info))
+
+    def test_ppm(self):
+        self.assertEquals('PPM', self.probe_format('PPM')['format'])
+
+    def test_unknown(self):
+        self.assertEquals(None, climage.probe.probe('bad data'))
+        self.assertFalse(climage.probe.is_complete(None))
@@ -19,11 +19,16 @@ import PIL.Image
 import os
 import shutil
 import StringIO
+import struct
+import sys
+import threading
+import time
 import unittest
 
 import clblob.client
 import clcommon.config
 import clcommon.http
+import clcommon.worker
 import climage.processor
 
 IMAGE = 'test/test.jpg'
@@ -56,6 +61,8 @@ class TestProcessor(unittest.TestCase):
     def setUp(self):
         shutil.rmtree('test_blob', ignore_errors=True)
         os.makedirs('test_blob')
+        climage.processor.close_checksum_indexes()
+        climage.processor._MEMORY_BUDGETS.clear()  # pylint: disable=W0212
 
     def test_process(self):
         processor = climage.processor.Processor(self.config, open(IMAGE))
@@ -65,6 +72,80 @@ class TestProcessor(unittest.TestCase):
         self.assertEquals(len(processed),
             len(self.config['climage']['processor']['sizes']))
 
+    def test_cascade(self):
+        processor = climage.processor.Processor(self.config, open(IMAGE))
+        processed = processor.process()
+        self.assertEquals(len(processed), 3)
+        # The test image is rotated, so 600x450 is 337x450 and 300x300 is
+        # 225x300, which is too close in size to cascade from it.
+        self.assertFalse('600x450:cascade' in processor.profile.marks)
+        self.assertFalse('300x300:cascade' in processor.profile.marks)
+        self.assertEquals(1, processor.profile.marks['50x50c:cascade'])
+        image = PIL.Image.open(StringIO.StringIO(processed['50x50c']))
+        self.assertEquals((50, 50), image.size)
+
+    def test_cascade_chain(self):
+        config = clcommon.config.update_option(self.config,
+            'climage.processor.sizes', ['50x50c', '200x200', '600x450'])
+        processor = climage.processor.Processor(config, open(IMAGE))
+        processed = processor.process()
+        self.assertEquals([['600x450'], ['200x200'], ['50x50c']],
+            [[size['name'] for size in level] for level in processor._plan])
+        self.assertEquals(1, processor.profile.marks['200x200:cascade'])
+        self.assertEquals(1, processor.profile.marks['50x50c:cascade'])
+        sizes = dict(('%dx%d' % (size['width'], size['height']),
+            size['source']) for size in processor._sizes)
+        self.assertEquals({'337x450': None, '150x200': '600x450',
+            '50x50': '200x200'}, sizes)
+        image = PIL.Image.open(StringIO.StringIO(processed['200x200']))
+        self.assertEquals((150, 200), image.size)
+        image = PIL.Image.open(StringIO.StringIO(processed['50x50c']))
+        self.assertEquals((50, 50), image.size)
+
+    def test_no_cascade(self):
+        config = clcommon.config.update_option(self.config,
+            'climage.processor.cascade', False)
+        processor = climage.processor.Processor(config, open(IMAGE))
+        processed = processor.process()
+        self.assertEquals(len(processed), 3)
+        self.assertFalse('300x300:cascade' in processor.profile.marks)
+
+    def test_cascade_scale(self):
+        config = clcommon.config.update_option(self.config,
+            'climage.processor.cascade_scale', 100)
+        processor = climage.processor.Processor(config, open(IMAGE))
+        processed = processor.process()
+        self.assertEquals(len(processed), 3)
+        self.assertFalse('50x50c:cascade' in processor.profile.marks)
+
+    def test_process_engine(self):
+        config = clcommon.config.update_option(self.config,
+            'climage.processor.engine', 'process')
+        config = clcommon.config.update_option(config,
+            'climage.processor.process_pool_size', 1)
+        processor = climage.processor.Processor(config, open(IMAGE))
+        processed = processor.process()
+        self.assertEquals(processor.info['width'], 1000)
+        self.assertEquals(len(processed), 3)
+        self.assertTrue('engine' in processor.profile.marks)
+        self.assertTrue('blob_names' in processor.info)
+        image = PIL.Image.open(StringIO.StringIO(processed['50x50c']))
+        self.assertEquals((50, 50), image.size)
+
+    def test_process_engine_bad_file(self):
+        config = clcommon.config.update_option(self.config,
+            'climage.processor.engine', 'process')
+        config = clcommon.config.update_option(config,
+            'climage.processor.process_pool_size', 1)
+        processor = climage.processor.Processor(config, 'bad')
+        self.assertRaises(climage.processor.BadImage, processor.process)
+
+    def test_invalid_engine(self):
+        config = clcommon.config.update_option(self.config,
+            'climage.processor.engine', 'bad')
+        self.assertRaises(climage.processor.ProcessingError,
+            climage.processor.Processor, config, open(IMAGE))
+
     def test_convert(self):
         image = PIL.Image.open(open(IMAGE))
         output = StringIO.StringIO()
@@ -88,11 +169,202 @@ class TestProcessor(unittest.TestCase):
         processor = climage.processor.Processor(self.config, "bad")
         self.assertRaises(climage.processor.BadImage, processor.process)
 
+    def test_decode_error(self):
+        exception = climage.processor._decode_error('%s', IOError('bad'))
+        self.assertTrue(isinstance(exception, climage.processor.InvalidImage))
+        exception = climage.processor._decode_error('%s', MemoryError())
+        self.assertFalse(
+            isinstance(exception, climage.processor.InvalidImage))
+        self.assertTrue(isinstance(exception, climage.processor.BadImage))
+
     def test_too_large(self):
         config = clcommon.config.update_option(self.config,
             'climage.processor.max_width', 100)
+        processor = climage.processor.Processor(config, open(IMAGE).read())
+        self.assertRaises(climage.processor.BadImage, processor.process)
+        # Streamed images are rejected from the header while reading.
+        self.assertRaises(climage.processor.BadImage,
+            climage.processor.Processor, config, open(IMAGE))
+
+    def test_stream_max_size(self):
+        config = clcommon.config.update_option(self.config,
+            'climage.processor.max_size', 1000)
+        self.assertRaises(climage.processor.BadImage,
+            climage.processor.Processor, config, open(IMAGE))
+
+    def test_stream_header(self):
+        config = clcommon.config.update_option(self.config,
+            'climage.processor.max_width', 100)
+        config = clcommon.config.update_option(config,
+            'climage.processor.read_size', 1024)
+        image = StringIO.StringIO(open(IMAGE).read())
+        self.assertRaises(climage.processor.BadImage,
+            climage.processor.Processor, config, image)
+        self.assertTrue(image.tell() < len(image.getvalue()))
+
+    def test_stream_checksum(self):
+        config = clcommon.config.update_option(self.config,
+            'climage.processor.read_size', 1024)
+        processor = climage.processor.Processor(config, open(IMAGE))
+        processor.process()
+        processor2 = climage.processor.Processor(config, open(IMAGE).read())
+        processor2.process()
+        self.assertEquals(processor.info['checksum'],
+            processor2.info['checksum'])
+        self.assertTrue('probe' in processor.profile.marks)
+
+    def test_probe_reject(self):
+        processor = climage.processor.Processor(self.config,
+            'not an image at all')
+        self.assertRaises(climage.processor.BadImage, processor.process)
+        self.assertFalse('open' in processor.profile.marks)
+        self.assertFalse('pgmagick' in processor.profile.marks)
+
+    def test_estimate_cost(self):
+        processor = climage.processor.Processor(self.config,
+            open(IMAGE).read())
+        image = PIL.Image.open(IMAGE)
+        self.assertEquals(image.size[0] * image.size[1] *
+            len(self.config['climage']['processor']['sizes']),
+            processor.estimate_cost())
+        processor = climage.processor.Processor(self.config, '\xff\xd8')
+        self.assertEquals(7000 * 7000 *
+            len(self.config['climage']['processor']['sizes']),
+            processor.estimate_cost())
+
+    def test_scheduler(self):
+        config = clcommon.config.update(self.config, {'climage': {
+            'processor': {
+                'scheduler_large_cost': 1000000,
+                'scheduler_large_slots': 1,
+                'scheduler_slots': 2}}})
+        scheduler = climage.processor.Scheduler(config)
+        processor = climage.processor.Processor(config, open(IMAGE).read(),
+            scheduler=scheduler)
+        processor.process()
+        self.assertTrue('wait_large' in processor.profile.marks)
+        config = clcommon.config.update_option(config,
+            'climage.processor.sizes', ['50x50'])
+        processor = climage.processor.Processor(config, open(IMAGE).read(),
+            scheduler=scheduler)
+        processor.process()
+        self.assertTrue('wait_fast' in processor.profile.marks)
+        self.assertEquals(dict(fast=0, large=0), scheduler.running)
+
+    def test_scheduler_lanes(self):
+        config = clcommon.config.update(self.config, {'climage': {
+            'processor': {
+                'scheduler_large_cost': 10,
+                'scheduler_large_slots': 1,
+                'scheduler_slots': 2}}})
+        scheduler = climage.processor.Scheduler(config)
+        self.assertEquals('large', scheduler.enter(10))
+        self.assertEquals('fast', scheduler.enter(1))
+        self.assertEquals(dict(fast=1, large=1), scheduler.running)
+        scheduler.leave('fast')
+        scheduler.leave('large')
+        self.assertEquals(dict(fast=0, large=0), scheduler.running)
+
+    def test_scheduler_timeout(self):
+        config = clcommon.config.update(self.config, {'climage': {
+            'processor': {
+                'scheduler_slots': 1,
+                'scheduler_timeout': 0.01}}})
+        scheduler = climage.processor.Scheduler(config)
+        self.assertEquals('fast', scheduler.enter(1))
+        processor = climage.processor.Processor(config, open(IMAGE).read(),
+            scheduler=scheduler)
+        self.assertRaises(climage.processor.Busy, processor.process)
+        self.assertEquals(0, scheduler.waiting('fast'))
+        self.assertEquals(1, scheduler.timeouts)
+        scheduler.leave('fast')
+        processor.process()
+        self.assertEquals(dict(fast=0, large=0), scheduler.running)
+
+    def test_memory_budget(self):
+        config = clcommon.config.update_option(self.config,
+            'climage.processor.memory_budget', 1000)
         processor = climage.processor.Processor(config, open(IMAGE))
+        processor.process()
+        budget = climage.processor.get_memory_budget(1000)
+        self.assertEquals(0, budget.current)
+        self.assertTrue(budget.peak > 1000)
+        self.assertTrue('memory_wait' in processor.profile.marks)
+
+    def test_memory_budget_wait(self):
+        config = clcommon.config.update_option(self.config,
+            'climage.processor.memory_budget', 1001)
+        budget = climage.processor.get_memory_budget(1001)
+        budget.reserve(1001)
+        pool = clcommon.worker.Pool(1)
+        processor = climage.processor.Processor(config, open(IMAGE), pool)
+        thread = threading.Thread(target=processor.process)
+        thread.start()
+        while budget.waits == 0:
+            time.sleep(0.01)
+        # The wait is on the calling thread, so the pool is still free.
+        self.assertEquals(1, pool.start(lambda: 1).wait())
+        budget.release(1001)
+        thread.join()
+        self.assertEquals(0, budget.current)
+        pool.stop()
+
+    def test_memory_budget_reserve(self):
+        budget = climage.processor.MemoryBudget(100)
+        budget.reserve(200)
+        budget.reserve(50, False)
+        self.assertEquals(250, budget.current)
+        budget.release(250)
+        budget.reserve(60)
+        budget.reserve(40)
+        self.assertEquals(100, budget.current)
+        self.assertEquals(250, budget.peak)
+        self.assertEquals(0, budget.waits)
+
+    def test_callback(self):
+        done = {}
+
+        def callback(size, raw, variants):
+            done[size] = (raw, variants)
+
+        processor = climage.processor.Processor(self.config, open(IMAGE))
+        processed = processor.process(callback)
+        self.assertEquals(sorted(processed), sorted(done))
+        for size in processed:
+            self.assertEquals(processed[size], done[size][0])
+
+    def test_probe_info(self):
+        config = clcommon.config.update_option(self.config,
+            'climage.processor.sizes', [])
+        processor = climage.processor.Processor(config,
+            open(IMAGE).read()[:20000])
+        processor.process()
+        self.assertEquals(processor.info['width'], 1000)
+        self.assertEquals(processor.info['height'], 750)
+        self.assertEquals(processor.info['format'], 'JPEG')
+
+    def test_probe_info_undecodable(self):
+        # A valid PNG header with a broken checksum probes fine but PIL
+        # can't open it, so only info-only requests succeed.
+        image = '\x89PNG\r\n\x1a\n' + struct.pack('>I', 13) + 'IHDR' + \
+            struct.pack('>IIBBBBB', 40, 30, 8, 2, 0, 0, 0) + '\0' * 4
+        processor = climage.processor.Processor(self.config, image)
         self.assertRaises(climage.processor.BadImage, processor.process)
+        config = clcommon.config.update_option(self.config,
+            'climage.processor.sizes', [])
+        processor = climage.processor.Processor(config, image)
+        processor.process()
+        self.assertEquals(processor.info['width'], 40)
+        self.assertEquals(processor.info['height'], 30)
+        self.assertEquals(processor.info['format'], 'PNG')
+        self.assertFalse('pgmagick' in processor.profile.marks)
+
+    def test_no_probe(self):
+        config = clcommon.config.update_option(self.config,
+            'climage.processor.probe', False)
+        processor = climage.processor.Processor(config, open(IMAGE))
+        processor.process()
+        self.assertFalse('probe' in processor.profile.marks)
 
     def test_no_size(self):
         config = clcommon.config.update_option(self.config,
@@ -101,11 +373,117 @@ class TestProcessor(unittest.TestCase):
         processed = processor.process()
         self.assertEquals(len(processed), 0)
 
+    def test_budget(self):
+        config = clcommon.config.update_option(self.config,
+            'climage.processor.sizes', ['600x450b20k', '300x300b1'])
+        processor = climage.processor.Processor(config, open(IMAGE))
+        processed = processor.process()
+        self.assertTrue(len(processed['600x450b20k']) <= 20 * 1024)
+        quality = processor.info['budget_quality']
+        attempts = processor.info['budget_attempts']
+        self.assertTrue(30 <= quality['600x450b20k'] <= 70)
+        self.assertTrue(attempts['600x450b20k'] <= 5)
+        self.assertEquals(30, quality['300x300b1'])
+        self.assertEquals(5, attempts['300x300b1'])
+        self.assertEquals(30, processor.profile.marks['300x300b1:quality'])
+
+    def test_output_formats(self):
+        config = clcommon.config.update_option(self.config,
+            'climage.processor.output_formats', ['WEBP', 'PNG'])
+        processor = climage.processor.Processor(config, open(IMAGE))
+        processor.process()
+        for size in processor.variants:
+            self.assertEquals(['webp'], processor.info['variants'][size])
+            webp = processor.variants[size]['webp']
+            self.assertEquals('WEBP',
+                PIL.Image.open(StringIO.StringIO(webp)).format)
+        client = clblob.client.Client(self.config)
+        name = processor.info['blob_variant_names']['50x50c']['webp']
+        self.assertTrue(name.endswith('_50x50c.webp'))
+        self.assertEquals(processor.variants['50x50c']['webp'],
+            client.get(name).read())
+
+    def test_output_formats_lossless(self):
+        # WebP drops an alpha channel that is fully opaque, so paint half
+        # the image with a transparent palette index.
+        image = PIL.Image.open(open(IMAGE)).convert(mode='P')
+        image.paste(0, (0, 0, 500, 750))
+        output = StringIO.StringIO()
+        image.save(output, 'PNG', transparency=0)
+        config = clcommon.config.update_option(self.config,
+            'climage.processor.output_formats', ['WEBP'])
+        processor = climage.processor.Processor(config, output.getvalue())
+        processor.process()
+        webp = PIL.Image.open(StringIO.StringIO(
+            processor.variants['50x50c']['webp']))
+        self.assertEquals('RGBA', webp.mode)
+        self.assertEquals(0, webp.getextrema()[3][0])
+
+    def test_output_formats_cmyk(self):
+        output = StringIO.StringIO()
+        PIL.Image.open(open(IMAGE)).convert(mode='CMYK').save(output, 'JPEG')
+        config = clcommon.config.update_option(self.config,
+            'climage.processor.output_formats', ['PNG', 'WEBP'])
+        processor = climage.processor.Processor(config, output.getvalue())
+        processor.process()
+        self.assertEquals('CMYK', processor.info['mode'])
+        self.assertTrue('50x50c.png:save' in processor.profile.marks)
+        webp = PIL.Image.open(StringIO.StringIO(
+            processor.variants['50x50c']['webp']))
+        self.assertEquals('RGB', webp.mode)
+
+    def test_invalid_output_format(self):
+        config = clcommon.config.update_option(self.config,
+            'climage.processor.output_formats', ['JPEG'])
+        self.assertRaises(climage.processor.ProcessingError,
+            climage.processor.Processor, config, open(IMAGE))
+
     def test_invalid_size(self):
         config = clcommon.config.update_option(self.config,
             'climage.processor.sizes', 'bad size')
         self.assertRaises(climage.processor.ProcessingError,
             climage.processor.Processor, config, open(IMAGE))
+        config = clcommon.config.update_option(self.config,
+            'climage.processor.sizes', '50x50x')
+        self.assertRaises(climage.processor.ProcessingError,
+            climage.processor.Processor, config, open(IMAGE))
+
+    def test_filter(self):
+        config = clcommon.config.update_option(self.config,
+            'climage.processor.sizes',
+            ['50x50cfb', '50x50c', '40x40fn', '40x40', '20x20'])
+        processor = climage.processor.Processor(config, open(IMAGE))
+        processed = processor.process()
+        # The test image is rotated by its exif orientation.
+        for size, dimensions in [('50x50cfb', (50, 50)),
+                ('40x40fn', (30, 40)), ('20x20', (15, 20))]:
+            image = PIL.Image.open(StringIO.StringIO(processed[size]))
+            self.assertEquals(dimensions, image.size)
+            self.assertTrue('%s:reduce' % size in processor.profile.marks)
+        self.assertNotEquals(processed['50x50c'], processed['50x50cfb'])
+        self.assertNotEquals(processed['40x40'], processed['40x40fn'])
+
+    def test_invalid_filter(self):
+        config = clcommon.config.update_option(self.config,
+            'climage.processor.resize_filter', 'lanczos')
+        self.assertRaises(climage.processor.ProcessingError,
+            climage.processor.Processor, config, open(IMAGE))
+        config = clcommon.config.update_option(self.config,
+            'climage.processor.sizes', '50x50fx')
+        self.assertRaises(climage.processor.ProcessingError,
+            climage.processor.Processor, config, open(IMAGE))
+
+    def test_no_reduce(self):
+        config = clcommon.config.update_option(self.config,
+            'climage.processor.reduce', False)
+        processed = climage.processor.Processor(config, open(IMAGE)).process()
+        reduced = climage.processor.Processor(self.config,
+            open(IMAGE)).process()
+        self.assertEquals(sorted(processed), sorted(reduced))
+        for size in processed:
+            self.assertEquals(
+                PIL.Image.open(StringIO.StringIO(processed[size])).size,
+                PIL.Image.open(StringIO.StringIO(reduced[size])).size)
 
     def test_save_blob(self):
         processor = climage.processor.Processor(self.config, open(IMAGE))
@@ -113,15 +491,142 @@ class TestProcessor(unittest.TestCase):
         self.assertTrue('blob_info_name' in processor.info)
         self.assertTrue('blob_names' in processor.info)
         client = clblob.client.Client(self.config)
-        info = processor.info.copy()
-        info.pop('blob_info_name')
-        info.pop('blob_names')
-        self.assertEquals(info,
+        self.assertEquals(processor.info,
             json.loads(client.get(processor.info['blob_info_name']).read()))
         for size in images:
             self.assertEquals(images[size],
                 client.get(processor.info['blob_names'][size]).read())
 
+    def test_dedup(self):
+        config = clcommon.config.update_option(self.config,
+            'climage.processor.dedup', True)
+        config = clcommon.config.update_option(config,
+            'climage.processor.dedup_index', 'test_blob/_dedup')
+        processor = climage.processor.Processor(config, open(IMAGE))
+        images = processor.process()
+        self.assertEquals(1, processor.profile.marks['dedup_miss'])
+        self.assertTrue(processor.info['checksum'] in
+            climage.processor.get_checksum_index('test_blob/_dedup'))
+        processor = climage.processor.Processor(config, open(IMAGE))
+        self.assertEquals(images, processor.process())
+        self.assertEquals(1, processor.profile.marks['dedup_hit'])
+        self.assertTrue('blob_names' in processor.info)
+        self.assertFalse('open' in processor.profile.marks)
+        self.assertFalse('dedup_refresh' in processor.profile.marks)
+
+    def test_dedup_quality(self):
+        config = clcommon.config.update_option(self.config,
+            'climage.processor.dedup', True)
+        processor = climage.processor.Processor(config, open(IMAGE))
+        processor.process()
+        config = clcommon.config.update_option(config,
+            'climage.processor.quality', 50)
+        processor = climage.processor.Processor(config, open(IMAGE))
+        processor.process()
+        self.assertEquals(1, processor.profile.marks['dedup_miss'])
+        self.assertEquals(50, processor.info['quality'])
+
+    def test_dedup_refresh(self):
+        config = clcommon.config.update_option(self.config,
+            'climage.processor.dedup', True)
+        config = clcommon.config.update_option(config,
+            'climage.processor.ttl', 100)
+        processor = climage.processor.Processor(config, open(IMAGE))
+        processor.process()
+        config = clcommon.config.update_option(config,
+            'climage.processor.ttl', 1000)
+        processor = climage.processor.Processor(config, open(IMAGE))
+        processor.process()
+        self.assertEquals(1, processor.profile.marks['dedup_hit'])
+        self.assertEquals(1, processor.profile.marks['dedup_refresh'])
+        client = clblob.client.Client(self.config)
+        info = json.loads(client.get(processor.info['blob_info_name']).read())
+        self.assertTrue(info['blob_expires'] >= time.time() + 900)
+
+    def test_dedup_index_only(self):
+        config = clcommon.config.update_option(self.config,
+            'climage.processor.dedup', True)
+        config = clcommon.config.update_option(config,
+            'climage.processor.dedup_check_blob', False)
+        config = clcommon.config.update_option(config,
+            'climage.processor.dedup_index', 'test_blob/_dedup_index_only')
+        processor = climage.processor.Processor(config, open(IMAGE))
+        processor.process()
+        self.assertEquals(1, processor.profile.marks['dedup_miss'])
+        self.assertFalse('dedup' in processor.profile.marks)
+        processor = climage.processor.Processor(config, open(IMAGE))
+        processor.process()
+        self.assertEquals(1, processor.profile.marks['dedup_hit'])
+        self.assertFalse('open' in processor.profile.marks)
+        climage.processor.close_checksum_indexes()
+        index = climage.processor.ChecksumIndex('test_blob/_dedup_index_only')
+        self.assertEquals(1, len(index))
+        index.close()
+
+    def test_save_original(self):
+        config = clcommon.config.update_option(self.config,
+            'climage.processor.save_original', True)
+        config = clcommon.config.update_option(config,
+            'climage.processor.save_info', False)
+        processor = climage.processor.Processor(config, open(IMAGE))
+        processor.process()
+        self.assertFalse('blob_info_name' in processor.info)
+        client = clblob.client.Client(self.config)
+        self.assertEquals(open(IMAGE).read(),
+            client.get(processor.info['blob_original_name']).read())
+
+    def test_save_pipeline(self):
+        config = clcommon.config.update(self.config, {'climage': {
+            'processor': {
+                'output_formats': ['WEBP'],
+                'save_original': True,
+                'save_pipeline': True}}})
+        processor = climage.processor.Processor(config, open(IMAGE))
+        processed = processor.process()
+        self.assertTrue('save_overlap' in processor.profile.marks)
+        self.assertTrue(processor.profile.marks['save_upload'] >=
+            processor.profile.marks['save_overlap'])
+        client = clblob.client.Client(self.config)
+        info = json.loads(client.get(processor.info['blob_info_name']).read())
+        self.assertEquals(processor.info, info)
+        for size in processed:
+            self.assertEquals(processed[size],
+                client.get(info['blob_names'][size]).read())
+            self.assertEquals(processor.variants[size]['webp'],
+                client.get(info['blob_variant_names'][size]['webp']).read())
+        self.assertEquals(open(IMAGE).read(),
+            client.get(info['blob_original_name']).read())
+
+    def test_save_pipeline_bad(self):
+        # Images too large are rejected before the pipeline starts, so fail
+        # once the first size has been uploaded to run the abort path.
+        config = clcommon.config.update(self.config, {'climage': {
+            'processor': {
+                'save_original': True,
+                'save_pipeline': True}}})
+        done = []
+
+        def callback(size, _image, _variants):
+            done.append(size)
+            raise climage.processor.BadImage('bad size')
+
+        processor = climage.processor.Processor(config, open(IMAGE).read())
+        self.assertRaises(climage.processor.BadImage, processor.process,
+            callback)
+        client = clblob.client.Client(self.config)
+        self.assertRaises(clblob.NotFound, client.get,
+            '%s_original' % processor._blob_name())
+        self.assertRaises(clblob.NotFound, client.get,
+            '%s_%s.jpg' % (processor._blob_name(), done[0]))
+
+    def test_save_pipeline_fail(self):
+        config = clcommon.config.update_option(self.config,
+            'climage.processor.save_pipeline', True)
+        config = clcommon.config.update_option(config,
+            'clblob.client.replica', None)
+        processor = climage.processor.Processor(config, open(IMAGE))
+        self.assertRaises(clblob.RequestError, processor.process)
+
     def test_save_blob_fail(self):
         config = clcommon.config.update_option(self.config,
             'clblob.client.replica', None)
@@ -138,13 +643,100 @@ class TestProcessor(unittest.TestCase):
     def test_pgmagick(self):
         # pylint: disable=W0212
         processor = climage.processor.Processor(self.config, open(IMAGE))
-        processor._pgmagick()
+        image = processor._pgmagick()
+        self.assertEquals(PIL.Image.open(IMAGE).size, image.size)
+        self.assertEquals('JPEG', image.format)
+        self.assertEquals('RGB', image.mode)
+        self.assertTrue('exif' in image.info)
+        self.assertEquals(open(IMAGE).read(), processor.raw)
         self.assertRaises(climage.processor.BadImage, processor._pgmagick)
 
+    def test_pgmagick_sizes(self):
+        config = clcommon.config.update_option(self.config,
+            'climage.processor.cascade', False)
+        image = open(IMAGE).read()[:-100]
+        processor = climage.processor.Processor(config, image)
+        processed = processor.process()
+        self.assertEquals(len(processed),
+            len(self.config['climage']['processor']['sizes']))
+        self.assertTrue('pgmagick_export' in processor.profile.marks)
+        self.assertTrue('pgmagick_buffer' in processor.profile.marks)
+
     def test_exif(self):
         processor = climage.processor.Processor(self.config, open(EXIF_IMAGE))
         processor.process()
         self.assertEquals(processor.info['exif_gpsversionid'], '(2, 2, 0, 0)')
+        self.assertEquals(processor.info['exif_model'], 'NIKON D2H')
+        self.assertFalse('exif_makernote' in processor.info)
+
+    def test_exif_tags(self):
+        config = clcommon.config.update_option(self.config,
+            'climage.processor.exif_tags', ['Orientation', 'GPSLatitudeRef'])
+        processor = climage.processor.Processor(config, open(EXIF_IMAGE))
+        processor.process()
+        exif = [key for key in processor.info if key.startswith('exif_')]
+        self.assertEquals(['exif_gpslatituderef', 'exif_orientation'],
+            sorted(exif))
+
+    def test_exif_tags_orientation(self):
+        config = clcommon.config.update_option(self.config,
+            'climage.processor.exif_tags', ['Model'])
+        processor = climage.processor.Processor(config, open(IMAGE))
+        processed = processor.process()
+        self.assertFalse('exif_orientation' in processor.info)
+        self.assertEquals('Canon PowerShot SD200',
+            processor.info['exif_model'])
+        image = PIL.Image.open(StringIO.StringIO(processed['300x300']))
+        self.assertEquals((225, 300), image.size)
+
+    def run_batch(self, config, filenames):
+        '''Run batch mode, returning the JSON lines and the totals.'''
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = StringIO.StringIO(), StringIO.StringIO()
+        try:
+            climage.processor._batch(config,  # pylint: disable=W0212
+                filenames)
+            output, totals = sys.stdout.getvalue(), sys.stderr.getvalue()
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+        records = [json.loads(line) for line in output.splitlines()]
+        return dict((record['filename'], record) for record in records), \
+            json.loads(totals)
+
+    def test_read_manifest(self):
+        manifest = open('test_blob/manifest', 'w')
+        manifest.write('  %s \r\n\n\t\nmissing.jpg\n\n' % IMAGE)
+        manifest.close()
+        self.assertEquals([IMAGE, 'missing.jpg'],
+            climage.processor._read_manifest(  # pylint: disable=W0212
+            'test_blob/manifest'))
+        config = clcommon.config.update_option(self.config,
+            'climage.processor.manifest', 'test_blob/missing_manifest')
+        self.assertRaises(IOError, self.run_batch, config, [])
+
+    def test_batch(self):
+        open('test_blob/bad.jpg', 'w').write('bad data')
+        manifest = open('test_blob/manifest', 'w')
+        manifest.write('test_blob/bad.jpg\ntest_blob/missing.jpg\n')
+        manifest.close()
+        config = clcommon.config.update_option(self.config,
+            'climage.processor.manifest', 'test_blob/manifest')
+        records, totals = self.run_batch(config, [IMAGE])
+        self.assertEquals(3, len(records))
+        self.assertEquals(1, totals['images'])
+        self.assertEquals(2, totals['errors'])
+        self.assertEquals(len(self.config['climage']['processor']['sizes']),
+            len(records[IMAGE]['sizes']))
+        self.assertFalse('error' in records[IMAGE])
+        self.assertTrue('error' in records['test_blob/bad.jpg'])
+        self.assertTrue('error' in records['test_blob/missing.jpg'])
+
+    def test_batch_blob_fail(self):
+        config = clcommon.config.update_option(self.config,
+            'clblob.client.replica', None)
+        records, totals = self.run_batch(config, [IMAGE, IMAGE])
+        self.assertEquals(2, totals['errors'])
+        self.assertTrue(records[IMAGE]['error'].startswith('RequestError'))
 
 
 class TestProcessorNoThreads(TestProcessor):
@@ -14,18 +14,22 @@
 
 '''Tests for craigslist image server module.'''
 
+import hashlib
 import httplib
 import json
 import os.path
 import PIL.Image
 import shutil
+import struct
 import StringIO
+import threading
 import unittest
 
 import clcommon.config
 import clcommon.http
 import climage.server
 import test.test_processor
+import test.test_upload
 
 HOST = '127.0.0.1'
 PORT = 8123
@@ -88,14 +92,40 @@ class TestServer(unittest.TestCase):
     def test_bad_data(self):
         config = clcommon.config.update_option(CONFIG,
             'climage.server.save_bad_path', 'test_image_bad')
-        self.start_server(config)
         shutil.rmtree('test_image_bad', ignore_errors=True)
+        self.start_server(config)
         response = request('PUT', '/?filename=a/b\x00\x80/%s' % ('c' * 1000),
             'bad data')
         self.assertEquals(415, response.status)
         self.assertEquals(True, os.path.isdir('test_image_bad'))
+        spool = self.server.bad_image_spool
+        test.test_upload.wait_for(lambda: spool.stats['written'] == 1)
         self.assertNotEquals(0, len(os.listdir('test_image_bad')))
 
+    def test_bad_data_spool(self):
+        config = clcommon.config.update(CONFIG, {'climage': {'server': {
+            'save_bad_max_files': 2,
+            'save_bad_path': 'test_image_bad',
+            'save_bad_rate': 0}}})
+        shutil.rmtree('test_image_bad', ignore_errors=True)
+        self.start_server(config)
+        for data in ['bad data 1', 'bad data 2', 'bad data 2', 'bad data 3']:
+            response = request('PUT', '/', data)
+            self.assertEquals(415, response.status)
+        self.stop_server()
+        self.assertEquals(2, len(os.listdir('test_image_bad')))
+        self.start_server(config)
+        spool = self.server.bad_image_spool
+        response = request('PUT', '/', 'bad data 3')
+        self.assertEquals(415, response.status)
+        test.test_upload.wait_for(lambda: spool.stats['duplicates'] == 1)
+        response = request('PUT', '/', 'bad data 4')
+        self.assertEquals(415, response.status)
+        test.test_upload.wait_for(lambda: spool.stats['written'] == 1)
+        self.assertEquals(1, spool.stats['evicted'])
+        self.assertEquals(2, len(os.listdir('test_image_bad')))
+        shutil.rmtree('test_image_bad', ignore_errors=True)
+
     def test_no_sizes(self):
         response = request('PUT', '/?sizes=', IMAGE)
         self.assertEquals(200, response.status)
@@ -131,6 +161,306 @@ class TestServer(unittest.TestCase):
         self.assertNotEquals(0, len(response.read()))
         self.assertEquals('image/jpeg', response.getheader('Content-Type'))
 
+    def test_response_accept(self):
+        config = clcommon.config.update_option(CONFIG,
+            'climage.processor.output_formats', ['WEBP'])
+        self.start_server(config)
+        response = request('PUT', '/?response=50x50c', IMAGE,
+            {'Accept': 'image/webp,image/*,*/*;q=0.8'})
+        self.assertEquals(200, response.status)
+        self.assertEquals('image/webp', response.getheader('Content-Type'))
+        self.assertEquals('Accept', response.getheader('Vary'))
+        response = request('PUT', '/?response=50x50c', IMAGE,
+            {'Accept': 'image/jpeg,image/webp;q=0.5'})
+        self.assertEquals('image/jpeg', response.getheader('Content-Type'))
+        response = request('PUT', '/?response=50x50c', IMAGE)
+        self.assertEquals('image/jpeg', response.getheader('Content-Type'))
+
+    def test_render_on_read(self):
+        config = clcommon.config.update_option(CONFIG,
+            'climage.server.render_on_read', True)
+        self.start_server(config)
+        response = request('PUT', '/?response=checksum', IMAGE)
+        self.assertEquals(200, response.status)
+        checksum = response.read()
+        response = request('GET', '/%s/50x50c' % checksum)
+        self.assertEquals(200, response.status)
+        self.assertEquals('image/jpeg', response.getheader('Content-Type'))
+        image = PIL.Image.open(StringIO.StringIO(response.read()))
+        self.assertEquals((50, 50), image.size)
+        response = request('GET', '/%s/50x50c' % checksum)
+        self.assertEquals(200, response.status)
+        response = request('GET', '/%s/20x20' % checksum)
+        self.assertEquals(404, response.status)
+        response = request('GET', '/%s/50x50c' % ('0' * 64))
+        self.assertEquals(404, response.status)
+        metrics = request('GET', '/_metrics').read()
+        self.assertTrue('climage_renders 1\n' in metrics)
+
+    def test_shared_calls(self):
+        shared_calls = climage.server.SharedCalls()
+        started = threading.Event()
+        finish = threading.Event()
+        calls = []
+
+        def function(value):
+            calls.append(value)
+            started.set()
+            finish.wait()
+            return value
+
+        results = []
+        thread = threading.Thread(target=lambda: results.append(
+            shared_calls.call('key', function, 1)))
+        thread.start()
+        started.wait()
+        other = threading.Thread(target=lambda: results.append(
+            shared_calls.call('key', function, 2)))
+        other.start()
+        test.test_upload.wait_for(lambda: shared_calls.stats['shared'] == 1)
+        finish.set()
+        thread.join()
+        other.join()
+        self.assertEquals([1], calls)
+        self.assertEquals([1, 1], results)
+        self.assertEquals(2, shared_calls.call('key', function, 2))
+
+    def test_render_on_read_response(self):
+        config = clcommon.config.update_option(CONFIG,
+            'climage.server.render_on_read', True)
+        self.start_server(config)
+        response = request('PUT', '/?response=info', IMAGE)
+        info = json.loads(response.read())
+        self.assertEquals({}, info['blob_names'])
+        self.assertTrue('blob_original_name' in info)
+        response = request('PUT', '/?response=300x300', IMAGE)
+        self.assertEquals(200, response.status)
+        self.assertEquals('image/jpeg', response.getheader('Content-Type'))
+
+    def test_render_on_read_multiple(self):
+        config = clcommon.config.update_option(CONFIG,
+            'climage.server.render_on_read', True)
+        self.start_server(config)
+        response = request('PUT', '/?response=checksum,50x50c', IMAGE)
+        self.assertEquals(200, response.status)
+        boundary = response.getheader('Content-Type').split('boundary=')[1]
+        parts = climage.server.split_multipart(response.read(), boundary)
+        self.assertEquals(2, len(parts))
+        checksum = parts[1][0]
+        response = request('GET', '/%s/300x300' % checksum)
+        self.assertEquals(200, response.status)
+        image = PIL.Image.open(StringIO.StringIO(response.read()))
+        self.assertEquals((225, 300), image.size)
+        metrics = request('GET', '/_metrics').read()
+        self.assertTrue('climage_renders 1\n' in metrics)
+
+    def test_cache(self):
+        config = clcommon.config.update_option(CONFIG,
+            'climage.server.cache_size', 1048576)
+        self.start_server(config)
+        response = request('PUT', '/?response=50x50c', IMAGE)
+        self.assertEquals(200, response.status)
+        image = response.read()
+        response = request('PUT', '/?response=300x300', IMAGE)
+        self.assertEquals(200, response.status)
+        self.assertEquals(1, self.server.cache.stats['hits'])
+        response = request('PUT', '/?response=50x50c&quality=10', IMAGE)
+        self.assertEquals(200, response.status)
+        self.assertNotEquals(image, response.read())
+        self.assertEquals(1, self.server.cache.stats['hits'])
+        response = request('PUT', '/?response=50x50c&ttl=100', IMAGE)
+        self.assertEquals(200, response.status)
+        self.assertEquals(1, self.server.cache.stats['hits'])
+        metrics = request('GET', '/_metrics').read()
+        self.assertTrue('climage_cache_hits 1\n' in metrics)
+
+    def test_disk_cache(self):
+        shutil.rmtree('test_cache', ignore_errors=True)
+        config = clcommon.config.update_option(CONFIG,
+            'climage.server.disk_cache_path', 'test_cache')
+        self.start_server(config)
+        response = request('PUT', '/?response=50x50c', IMAGE)
+        self.assertEquals(200, response.status)
+        image = response.read()
+        response = request('PUT', '/?response=info', IMAGE)
+        self.assertEquals(200, response.status)
+        info = json.loads(response.read())
+        self.start_server(config)
+        response = request('PUT', '/?response=50x50c', IMAGE)
+        self.assertEquals(200, response.status)
+        self.assertEquals(image, response.read())
+        response = request('PUT', '/?response=info', IMAGE)
+        self.assertEquals(info, json.loads(response.read()))
+        self.assertEquals(2, self.server.disk_cache.stats['hits'])
+        response = request('PUT', '/?response=info&filename=other', IMAGE)
+        self.assertEquals('other', json.loads(response.read())['filename'])
+        self.assertEquals(3, self.server.disk_cache.stats['hits'])
+        response = request('PUT', '/?response=info&ttl=100', IMAGE)
+        self.assertEquals(200, response.status)
+        self.assertEquals(3, self.server.disk_cache.stats['hits'])
+        metrics = request('GET', '/_metrics').read()
+        self.assertTrue('climage_disk_cache_hits 3\n' in metrics)
+        shutil.rmtree('test_cache', ignore_errors=True)
+
+    def test_write_behind(self):
+        shutil.rmtree('test_spool', ignore_errors=True)
+        config = clcommon.config.update_option(CONFIG,
+            'climage.server.spool_path', 'test_spool')
+        self.start_server(config)
+        response = request('PUT', '/?response=info', IMAGE)
+        self.assertEquals(200, response.status)
+        info = json.loads(response.read())
+        uploader = self.server.blob_uploader
+        test.test_upload.wait_for(lambda: uploader.stats['uploaded'] ==
+            uploader.stats['spooled'])
+        self.assertEquals([], os.listdir('test_spool'))
+        response = request('GET', '/_metrics')
+        self.assertTrue('climage_upload_spooled %d\n' %
+            (len(info['blob_names']) + 1) in response.read())
+        shutil.rmtree('test_spool', ignore_errors=True)
+
+    def test_negative_cache(self):
+        config = clcommon.config.update_option(CONFIG,
+            'climage.server.negative_cache_size', 10)
+        self.start_server(config)
+        image = IMAGE[:100] + 'x' * 1000
+        response = request('PUT', '/', image)
+        self.assertEquals(415, response.status)
+        response = request('PUT', '/', image)
+        self.assertEquals(415, response.status)
+        self.assertEquals(1, self.server.negative_cache.stats['hits'])
+        response = request('PUT', '/', IMAGE)
+        self.assertEquals(200, response.status)
+        metrics = request('GET', '/_metrics').read()
+        self.assertTrue('climage_negative_cache_hits 1\n' in metrics)
+        self.assertTrue('climage_bad_images 1\n' in metrics)
+
+    def test_negative_cache_stream(self):
+        config = clcommon.config.update_option(CONFIG,
+            'climage.server.negative_cache_size', 10)
+        self.start_server(config)
+        image = 'x' * 1000
+        response = request('PUT', '/', image)
+        self.assertEquals(415, response.status)
+        key = climage.server.negative_cache_key(config,
+            hashlib.sha256(image).hexdigest())
+        self.assertTrue(self.server.negative_cache.get(key) is not None)
+
+    def test_batch_pool_slots(self):
+        config = clcommon.config.update_option(CONFIG,
+            'climage.server.batch_pool_slots', 1)
+        self.start_server(config)
+        body = ''
+        for image in [IMAGE, 'bad data', IMAGE]:
+            body += struct.pack('!I', len(image)) + image
+        response = request('POST', '/_batch', body)
+        self.assertEquals(200, response.status)
+        results = json.loads(response.read())
+        self.assertEquals(64, len(results[0]['checksum']))
+        self.assertEquals(415, results[1]['status'])
+        self.assertEquals(64, len(results[2]['checksum']))
+        self.assertTrue(self.server.batch_slots.acquire(False))
+        self.server.batch_slots.release()
+
+    def test_batch_pool_slots_capped(self):
+        config = clcommon.config.update_option(CONFIG,
+            'climage.server.batch_pool_slots', 4)
+        config = clcommon.config.update_option(config,
+            'climage.processor.pool_size', 3)
+        self.start_server(config)
+        self.assertTrue(self.server.batch_slots.acquire(False))
+        self.assertTrue(self.server.batch_slots.acquire(False))
+        self.assertFalse(self.server.batch_slots.acquire(False))
+        self.server.batch_slots.release()
+        self.server.batch_slots.release()
+
+    def test_batch(self):
+        body = ''
+        for image in [IMAGE, 'bad data', IMAGE]:
+            body += struct.pack('!I', len(image)) + image
+        response = request('POST', '/_batch?quality=50', body)
+        self.assertEquals(200, response.status)
+        self.assertEquals('application/json',
+            response.getheader('Content-Type'))
+        results = json.loads(response.read())
+        self.assertEquals(3, len(results))
+        self.assertEquals(results[0], results[2])
+        self.assertEquals(64, len(results[0]['checksum']))
+        self.assertEquals(len(CONFIG['climage']['processor']['sizes']),
+            len(results[0]['blob_names']))
+        self.assertEquals(dict(error='Bad image file', status=415),
+            results[1])
+
+    def test_batch_multipart(self):
+        body = ''
+        for index, image in enumerate([IMAGE, IMAGE]):
+            body += '--BOUNDARY\r\nContent-Disposition: form-data; ' \
+                'name="image"; filename="%d.jpg"\r\n' \
+                'Content-Type: image/jpeg\r\n\r\n%s\r\n' % (index, image)
+        body += '--BOUNDARY--\r\n'
+        response = request('POST', '/_batch?save=false', body,
+            {'Content-Type': 'multipart/form-data; boundary=BOUNDARY'})
+        self.assertEquals(200, response.status)
+        results = json.loads(response.read())
+        self.assertEquals(['0.jpg', '1.jpg'],
+            [result['filename'] for result in results])
+        self.assertFalse('blob_names' in results[0])
+
+    def test_batch_bad(self):
+        response = request('POST', '/_batch', struct.pack('!I', 100) + 'x')
+        self.assertEquals(400, response.status)
+        response = request('POST', '/_batch', '',
+            {'Content-Type': 'multipart/form-data'})
+        self.assertEquals(400, response.status)
+        body = (struct.pack('!I', 1) + 'x') * 25
+        response = request('POST', '/_batch', body)
+        self.assertEquals(400, response.status)
+
+    def test_response_multiple(self):
+        response = request('PUT', '/?response=checksum,50x50c,300x300,info',
+            IMAGE)
+        self.assertEquals(200, response.status)
+        content_type = response.getheader('Content-Type')
+        self.assertTrue(content_type.startswith('multipart/mixed'))
+        boundary = content_type.split('boundary=')[1]
+        parts = climage.server.split_multipart(response.read(), boundary)
+        self.assertEquals(4, len(parts))
+        sizes = [PIL.Image.open(StringIO.StringIO(data)).size
+            for data, _filename in parts[:2]]
+        self.assertTrue((50, 50) in sizes)
+        self.assertEquals(parts[2][0], json.loads(parts[3][0])['checksum'])
+        self.assertTrue('50x50c' in json.loads(parts[3][0])['blob_names'])
+
+    def test_response_multiple_cache(self):
+        config = clcommon.config.update_option(CONFIG,
+            'climage.server.cache_size', 1048576)
+        self.start_server(config)
+        results = []
+        for _count in range(2):
+            response = request('PUT', '/?response=checksum,50x50c', IMAGE)
+            self.assertEquals(200, response.status)
+            boundary = response.getheader('Content-Type').split(
+                'boundary=')[1]
+            results.append(
+                climage.server.split_multipart(response.read(), boundary))
+        self.assertEquals(1, self.server.cache.stats['hits'])
+        self.assertEquals(sorted(results[0]), sorted(results[1]))
+
+    def test_response_multiple_no_save(self):
+        response = request('PUT', '/?response=50x50c,info&save=false', IMAGE)
+        self.assertEquals(200, response.status)
+        boundary = response.getheader('Content-Type').split('boundary=')[1]
+        parts = climage.server.split_multipart(response.read(), boundary)
+        self.assertEquals(2, len(parts))
+        self.assertEquals((50, 50),
+            PIL.Image.open(StringIO.StringIO(parts[0][0])).size)
+
+    def test_response_multiple_bad(self):
+        response = request('PUT', '/?response=info,bad', IMAGE)
+        self.assertEquals(400, response.status)
+        response = request('PUT', '/?response=info,50x50c', 'bad data')
+        self.assertEquals(415, response.status)
+
     def test_response_bad(self):
         response = request('PUT', '/?response=bad', IMAGE)
         self.assertEquals(400, response.status)
@@ -149,6 +479,27 @@ class TestServer(unittest.TestCase):
         response = request('PUT', '/', IMAGE)
         self.assertEquals(415, response.status)
 
+    def test_max_size(self):
+        config = clcommon.config.update_option(CONFIG,
+            'climage.processor.max_size', 1000)
+        self.start_server(config)
+        response = request('PUT', '/', IMAGE)
+        self.assertEquals(415, response.status)
+
+    def test_max_size_keep_alive(self):
+        config = clcommon.config.update_option(CONFIG,
+            'climage.processor.max_size', 1000)
+        self.start_server(config)
+        connection = httplib.HTTPConnection(HOST, PORT)
+        connection.request('PUT', '/', IMAGE)
+        response = connection.getresponse()
+        self.assertEquals(415, response.status)
+        response.read()
+        connection.request('GET', '/_metrics')
+        response = connection.getresponse()
+        self.assertEquals(200, response.status)
+        self.assertTrue('climage_bad_images 1\n' in response.read())
+
     def test_param_sizes(self):
         response = request('PUT', '/?sizes=20x20,50x50c', IMAGE)
         self.assertEquals(200, response.status)
@@ -157,6 +508,96 @@ class TestServer(unittest.TestCase):
         response = request('PUT', '/?sizes=bad', IMAGE)
         self.assertEquals(400, response.status)
 
+    def test_process_engine(self):
+        config = clcommon.config.update_option(CONFIG,
+            'climage.processor.engine', 'process')
+        config = clcommon.config.update_option(config,
+            'climage.processor.process_pool_size', 2)
+        self.start_server(config)
+        response = request('PUT', '/?response=50x50c', IMAGE)
+        self.assertEquals(200, response.status)
+        self.assertNotEquals(0, len(response.read()))
+        response = request('PUT', '/', 'bad data')
+        self.assertEquals(415, response.status)
+
+    def test_metrics(self):
+        request('PUT', '/', IMAGE).read()
+        request('PUT', '/', 'bad data').read()
+        response = request('GET', '/_metrics')
+        self.assertEquals(200, response.status)
+        self.assertEquals('text/plain', response.getheader('Content-Type'))
+        metrics = response.read()
+        self.assertTrue('climage_requests 2\n' in metrics)
+        self.assertTrue('climage_bad_images 1\n' in metrics)
+        self.assertTrue('climage_bytes_in %d\n' % (len(IMAGE) + 8) in
+            metrics)
+        self.assertTrue('stage="resize"' in metrics)
+        self.assertTrue('climage_pool_busy 0\n' in metrics)
+        self.assertTrue('climage_pool_queued 0\n' in metrics)
+        self.assertTrue('climage_pool_utilization 0.000000\n' in metrics)
+
+    def test_counting_pool(self):
+        pool = climage.server.CountingPool(1)
+        started = threading.Event()
+        finish = threading.Event()
+
+        def function(value):
+            started.set()
+            finish.wait()
+            return value
+
+        first = pool.start(function, 1)
+        started.wait()
+        batch = pool.batch()
+        batch.start(function, 2)
+        self.assertEquals(1, pool.busy)
+        self.assertEquals(1, pool.queued)
+        finish.set()
+        self.assertEquals(1, first.wait())
+        batch.wait_all()
+        self.assertEquals(0, pool.busy)
+        self.assertEquals(0, pool.queued)
+        pool.stop()
+
+    def test_admission(self):
+        admission = climage.server.Admission(1, 0)
+        self.assertTrue(admission.acquire(2000000))
+        self.assertFalse(admission.acquire(1))
+        self.assertEquals(1, admission.stats['shed'])
+        admission.release(2000000)
+        self.assertTrue(admission.acquire(500000))
+        self.assertTrue(admission.acquire(500000))
+        self.assertEquals(3, admission.stats['admitted'])
+
+    def test_admission_shed(self):
+        config = clcommon.config.update(CONFIG, {'climage': {'server': {
+            'admission_limit': 1,
+            'admission_timeout': 0}}})
+        self.start_server(config)
+        self.server.admission.acquire(1000000)
+        response = request('PUT', '/', IMAGE)
+        self.assertEquals(503, response.status)
+        self.server.admission.release(1000000)
+        response = request('PUT', '/', IMAGE)
+        self.assertEquals(200, response.status)
+        metrics = request('GET', '/_metrics').read()
+        self.assertTrue('climage_admission_shed 1\n' in metrics)
+
+    def test_admission_render(self):
+        config = clcommon.config.update(CONFIG, {'climage': {'server': {
+            'admission_limit': 1,
+            'admission_timeout': 0,
+            'render_on_read': True}}})
+        self.start_server(config)
+        response = request('PUT', '/?response=checksum', IMAGE)
+        checksum = response.read()
+        self.server.admission.acquire(1000000)
+        response = request('GET', '/%s/50x50c' % checksum)
+        self.assertEquals(503, response.status)
+        self.server.admission.release(1000000)
+        response = request('GET', '/%s/50x50c' % checksum)
+        self.assertEquals(200, response.status)
+
     def test_param_ttl(self):
         response = request('PUT', '/?ttl=100', IMAGE)
         self.assertEquals(200, response.status)
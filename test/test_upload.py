@@ -0,0 +1,128 @@
+# Copyright 2013 craigslist
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Tests for craigslist image upload module.'''
+
+import os
+import shutil
+import time
+import unittest
+
+import clblob.client
+import climage.upload
+import test.test_processor
+
+
+def wait_for(check, timeout=5):
+    '''Wait for a background upload to make the check true.'''
+    end = time.time() + timeout
+    while not check() and time.time() < end:
+        time.sleep(0.01)
+
+
+class FlakyClient(object):
+    '''Blob client wrapper that fails the given number of puts first.'''
+
+    def __init__(self, blob_client, failures):
+        self.blob_client = blob_client
+        self.failures = failures
+
+    def put(self, *args, **kwargs):
+        '''Fail if there are failures left, otherwise put the blob.'''
+        if self.failures > 0:
+            self.failures -= 1
+            raise IOError('put failed')
+        return self.blob_client.put(*args, **kwargs)
+
+
+class TestUpload(unittest.TestCase):
+
+    def setUp(self):
+        shutil.rmtree('test_blob', ignore_errors=True)
+        os.makedirs('test_blob')
+        shutil.rmtree('test_spool', ignore_errors=True)
+        self.blob_client = clblob.client.Client(test.test_processor.CONFIG)
+        self.name = self.blob_client.name('test')
+
+    def tearDown(self):
+        self.blob_client.stop()
+        shutil.rmtree('test_spool', ignore_errors=True)
+
+    def test_upload(self):
+        uploader = climage.upload.Uploader(self.blob_client, 2)
+        batch = uploader.batch()
+        batch.put(self.name, 'data', 60)
+        batch.wait()
+        self.assertEquals('data', self.blob_client.get(self.name).read())
+        self.assertEquals(1, uploader.stats['uploaded'])
+        uploader.stop()
+
+    def test_retry(self):
+        uploader = climage.upload.Uploader(
+            FlakyClient(self.blob_client, 2), 1, retry_delay=0)
+        batch = uploader.batch()
+        batch.put(self.name, 'data', 60)
+        batch.wait()
+        self.assertEquals('data', self.blob_client.get(self.name).read())
+        self.assertEquals(2, uploader.stats['retried'])
+        self.assertEquals(1, uploader.stats['uploaded'])
+        uploader.stop()
+
+    def test_retry_fail(self):
+        uploader = climage.upload.Uploader(
+            FlakyClient(self.blob_client, 3), 1, retry_delay=0)
+        batch = uploader.batch()
+        batch.put(self.name, 'data', 60)
+        self.assertRaises(IOError, batch.wait)
+        self.assertEquals(1, uploader.stats['failed'])
+        uploader.stop()
+
+    def test_abort(self):
+        uploader = climage.upload.Uploader(self.blob_client, 2)
+        batch = uploader.batch()
+        batch.put(self.name, 'data', 60)
+        batch.abort()
+        self.assertRaises(clblob.NotFound, self.blob_client.get, self.name)
+        self.assertEquals(1, uploader.stats['deleted'])
+        uploader.stop()
+
+    def test_abort_spool(self):
+        uploader = climage.upload.Uploader(self.blob_client, 2, 'test_spool')
+        batch = uploader.batch()
+        batch.put(self.name, 'data', 60)
+        batch.abort()
+        batch.wait()
+        self.assertEquals(0, uploader.stats['spooled'])
+        self.assertEquals([], os.listdir('test_spool'))
+        uploader.stop()
+
+    def test_write_behind(self):
+        uploader = climage.upload.Uploader(self.blob_client, 2, 'test_spool')
+        batch = uploader.batch()
+        batch.put(self.name, 'data', 60)
+        batch.wait()
+        self.assertEquals(1, uploader.stats['spooled'])
+        wait_for(lambda: uploader.stats['uploaded'] == 1)
+        self.assertEquals('data', self.blob_client.get(self.name).read())
+        self.assertEquals([], os.listdir('test_spool'))
+        uploader.stop()
+
+    def test_replay(self):
+        uploader = climage.upload.Uploader(self.blob_client, 1, 'test_spool')
+        uploader._spool(self.name, 'data', 60)
+        self.assertEquals(1, uploader.replay())
+        wait_for(lambda: uploader.stats['uploaded'] == 1)
+        self.assertEquals('data', self.blob_client.get(self.name).read())
+        self.assertEquals([], os.listdir('test_spool'))
+        uploader.stop()